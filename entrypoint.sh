@@ -37,6 +37,23 @@ printf '%s\n' "  heif-enc: $(command -v heif-enc)"
 PORT="${PORT:-8000}"
 WORKERS="${WORKERS:-4}"
 
+# 按 cgroup 的 CPU 配额与内存限制收紧 worker 数（WORKERS 为上限）；
+# 导出后各 worker 据此规划自己的并发数与线程数
+if [ "${RESOURCE_PLANNING:-auto}" = "auto" ]; then
+    if PLANNED_WORKERS=$(WORKERS="$WORKERS" python3 main.py --plan-workers 2>/dev/null); then
+        WORKERS="$PLANNED_WORKERS"
+    else
+        echo "warning: resource planning failed, using WORKERS=$WORKERS" >&2
+    fi
+fi
+export WORKERS
+
+# 转换代理：各 worker 经 Unix socket 共享一个全局准入调度器（CONVERSION_BROKER=off 时不启动）
+if [ "${CONVERSION_BROKER:-auto}" != "off" ]; then
+    echo "Starting conversion broker..."
+    python3 main.py --broker &
+fi
+
 echo "Starting $WORKERS workers on port $PORT..."
 echo "=========================================="
 
@@ -10,30 +10,64 @@ ImageMagick 动态图像转换 API
 
 主要端点:
 - POST /convert/{target_format}/{mode}/{setting}
-- GET /health
+- POST /renditions
+- POST /jobs/{target_format}/{mode}/{setting}, GET/DELETE /jobs/{job_id}, GET /jobs/{job_id}/result
+- GET /health, /health/live, /health/ready
+- GET /metrics
 """
 
 from fastapi import (
     FastAPI,
-    File,
-    UploadFile,
     HTTPException,
     BackgroundTasks,
     Path,
-    Form,
+    Query,
     Request
 )
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import asyncio
+import base64
 import tempfile
 import os
 import shutil
 import logging
 import uuid
-import imghdr
-from typing import Literal
+import io
+import hashlib
+import functools
+import math
+import fcntl
+import json
+import time
+import zipfile
+import bisect
+import re
+import resource
+import signal
+import subprocess
+import threading
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Literal, Optional, get_args
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13 使用旧包名
+    from multipart.multipart import MultipartParser, parse_options_header
+
+try:
+    import PIL
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Pillow 为可选依赖，缺失时所有转换都走 magick CLI
+    PIL = None
+    Image = None
+    ImageOps = None
+    pil_features = None
 
 # --- 1. 应用配置 ---
 
@@ -47,24 +81,236 @@ logger = logging.getLogger(__name__)
 # 资源限制
 MAX_FILE_SIZE_MB = 200  # 允许上传的最大文件大小 (MB)
 TIMEOUT_SECONDS = 300   # Magick 进程执行的超时时间 (秒)
+MAX_RENDITIONS = 8      # /renditions 单次请求允许的最大输出版本数
+MAX_RESIZE_DIMENSION = 16384  # 缩放目标宽/高的上限 (像素)
+MAX_INPUT_MEGAPIXELS = float(os.getenv("MAX_INPUT_MEGAPIXELS", "250"))  # 单帧像素数上限（解压炸弹防护），0 表示不限制
+MAGICK_MEMORY_LIMIT = os.getenv("MAGICK_MEMORY_LIMIT", "512MiB")  # ImageMagick 全局内存限制，也是单次转换 -limit memory 的上限
+MAGICK_MAP_LIMIT = os.getenv("MAGICK_MAP_LIMIT", "1GiB")          # 与 MAGICK_MEMORY_LIMIT 一起决定 magick 子进程的地址空间上限
+MAGICK_DISK_LIMIT = os.getenv("MAGICK_DISK_LIMIT", "4GiB")        # 子进程可写单个文件的大小上限
+PROCESS_RLIMITS = os.getenv("PROCESS_RLIMITS", "on")              # on 时为每个编码子进程设置 rlimit，off 不设置
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # Content-Length 预检时为 multipart 边界和表单字段预留的余量
+MAX_FORM_FIELD_BYTES = 64 * 1024      # 单个文本表单字段的最大长度
 TEMP_DIR = os.getenv("TEMP_DIR", tempfile.gettempdir())  # 临时文件存储目录，优先使用环境变量，否则使用系统临时目录
 
-# 并发控制配置（防止资源过载）
-MAX_CONCURRENT_CONVERSIONS = int(os.getenv("MAX_CONCURRENT_PER_WORKER", "3"))
-conversion_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
-logger.info(f"并发限制已启用: 每个worker最多 {MAX_CONCURRENT_CONVERSIONS} 个并发转换")
+# 并发控制配置（防止资源过载）：WORKERS 与 MAX_CONCURRENT_PER_WORKER 为上限，
+# RESOURCE_PLANNING=auto 时再按 cgroup 的 CPU 配额与内存限制收紧，并为每条命令分配线程数（见 1b 节）
+WORKERS = int(os.getenv("WORKERS", "4"))
+MAX_CONCURRENT_PER_WORKER = int(os.getenv("MAX_CONCURRENT_PER_WORKER", "3"))
+RESOURCE_PLANNING = os.getenv("RESOURCE_PLANNING", "auto")  # auto 或 off（完全按环境变量配置，不传线程参数）
+
+# 准入调度：按估算成本（百万像素 × 帧数 × 格式权重）分配每个 worker 的成本预算
+ADMISSION_SLOT_COST = float(os.getenv("ADMISSION_SLOT_COST", "50"))            # 每个并发槽位对应的成本单位
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))              # 每个 worker 最多排队的转换数
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "60"))  # 排队超时后返回 429
+ADMISSION_FAST_LANE_COST = float(os.getenv("ADMISSION_FAST_LANE_COST", "2"))  # 不超过该成本的任务走快速通道
+FAST_LANE_RESERVED_SLOTS = 1  # 快速通道在常规槽位之外额外保留的并发数
+
+# 转换代理（broker）：独立进程持有全局准入调度器，各 worker 经 Unix socket 申请转换许可；
+# 连不上时退回 worker 内的调度器
+CONVERSION_BROKER = os.getenv("CONVERSION_BROKER", "auto")  # auto 或 off（始终按 worker 调度）
+BROKER_SOCKET = os.path.join(TEMP_DIR, ".broker.sock")
+BROKER_MAX_CONVERSIONS = int(os.getenv("BROKER_MAX_CONVERSIONS", "0"))  # 全局并发转换数，0 表示 worker 数 × 每 worker 并发数
+
+# 转换结果缓存（按内容寻址，位于 TEMP_DIR 下，多个 worker 共享）
+CACHE_DIR = os.path.join(TEMP_DIR, ".conversion-cache")
+CACHE_MAX_MB = int(os.getenv("CONVERSION_CACHE_MAX_MB", "1024"))  # 0 表示禁用缓存
+CACHE_LOCK_PREFIX_CHARS = 3  # single_flight 跨 worker 锁按键前缀分片：16^3 = 4096 个固定锁文件
+
+# 会话暂存区：小任务的会话目录与 heif-enc 中间文件放在内存文件系统，大任务落在 TEMP_DIR
+SCRATCH_RAM_DIR = "/dev/shm"
+STAGING_RAM_MAX_MB = int(os.getenv("STAGING_RAM_MAX_MB", "256"))          # 所有 worker 合计的内存暂存预算，0 表示只用磁盘
+STAGING_SWEEP_SECONDS = int(os.getenv("STAGING_SWEEP_SECONDS", "300"))    # 遗留会话目录的清理间隔，0 表示只在启动时清理
+
+# 能力探测（依赖版本、coder 列表、临时目录）后台刷新间隔（秒），0 表示只在启动时探测
+CAPABILITY_REFRESH_SECONDS = int(os.getenv("CAPABILITY_REFRESH_SECONDS", "60"))
+
+# 大型动图分片并行编码：帧数或总像素数（帧数 × 单帧像素）达到阈值时启用，0 表示不按该条件启用
+ANIMATION_SHARD_MIN_FRAMES = int(os.getenv("ANIMATION_SHARD_MIN_FRAMES", "100"))
+ANIMATION_SHARD_MIN_MEGAPIXELS = float(os.getenv("ANIMATION_SHARD_MIN_MEGAPIXELS", "200"))
+
+# 异步任务：结果保存在 TEMP_DIR/.jobs 下，过期后由后台任务清理
+JOBS_DIR = os.path.join(TEMP_DIR, ".jobs")
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "16"))              # 所有 worker 合计排队/执行中的任务上限
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))  # 任务结束后记录与结果的保留时间
+
+# 进程内快速引擎（Pillow）：仅处理不超过该像素数的静态 JPEG/PNG/WebP，0 表示禁用
+FAST_PATH_MAX_MEGAPIXELS = float(os.getenv("FAST_PATH_MAX_MEGAPIXELS", "16"))
+
+# 管道模式：不超过该大小的上传保留在内存中，经 stdin/stdout 与 magick 交换数据并流式返回，0 表示禁用
+PIPE_MAX_MB = float(os.getenv("PIPE_MAX_MB", "8"))
+
+# auto 目标格式：按 Accept 协商后实际编码的候选格式数，返回其中最小的结果；1 表示只编码首选格式
+AUTO_CANDIDATES = int(os.getenv("AUTO_CANDIDATES", "2"))
+
+# 源图存储：POST /img 上传一次，GET /img/{hash}/... 多次转换；0 表示禁用
+SOURCES_DIR = os.path.join(TEMP_DIR, ".sources")
+SOURCE_STORE_MAX_MB = int(os.getenv("SOURCE_STORE_MAX_MB", "2048"))
+IMG_CACHE_MAX_AGE = int(os.getenv("IMG_CACHE_MAX_AGE", "86400"))  # GET /img 响应的 Cache-Control max-age (秒)
+
+# 请求级性能追踪：header 时请求带 X-Conversion-Trace: 1 才输出 Server-Timing 与 X-Conversion-Stats，
+# on 时所有转换响应都输出，off 时不输出（忽略请求头）
+CONVERSION_TRACE = os.getenv("CONVERSION_TRACE", "header")
+
+# 分块续传上传：数据块追加到 TEMP_DIR/.uploads 下的会话文件，空闲超时的会话由后台清理
+UPLOADS_DIR = os.path.join(TEMP_DIR, ".uploads")
+UPLOAD_MAX_SESSIONS = int(os.getenv("UPLOAD_MAX_SESSIONS", "32"))                # 所有 worker 合计未完成的会话上限
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", "3600"))  # 会话空闲超过该时间即过期
+
+# --- 1b. 资源规划 ---
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+WORKER_BASE_MEMORY_BYTES = 128 * 1024 * 1024  # 每个 worker 进程自身（Python、FastAPI、Pillow）的常驻内存估算
+
+def parse_byte_size(value: str) -> Optional[int]:
+    """解析 ImageMagick 资源限制写法（如 512MiB、1GB、1048576），无法解析时返回 None。"""
+    number = value.strip().upper().rstrip("B").rstrip("I")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    multiplier = units.get(number[-1:], 1)
+    if number[-1:] in units:
+        number = number[:-1]
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        return None
+
+def _read_cgroup_value(*candidates: str) -> Optional[str]:
+    """读取第一个存在的 cgroup 文件（相对 CGROUP_ROOT），都不存在时返回 None。"""
+    for candidate in candidates:
+        try:
+            with open(os.path.join(CGROUP_ROOT, candidate)) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+def detect_cpu_limit() -> float:
+    """
+    可用 CPU 数：CPU 亲和性掩码与 cgroup CPU 配额中较小者。
+
+    cgroup v2 读取 cpu.max（"配额 周期" 或 "max 周期"），v1 读取
+    cpu.cfs_quota_us / cpu.cfs_period_us（配额为 -1 表示不限制）。
+    """
+    try:
+        cpus = float(len(os.sched_getaffinity(0)))
+    except AttributeError:  # 非 Linux 平台
+        cpus = float(os.cpu_count() or 1)
+
+    quota = period = None
+    cpu_max = _read_cgroup_value("cpu.max")
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota = _read_cgroup_value("cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us")
+        period = _read_cgroup_value("cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us")
+    try:
+        if quota not in (None, "max", "-1") and period and int(quota) > 0:
+            cpus = min(cpus, int(quota) / int(period))
+    except ValueError:
+        pass
+    return max(cpus, 1.0)
+
+def detect_memory_limit() -> Optional[int]:
+    """可用内存（字节）：cgroup 内存限制（v2 memory.max，v1 memory.limit_in_bytes）与物理内存中较小者。"""
+    limits = []
+    try:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (AttributeError, ValueError, OSError):
+        pass
+    value = _read_cgroup_value("memory.max", "memory/memory.limit_in_bytes")
+    if value is not None and value.isdigit():
+        # v1 未设置限制时为接近 2^63 的值，与物理内存取较小者即可自然忽略
+        limits.append(int(value))
+    return min(limits) if limits else None
+
+def plan_resources(
+    cpus: float,
+    memory_bytes: Optional[int],
+    workers: int,
+    concurrency: int,
+    job_memory_bytes: Optional[int]
+) -> dict:
+    """
+    根据可用 CPU 与内存推导 worker 数、每个 worker 的并发数和单个任务的线程数。
+
+    - worker 数不超过 CPU 数，每个 worker 的并发数使总并发约等于 CPU 数
+    - 有内存限制时，总并发 × 单任务内存上限（MAGICK_MEMORY_LIMIT）加上各
+      worker 自身的常驻内存不超过限制
+    - max_threads 为单个 worker 的 CPU 份额（负载低时一个任务可用满），
+      min_threads 为并发跑满时每个任务的份额（至少 1）
+
+    workers 与 concurrency 为环境变量给出的上限，规划结果只会更小。
+    """
+    workers = max(1, min(workers, int(cpus)))
+    concurrency = max(1, min(concurrency, math.ceil(cpus / workers)))
+    if memory_bytes and job_memory_bytes:
+        max_jobs = max(1, (memory_bytes - workers * WORKER_BASE_MEMORY_BYTES) // job_memory_bytes)
+        workers = max(1, min(workers, max_jobs))
+        concurrency = max(1, min(concurrency, max_jobs // workers))
+    cpu_share = cpus / workers
+    return {
+        "cpus": round(cpus, 2),
+        "memory_bytes": memory_bytes,
+        "workers": workers,
+        "concurrency": concurrency,
+        "max_threads": max(1, int(cpu_share)),
+        "min_threads": max(1, int(cpu_share / concurrency)),
+    }
+
+if RESOURCE_PLANNING == "auto":
+    RESOURCE_PLAN = plan_resources(
+        detect_cpu_limit(), detect_memory_limit(), WORKERS, MAX_CONCURRENT_PER_WORKER,
+        parse_byte_size(MAGICK_MEMORY_LIMIT)
+    )
+else:
+    RESOURCE_PLAN = {
+        "cpus": round(detect_cpu_limit(), 2),
+        "memory_bytes": detect_memory_limit(),
+        "workers": WORKERS,
+        "concurrency": MAX_CONCURRENT_PER_WORKER,
+        "max_threads": None,
+        "min_threads": None,
+    }
+MAX_CONCURRENT_CONVERSIONS = RESOURCE_PLAN["concurrency"]
+logger.info(
+    "资源规划 (%s): %.2f CPU, %d workers, 每个worker最多 %d 个并发转换, 单任务线程数 %s-%s",
+    RESOURCE_PLANNING, RESOURCE_PLAN["cpus"], RESOURCE_PLAN["workers"], MAX_CONCURRENT_CONVERSIONS,
+    RESOURCE_PLAN["min_threads"], RESOURCE_PLAN["max_threads"]
+)
 
 # --- 2. API 参数类型定义 ---
 
 # 定义 API 路径中允许的目标格式
 TargetFormat = Literal["avif", "webp", "jpeg", "png", "gif", "heif"]
 
+# 同步转换端点额外允许 auto：按 Accept 请求头协商输出格式
+NegotiableFormat = Literal["avif", "webp", "jpeg", "png", "gif", "heif", "auto"]
+
 # 定义 API 路径中允许的转换模式
 ConversionMode = Literal["lossless", "lossy"]
 
+# 定义缩放适配方式：contain=等比缩小到框内（不放大），cover=等比填满后居中裁剪，fill=拉伸到精确尺寸
+ResizeFit = Literal["contain", "cover", "fill"]
+
 # --- 3. FastAPI 应用初始化 ---
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """worker 启动时完成能力探测并启动能力/指标刷新、遗留会话目录与任务清理的后台任务，退出时停止。"""
+    await capability_probe.start()
+    await staging_area.start()
+    await metrics.start()
+    await job_store.start()
+    await upload_store.start()
+    yield
+    await upload_store.stop()
+    await source_store.stop()
+    await job_store.stop()
+    await metrics.stop()
+    await staging_area.stop()
+    await capability_probe.stop()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Magick 动态图像转换器 (V4)",
     description="通过 Web 界面或 API 实现多种格式的(无)损图像转换，支持动图。提供现代化图形上传界面和灵活的 RESTful API。",
     version="4.0.0"
@@ -79,119 +325,25 @@ templates = Jinja2Templates(directory="templates")
 # 启动时确保临时目录存在
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-# --- 4. 辅助函数 ---
-
-async def get_upload_file_size(upload_file: UploadFile) -> int:
-    """
-    异步获取上传文件的大小（以字节为单位）。
-    
-    通过 seek 到文件末尾来测量大小，然后重置指针。
-    (继承自 ocrmypdf-hfs 实践)
-
-    Args:
-        upload_file: FastAPI 的 UploadFile 对象。
-
-    Returns:
-        文件大小（字节）。
-    """
-    current_position = upload_file.file.tell()
-    upload_file.file.seek(0, 2)  # 移动到文件末尾
-    size = upload_file.file.tell()
-    upload_file.file.seek(current_position)  # 恢复原始指针位置
-    return size
+# --- 3a. 运行时能力快照 ---
 
-async def validate_image_content(upload_file: UploadFile) -> bool:
+async def _run_probe(name: str, executable: str, *probe_args: str) -> tuple:
     """
-    验证上传文件是否为有效的图像文件（通过文件头魔数检测）。
-    
-    此函数通过检查文件头部的魔数（magic bytes）来验证文件的真实类型，
-    防止恶意文件通过修改扩展名绕过验证。
-
-    Args:
-        upload_file: FastAPI 的 UploadFile 对象。
+    执行一次探测命令。
 
     Returns:
-        True 如果文件是有效的图像，False 否则。
-    """
-    # 保存当前位置
-    current_position = upload_file.file.tell()
-    upload_file.file.seek(0)
-    
-    # 读取文件头部用于检测
-    file_header = upload_file.file.read(32)
-    upload_file.file.seek(current_position)  # 恢复原始指针位置
-    
-    # 使用 imghdr 检测图像类型
-    img_type = imghdr.what(None, h=file_header)
-    
-    # 支持的图像类型
-    valid_types = {'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
-    
-    if img_type in valid_types:
-        return True
-    
-    # imghdr 不支持某些格式，需要手动检测魔数
-    # AVIF/HEIF 检测 (ftyp box)
-    if len(file_header) >= 12:
-        # HEIF/AVIF 文件以 ftyp box 开头
-        ftyp_offset = file_header[4:8]
-        if ftyp_offset == b'ftyp':
-            # 检查品牌类型
-            brand = file_header[8:12]
-            # 常见的 HEIF/AVIF 品牌
-            heif_brands = [b'heic', b'heix', b'hevc', b'hevx', b'mif1', b'msf1', b'avif', b'avis']
-            if brand in heif_brands:
-                return True
-    
-    # WebP 可能 imghdr 检测不到的情况
-    if len(file_header) >= 12:
-        if file_header[:4] == b'RIFF' and file_header[8:12] == b'WEBP':
-            return True
-    
-    return False
-
-def cleanup_temp_dir(temp_dir: str):
-    """
-    在后台任务中安全地清理临时会话目录。
-    (继承自 ocrmypdf-hfs 实践)
-
-    Args:
-        temp_dir: 要递归删除的目录路径。
-    """
-    try:
-        if os.path.exists(temp_dir):
-            logger.info(f"后台清理：正在删除临时目录: {temp_dir}")
-            shutil.rmtree(temp_dir)
-            logger.info(f"后台清理：已成功删除 {temp_dir}")
-    except Exception as cleanup_error:
-        logger.error(f"后台清理：删除 {temp_dir} 失败: {cleanup_error}", exc_info=True)
-
-# --- 5. API 端点 ---
-
-@app.get("/", summary="上传界面")
-async def root(request: Request):
+        (stdout, None) 成功；(None, 失败原因) 无法启动、超时或非零退出
     """
-    返回用户友好的HTML上传表单页面。
-    提供图形化界面进行图像转换，支持4套主题切换。
-    """
-    return templates.TemplateResponse("index.html", {"request": request})
-
-async def _probe_dependency(name: str, probe_arg: str) -> dict:
-    """Probe a required executable without relying on an external ``which`` command."""
-    executable = shutil.which(name)
-    if executable is None:
-        return {"status": "missing", "path": None, "detail": "executable not found"}
-
     try:
         process = await asyncio.subprocess.create_subprocess_exec(
             executable,
-            probe_arg,
+            *probe_args,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
     except OSError as exc:
         logger.warning("Unable to start dependency probe for %s: %s", name, exc)
-        return {"status": "failed", "path": executable, "detail": "probe could not start"}
+        return None, "probe could not start"
 
     try:
         stdout, _ = await asyncio.wait_for(process.communicate(), timeout=5)
@@ -201,16 +353,79 @@ async def _probe_dependency(name: str, probe_arg: str) -> dict:
         except ProcessLookupError:
             pass
         await process.communicate()
-        return {"status": "failed", "path": executable, "detail": "probe timed out"}
+        return None, "probe timed out"
 
     if process.returncode != 0:
-        return {"status": "failed", "path": executable, "detail": "probe exited unsuccessfully"}
+        return None, "probe exited unsuccessfully"
+    return stdout.decode(errors="replace"), None
+
+async def _probe_dependency(name: str, probe_arg: str) -> dict:
+    """Probe a required executable without relying on an external ``which`` command."""
+    executable = shutil.which(name)
+    if executable is None:
+        return {"status": "missing", "path": None, "detail": "executable not found"}
+
+    stdout, failure = await _run_probe(name, executable, probe_arg)
+    if failure is not None:
+        return {"status": "failed", "path": executable, "detail": failure}
 
     details = {"status": "available", "path": executable}
-    if name == "magick":
-        details["version"] = stdout.decode(errors="replace").split("\n")[0]
+    # magick --version 与 heif-enc --help 的首行都包含版本信息
+    details["version"] = stdout.split("\n")[0]
     return details
 
+async def _probe_magick_coders(executable: Optional[str]) -> dict:
+    """
+    解析 `magick -list format`，返回 {coder: 模式}，例如 {"WEBP": "rw+"}。
+
+    模式列中 r/w 表示可读/可写，+ 表示支持多帧。探测失败时返回空字典。
+    """
+    if executable is None:
+        return {}
+    stdout, failure = await _run_probe("magick", executable, "-list", "format")
+    if failure is not None:
+        return {}
+    # IM7 的列为 "Format  Module  Mode  Description"，Module 列可能为空
+    coders = {}
+    for line in stdout.splitlines():
+        parts = line.split()
+        for token in parts[1:3]:
+            if len(token) == 3 and token[0] in "r-" and token[1] in "w-" and token[2] in "+-":
+                coders[parts[0].rstrip("*")] = token
+                break
+    return coders
+
+async def _probe_heif_enc_sequence(executable: Optional[str]) -> bool:
+    """heif-enc 是否支持编码图像序列（libheif 1.20 起的 --sequence 选项）。"""
+    if executable is None:
+        return False
+    stdout, failure = await _run_probe("heif-enc", executable, "--help")
+    return failure is None and "--sequence" in stdout
+
+async def _probe_heif_enc_parameters(executable: Optional[str]) -> dict:
+    """
+    解析 `heif-enc --params` 与 `heif-enc --avif --params`，返回
+    {"heif"/"avif": {"encoder": 编码器名称, "parameters": [参数名, ...]}}。
+
+    用于判断能否向编码器传递线程数参数；探测失败时对应格式缺失。
+    """
+    if executable is None:
+        return {}
+    result = {}
+    for target_format, probe_args in (("heif", ["--params"]), ("avif", ["--avif", "--params"])):
+        stdout, failure = await _run_probe("heif-enc", executable, *probe_args)
+        if failure is not None:
+            continue
+        encoder = None
+        parameters = []
+        for line in stdout.splitlines():
+            if line.startswith("Parameters for encoder"):
+                encoder = line.split("`")[1] if line.count("`") >= 2 else line
+            elif line.startswith(" ") and "," in line:
+                parameters.append(line.split(",", 1)[0].strip())
+        result[target_format] = {"encoder": encoder, "parameters": parameters}
+    return result
+
 
 def _probe_temp_dir() -> dict:
     """Verify that conversion workers can create files in the configured temp directory."""
@@ -232,372 +447,6130 @@ def _probe_temp_dir() -> dict:
     }
 
 
-@app.get("/health", summary="服务健康检查")
-async def health_check():
-    """Report dependency failures as a non-2xx response before serving conversions."""
-    dependencies = {
-        "magick": await _probe_dependency("magick", "--version"),
-        "heif_enc": await _probe_dependency("heif-enc", "--help"),
-    }
-    magick = dependencies["magick"]
-    heif_enc = dependencies["heif_enc"]
-    base_response = {
-        "dependencies": dependencies,
-        "imagemagick": magick.get("version", "Not available"),
-        "avif_encoder": heif_enc.get("path") or "Not available (AVIF/HEIF conversion will fail)",
-        "resource_limits": {
-            "max_file_size_mb": MAX_FILE_SIZE_MB,
-            "timeout_seconds": TIMEOUT_SECONDS,
-        },
-    }
+# ImageMagick 中 AVIF/HEIF 对应的 coder 名称
+HEIF_CODERS = {"avif": "AVIF", "heif": "HEIC"}
 
-    if any(item["status"] != "available" for item in dependencies.values()):
-        base_response["status"] = "unhealthy"
-        return JSONResponse(status_code=503, content=base_response)
+class CapabilityProbe:
+    """
+    每个 worker 一份的运行时能力快照。
 
-    temp_dir = _probe_temp_dir()
-    if temp_dir["status"] != "available":
-        base_response["status"] = "unhealthy"
-        base_response["disk_space"] = temp_dir
-        return JSONResponse(status_code=503, content=base_response)
+    启动时探测一次，之后由后台任务按 CAPABILITY_REFRESH_SECONDS 刷新：
+    记录 magick / heif-enc / webpmux 的路径与版本、magick 支持的 coder
+    以及临时目录状态。健康检查与转换路径只读取快照，不再逐请求派生
+    探测进程。
+    """
 
-    base_response["status"] = "healthy"
-    base_response["disk_space"] = {
-        "free_mb": temp_dir["free_mb"],
-        "temp_dir": temp_dir["temp_dir"],
-    }
-    return base_response
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.snapshot: Optional[dict] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
 
-async def _perform_conversion(
-    background_tasks: BackgroundTasks,
-    file: UploadFile,
-    target_format: str,
-    mode: str,
-    setting: int
-) -> FileResponse:
-    """
-    核心图像转换逻辑（内部函数）。
-    被多个端点复用以避免代码重复。
+    async def refresh(self) -> dict:
+        """重新探测全部能力并替换快照。"""
+        async with self._lock:
+            magick = await _probe_dependency("magick", "--version")
+            heif_enc = await _probe_dependency("heif-enc", "--help")
+            webpmux_path = shutil.which("webpmux")
+            webpmux = (
+                {"status": "available", "path": webpmux_path}
+                if webpmux_path else {"status": "missing", "path": None, "detail": "executable not found"}
+            )
+            coders = await _probe_magick_coders(magick.get("path") if magick["status"] == "available" else None)
+            heif_enc_parameters = await _probe_heif_enc_parameters(
+                heif_enc.get("path") if heif_enc["status"] == "available" else None
+            )
+            heif_enc_sequence = await _probe_heif_enc_sequence(
+                heif_enc.get("path") if heif_enc["status"] == "available" else None
+            )
+            temp_dir = await asyncio.to_thread(_probe_temp_dir)
+            self.snapshot = {
+                "dependencies": {"magick": magick, "heif_enc": heif_enc, "webpmux": webpmux},
+                "coders": coders,
+                "heif_enc_parameters": heif_enc_parameters,
+                "heif_enc_sequence": heif_enc_sequence,
+                "temp_dir": temp_dir,
+                "checked_at": time.monotonic(),
+            }
+            return self.snapshot
 
-    Args:
-        background_tasks: FastAPI后台任务对象
-        file: 上传的图像文件
-        target_format: 目标格式 (avif, webp, jpeg, png, gif, heif)
-        mode: 转换模式 (lossy, lossless)
-        setting: 质量/压缩参数 (0-100)
+    async def get(self) -> dict:
+        """返回当前快照；尚未探测过时（例如未经 lifespan 启动）同步探测一次。"""
+        if self.snapshot is None:
+            return await self.refresh()
+        return self.snapshot
 
-    Returns:
-        FileResponse: 转换后的图像文件
-    """
-    logger.info(f"开始转换: {target_format}/{mode}/{setting} (文件: {file.filename})")
+    def has(self, executable: str) -> bool:
+        """可执行文件是否可用；快照生成前回退到 shutil.which。"""
+        if self.snapshot is None:
+            return shutil.which(executable) is not None
+        key = executable.replace("-", "_")
+        return self.snapshot["dependencies"].get(key, {}).get("status") == "available"
 
-    # 初始化临时目录变量，确保 finally 块中可以安全访问
-    temp_dir = None
-    cleanup_scheduled = False
+    def can_write(self, coder: str) -> bool:
+        """magick 是否能写出指定 coder；coder 列表未知时不做限制。"""
+        coders = self.snapshot["coders"] if self.snapshot else {}
+        if not coders:
+            return True
+        return "w" in coders.get(coder.upper(), "")
 
-    # 预检查: AVIF/HEIF 格式需要 heif-enc 依赖。
-    if target_format in ["avif", "heif"] and shutil.which("heif-enc") is None:
-        raise HTTPException(
-            status_code=503,
-            detail="AVIF/HEIF encoding is not available. heif-enc encoder not found."
-        )
+    def can_read(self, coder: str) -> bool:
+        """magick 是否能读取指定 coder；coder 列表未知时不做限制。"""
+        coders = self.snapshot["coders"] if self.snapshot else {}
+        if not coders:
+            return True
+        return "r" in coders.get(coder.upper(), "")
 
-    # 1. 验证文件扩展名
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="Filename is required.")
+    def sequence_encoder(self, target_format: str) -> Optional[str]:
+        """
+        能把动图编码为 AVIF/HEIF 图像序列的编码器：heif-enc 支持 --sequence 时为
+        "heif-enc"，否则为 None（只能输出第一帧）。
 
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heif', '.heic', '.bmp', '.tiff', '.tif'}
-    if file_ext not in allowed_extensions:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file format: {file_ext}. Allowed formats: {', '.join(allowed_extensions)}"
-        )
+        ImageMagick 的 AVIF/HEIC coder 即使是 w+（接受多帧）也只把各帧写成独立的
+        静态图像项，而不是带时间轴的 avis/msf1 轨道，浏览器只显示主图像，因此不算。
+        """
+        if self.snapshot is None:
+            return None
+        if self.snapshot.get("heif_enc_sequence") and self.has("heif-enc"):
+            return "heif-enc"
+        return None
 
-    # 2. 验证文件内容（魔数检查，防止恶意文件）
-    is_valid_image = await validate_image_content(file)
-    if not is_valid_image:
-        logger.warning(f"文件内容验证失败: {file.filename} - 文件头魔数不匹配图像格式")
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid image file content. The file does not appear to be a valid image."
-        )
+    def heif_enc_thread_options(self, target_format: str, threads: int) -> list:
+        """
+        限制 heif-enc 编码线程数的参数：编码器声明了 threads 参数（aom、svt、rav1e）时
+        使用 -p threads=N；x265 不声明该参数，但会转发 x265: 前缀参数，使用线程池大小
+        -p x265:pools=N。编码器未知时不传参数。
+        """
+        encoder = (self.snapshot or {}).get("heif_enc_parameters", {}).get(target_format)
+        if encoder is None:
+            return []
+        if "threads" in encoder["parameters"]:
+            return ['-p', f'threads={threads}']
+        if encoder["encoder"] and "x265" in encoder["encoder"]:
+            return ['-p', f'x265:pools={threads}']
+        return []
 
-    # 3. 验证文件大小
-    file_size_mb = await get_upload_file_size(file) / (1024 * 1024)
-    if file_size_mb > MAX_FILE_SIZE_MB:
-        logger.warning(f"文件过大: {file_size_mb:.2f}MB (最大: {MAX_FILE_SIZE_MB}MB)")
-        raise HTTPException(
-            status_code=400, 
-            detail=f"File too large. Max size is {MAX_FILE_SIZE_MB}MB."
+    @staticmethod
+    def is_healthy(snapshot: dict) -> bool:
+        """必需依赖与临时目录是否全部可用。"""
+        required = (snapshot["dependencies"]["magick"], snapshot["dependencies"]["heif_enc"])
+        return (
+            all(item["status"] == "available" for item in required)
+            and snapshot["temp_dir"]["status"] == "available"
         )
 
-    # 4. 创建唯一的临时工作目录
-    session_id = str(uuid.uuid4())
-    temp_dir = os.path.join(TEMP_DIR, session_id)
-    os.makedirs(temp_dir, exist_ok=True)
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as exc:
+                logger.warning("后台能力探测失败: %s", exc)
 
-    _, file_extension = os.path.splitext(file.filename)
-    input_path = os.path.join(temp_dir, f"input{file_extension}")
-    output_path = os.path.join(temp_dir, f"output.{target_format}")
+    async def start(self) -> None:
+        """完成首次探测并启动后台刷新任务。"""
+        snapshot = await self.refresh()
+        if not self.is_healthy(snapshot):
+            logger.warning("启动时能力探测发现依赖不可用: %s", snapshot["dependencies"])
+        if self.refresh_seconds > 0:
+            self._task = asyncio.create_task(self._refresh_loop())
 
-    logger.info(f"正在临时目录中处理: {temp_dir}")
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-    try:
-        # 5. 保存上传的文件到临时输入路径
-        logger.info(f"正在保存上传的文件 '{file.filename}' 至 '{input_path}'")
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logger.info("文件保存成功。")
-
-        # 6. 动态构建转换命令。Debian 的 ImageMagick 包不一定编译了
-        # HEIF coder；在这种环境里仅使用 output.avif/output.heif 后缀会
-        # 静默写出 PNG。AVIF/HEIF 因此由已校验存在的 heif-enc 负责，
-        # ImageMagick 只把输入规范化为 encoder 可读的 PNG。
-        use_heif_encoder = target_format in ["avif", "heif"]
-        cmd = ['magick', input_path]
-
-        # 关键: 仅对动画格式使用 -coalesce 以优化性能
-        # -coalesce 会合并所有帧，确保动图（GIF/WebP/AVIF）被正确处理
-        # 检测可能是动画的格式
-        animated_formats = ['.gif', '.webp', '.apng', '.png']
-        if file_extension.lower() in animated_formats or target_format in ['gif', 'webp']:
-            cmd.append('-coalesce')
 
-        # --- 6a. 无损 (lossless) 模式逻辑 ---
-        if mode == "lossless":
-            # 'setting' (0-100) 代表压缩速度 (0=最佳/最慢, 100=最快/最差)
-            
-            if target_format == "webp":
-                # WebP method (0-6), 6 是最慢/最佳
-                # 映射: setting(0) -> method(6), setting(100) -> method(0)
-                # 使用线性插值确保精确映射
-                webp_method = round(6 - (setting / 100.0) * 6)
-                # WebP 无损模式下 quality 应始终为 100
-                cmd.extend(['-define', 'webp:lossless=true'])
-                cmd.extend(['-define', f'webp:method={webp_method}'])
-                cmd.extend(['-quality', '100'])
-
-            elif target_format == "jpeg":
-                # JPEG 几乎没有通用的无损模式，使用-quality 100作为最佳有损替代
-                cmd.extend(['-quality', '100'])
-                
-            elif target_format == "png":
-                # PNG 始终无损
-                # 映射: setting(0) -> compression(9), setting(100) -> compression(0)
-                png_compression = min(9, int((100 - setting) * 0.09))
-                # Magick -quality 映射: 91=级别0, 100=级别9
-                cmd.extend(['-quality', str(91 + png_compression)])
-            
-            elif target_format == "gif":
-                # GIF 始终是基于调色板的无损
-                # -layers optimize 用于优化动图帧
-                cmd.extend(['-layers', 'optimize'])
-
-        # --- 6b. 有损 (lossy) 模式逻辑 ---
-        elif mode == "lossy":
-            # 'setting' (0-100) 代表 质量 (0=最差, 100=最佳)
-            quality = setting
-
-            if target_format == "webp":
-                cmd.extend(['-quality', str(quality)])
-                cmd.extend(['-define', 'webp:method=4']) # 默认使用较快的速度
-            
-            elif target_format == "jpeg":
-                cmd.extend(['-quality', str(quality)])
-                
-            elif target_format == "png":
-                # PNG 本身无损，通过量化（减少颜色）模拟 "有损"
-                # 映射: quality(100) -> 256色, quality(0) -> 2色
-                colors = max(2, int(256 * (quality / 100.0)))
-                cmd.extend(['-colors', str(colors), '+dither'])
-            
-            elif target_format == "gif":
-                # GIF "有损" 通过减少调色板颜色实现
-                colors = max(2, int(256 * (quality / 100.0)))
-                cmd.extend(['-colors', str(colors), '+dither'])
-                cmd.extend(['-layers', 'optimize'])
-
-
-        # 7. 添加输出路径并完成命令构建
-        if use_heif_encoder:
-            encoder_input_path = os.path.join(temp_dir, "encoder-input.png")
-            # heif-enc 只消费单张静态输入；明确选择第一帧，避免
-            # ImageMagick 按未知 AVIF/HEIF coder 静默生成错误格式。
-            commands = [
-                ['magick', f'{input_path}[0]', encoder_input_path],
-                ['heif-enc'],
-            ]
-            if target_format == "avif":
-                commands[1].append('--avif')
-            if mode == "lossless":
-                commands[1].append('--lossless')
-            else:
-                commands[1].extend(['--quality', str(setting)])
-            commands[1].extend(['--output', output_path, encoder_input_path])
-        else:
-            cmd.append(output_path)
-            commands = [cmd]
-
-        # 8. 异步执行转换命令 (使用信号量限制并发)
-        async with conversion_semaphore:
-            logger.info("获取并发许可，开始图像处理")
-            for command in commands:
-                logger.info("正在执行命令: %s", ' '.join(command))
-                try:
-                    process = await asyncio.subprocess.create_subprocess_exec(
-                        *command,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                except OSError as exc:
-                    logger.error("无法启动图像转换进程: %s", exc)
-                    raise HTTPException(
-                        status_code=503,
-                        detail="Image conversion dependency is unavailable."
-                    ) from exc
-                _, stderr = await asyncio.wait_for(
-                    process.communicate(),
-                    timeout=TIMEOUT_SECONDS
+capability_probe = CapabilityProbe(CAPABILITY_REFRESH_SECONDS)
+
+def require_conversion_capabilities(target_formats: list) -> None:
+    """
+    根据能力快照预检查目标格式所需的编码器。
+
+    Raises:
+        HTTPException: 503，heif-enc 缺失或 ImageMagick 不支持写出目标格式
+    """
+    for target_format in target_formats:
+        if target_format in ["avif", "heif"]:
+            if not capability_probe.has("heif-enc"):
+                raise HTTPException(
+                    status_code=503,
+                    detail="AVIF/HEIF encoding is not available. heif-enc encoder not found."
                 )
-                if process.returncode != 0:
-                    error_detail = stderr.decode(errors="replace")
-                    logger.error("Image conversion command failed: %s", error_detail)
-                    raise HTTPException(
-                        status_code=500,
-                        detail="Image conversion failed. Please check your input file and parameters."
-                    )
+        elif not capability_probe.can_write(target_format):
+            raise HTTPException(
+                status_code=503,
+                detail=f"{target_format.upper()} encoding is not available in this ImageMagick build."
+            )
 
-        # 9. 检查命令执行结果
-        if not os.path.exists(output_path):
-            error_message = "转换命令成功执行，但未找到输出文件。"
-            logger.error(error_message)
-            raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+# --- 3b. 运行时指标 ---
 
-        # 10. 成功：准备并返回文件响应
-        logger.info(f"转换成功。输出文件: '{output_path}'")
-        
-        original_filename_base = os.path.splitext(file.filename)[0]
-        download_filename = f"{original_filename_base}.{target_format}"
-        
-        # 动态设置 MimeType
-        media_type = f"image/{target_format}"
-        if target_format == "heif":
-            media_type = "image/heif" # HEIF 的 MimeType
+# 每个 worker 把自己的指标写入 METRICS_DIR/<pid>-<nonce>.json，/metrics 被任一 worker
+# 处理时合并所有文件，因此多 worker 部署下的数值是全局的。已退出 worker 的计数器与
+# 直方图并入 METRICS_DIR/retired.json，其文件随即删除。
+METRICS_DIR = os.path.join(TEMP_DIR, ".metrics")
+METRICS_RETIRED_FILE = "retired.json"
+METRICS_FLUSH_SECONDS = 1.0
 
-        # 注册后台清理任务
-        background_tasks.add_task(cleanup_temp_dir, temp_dir)
-        cleanup_scheduled = True
+# 延迟直方图桶（秒），覆盖从 Pillow 快速路径到 TIMEOUT_SECONDS 的范围
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
 
-        return FileResponse(
-            path=output_path,
-            media_type=media_type,
-            filename=download_filename
-        )
+METRIC_DEFINITIONS = {
+    "imagemagick_api_upload_seconds": ("histogram", "Time spent streaming the upload to disk."),
+    "imagemagick_api_validation_seconds": ("histogram", "Time spent validating the upload (filename, magic bytes)."),
+    "imagemagick_api_semaphore_wait_seconds": ("histogram", "Time spent waiting for admission to a conversion slot."),
+    "imagemagick_api_command_seconds": ("histogram", "Duration of each encoder invocation, by tool."),
+    "imagemagick_api_request_seconds": ("histogram", "Total request time from first body byte to response."),
+    "imagemagick_api_conversions_in_flight": ("gauge", "Conversions currently holding a slot."),
+    "imagemagick_api_conversions_queued": ("gauge", "Conversions waiting for a slot."),
+    "imagemagick_api_conversion_slots": ("gauge", "Configured conversion slots (MAX_CONCURRENT_PER_WORKER per worker)."),
+    "imagemagick_api_input_bytes_total": ("counter", "Bytes of uploaded source images."),
+    "imagemagick_api_output_bytes_total": ("counter", "Bytes of converted output returned."),
+    "imagemagick_api_cache_requests_total": ("counter", "Conversion cache lookups, by result."),
+    "imagemagick_api_admission_rejected_total": ("counter", "Conversions rejected with 429 by admission control, by reason."),
+    "imagemagick_api_processes_total": ("counter", "Encoder child processes reaped, by tool and outcome (ok, failed, terminated)."),
+    "imagemagick_api_process_cpu_seconds_total": ("counter", "User plus system CPU time of encoder child processes, by tool."),
+    "imagemagick_api_process_peak_rss_bytes_total": ("counter", "Sum of per-process peak RSS of encoder child processes, by tool."),
+}
 
-    except asyncio.TimeoutError:
-        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {file.filename}")
-        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
-    except HTTPException as http_exc:
-        # 重新抛出已知的 HTTP 异常
-        raise http_exc
-    except Exception as e:
-        # 捕获所有其他意外错误
-        logger.error(f"发生意外错误: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
-    finally:
-        # 确保关闭上传的文件句柄
-        await file.close()
-        # 备用清理：仅当未注册后台任务时立即清理
-        if temp_dir is not None and not cleanup_scheduled and os.path.exists(temp_dir):
-            cleanup_temp_dir(temp_dir)
+# 当前请求的指标标签（target_format、mode），由转换入口设置，子任务与线程自动继承
+metric_labels: ContextVar[dict] = ContextVar("metric_labels", default={})
 
-@app.post("/", response_class=FileResponse, summary="简化上传转换")
-async def upload_convert(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(..., description="要转换的图像文件"),
-    target_format: str = Form("heif", description="目标格式"),
-    mode: str = Form("lossless", description="转换模式"),
-    setting: int = Form(0, ge=0, le=100, description="质量参数")
-):
-    """
-    通过HTML表单上传并转换图像。
+# 当前转换的进度回调 (stage, fraction)；仅异步任务设置，同步请求为 None
+conversion_progress: ContextVar[Optional[Callable]] = ContextVar("conversion_progress", default=None)
 
-    这个端点接收表单数据（而非URL路径参数），适合从网页表单调用。
-    内部调用与 /convert/{format}/{mode}/{setting} 相同的转换逻辑。
+def report_progress(stage: str, fraction: float) -> None:
+    """向异步任务报告转换阶段与该阶段内的完成比例（0-1）。"""
+    callback = conversion_progress.get()
+    if callback is not None:
+        callback(stage, fraction)
 
-    - **file**: 图像文件
-    - **target_format**: 目标格式 (avif, webp, jpeg, png, gif, heif)，默认 webp
-    - **mode**: 转换模式 (lossy, lossless)，默认 lossy
-    - **setting**: 质量/压缩参数 (0-100)，默认 80
+
+class MetricsRegistry:
     """
-    # 验证参数
-    valid_formats = ["avif", "webp", "jpeg", "png", "gif", "heif"]
-    if target_format not in valid_formats:
-        raise HTTPException(
-            status_code=422,
-            detail=f"Invalid target_format: {target_format}. Must be one of {valid_formats}"
-        )
+    进程内指标注册表，按 Prometheus 文本格式输出。
 
-    valid_modes = ["lossy", "lossless"]
-    if mode not in valid_modes:
-        raise HTTPException(
-            status_code=422,
-            detail=f"Invalid mode: {mode}. Must be one of {valid_modes}"
-        )
+    - 直方图以 [各桶计数..., +Inf 计数, 总和] 的列表保存，输出时累加为累积桶
+    - 计数器跨 worker 求和；仪表值只统计存活进程
+    - 文件名带进程启动时生成的随机后缀，并记录进程启动时间：PID 被新 worker 复用时
+      不会覆盖旧文件，旧文件也不会被误认为存活。已退出 worker 的计数器与直方图在
+      合并时（持有锁）累加进 retired.json，然后删除其文件
+    - 后台任务每 METRICS_FLUSH_SECONDS 把有变化的数据原子写入磁盘，
+      因此其他 worker 的仪表值最多滞后一个刷新周期。序列化在事件循环线程中完成，
+      线程池只负责写文件，避免与 observe()/inc() 并发修改字典
+    """
 
-    if not (0 <= setting <= 100):
-        raise HTTPException(
-            status_code=422,
-            detail=f"Invalid setting: {setting}. Must be between 0 and 100"
+    def __init__(self, metrics_dir: str, flush_seconds: float):
+        self.metrics_dir = metrics_dir
+        self.flush_seconds = flush_seconds
+        self.series: dict = {}
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self._owner: Optional[tuple] = None  # (pid, 文件名, 进程启动时间)
+
+    @staticmethod
+    def _key(labels: dict) -> str:
+        return json.dumps(labels, sort_keys=True)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """向直方图记录一次观测值（秒）。"""
+        values = self.series.setdefault(name, {}).setdefault(
+            self._key(labels), [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
         )
+        values[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        values[-1] += value
+        self._dirty = True
 
-    logger.info(f"收到表单上传请求: {target_format}/{mode}/{setting} (文件: {file.filename})")
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """增加计数器或仪表值（仪表可传负数）。"""
+        series = self.series.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0) + amount
+        self._dirty = True
 
-    # 调用核心转换逻辑
-    return await _perform_conversion(
-        background_tasks=background_tasks,
-        file=file,
-        target_format=target_format,
-        mode=mode,
-        setting=setting
-    )
+    def set(self, name: str, value: float, **labels) -> None:
+        """设置仪表值。"""
+        self.series.setdefault(name, {})[self._key(labels)] = value
+        self._dirty = True
 
-@app.post(
-    "/convert/{target_format}/{mode}/{setting}",
-    summary="动态转换图像 (支持动图)",
-    response_class=FileResponse,
-    responses={
-        200: {"description": "转换成功，返回图像文件"},
-        400: {"description": "请求无效（例如文件过大）"},
-        422: {"description": "路径参数验证失败（例如格式不支持）"},
-        500: {"description": "服务器内部转换失败"},
-        504: {"description": "转换处理超时"}
-    }
-)
+    def _file_owner(self) -> tuple:
+        # 按 PID 惰性生成，fork 出的子进程会得到自己的文件名
+        pid = os.getpid()
+        if self._owner is None or self._owner[0] != pid:
+            self._owner = (pid, f"{pid}-{uuid.uuid4().hex[:8]}.json", process_start_time(pid))
+        return self._owner
+
+    def snapshot(self) -> bytes:
+        """在事件循环线程中序列化本 worker 的指标，结果交给 write() 写入。"""
+        pid, _, started_at = self._file_owner()
+        self._dirty = False
+        return json.dumps({"pid": pid, "started_at": started_at, "series": self.series}).encode()
+
+    def write(self, data: bytes) -> None:
+        """把 snapshot() 的结果原子写入本 worker 的指标文件（可在线程中执行）。"""
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, self._file_owner()[1])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def flush(self) -> None:
+        """序列化并立即写入（事件循环已停止或在其线程内调用）。"""
+        self.write(self.snapshot())
+
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _worker_alive(pid: int, started_at: Optional[float]) -> bool:
+        if not MetricsRegistry._pid_alive(pid):
+            return False
+        if started_at is None:
+            return True
+        current = process_start_time(pid)
+        # PID 已被复用时启动时间不同
+        return current is None or abs(current - started_at) < 1.0
+
+    @staticmethod
+    def _merge_series(target: dict, metric: str, series: dict) -> None:
+        kind = METRIC_DEFINITIONS[metric][0]
+        merged = target.setdefault(metric, {})
+        for key, value in series.items():
+            if kind == "histogram":
+                current = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    def _retire_dead_workers(self) -> dict:
+        """
+        把已退出 worker 的计数器与直方图并入 retired.json 并删除其文件，返回累计值。
+
+        持有目录锁执行，多个 worker 同时抓取时不会重复累加；retired.json 记录已并入
+        的文件名，即使写入后删除前进程退出，下次也不会再次累加。
+        """
+        retired_path = os.path.join(self.metrics_dir, METRICS_RETIRED_FILE)
+        with open(os.path.join(self.metrics_dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(retired_path) as f:
+                    retired = json.load(f)
+            except (OSError, ValueError):
+                retired = {"folded": [], "series": {}}
+            names = set(os.listdir(self.metrics_dir))
+            folded = [name for name in retired["folded"] if name in names]
+            dead = []
+            for name in names:
+                if not name.endswith(".json") or name == METRICS_RETIRED_FILE:
+                    continue
+                path = os.path.join(self.metrics_dir, name)
+                if name in folded:
+                    dead.append(path)
+                    continue
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if self._worker_alive(data.get("pid", 0), data.get("started_at")):
+                    continue
+                for metric, series in data.get("series", {}).items():
+                    if metric in METRIC_DEFINITIONS and METRIC_DEFINITIONS[metric][0] != "gauge":
+                        self._merge_series(retired["series"], metric, series)
+                folded.append(name)
+                dead.append(path)
+            if dead:
+                retired["folded"] = folded
+                tmp_path = f"{retired_path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(retired, f)
+                os.replace(tmp_path, retired_path)
+                for path in dead:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+        return retired["series"]
+
+    @staticmethod
+    def _format_labels(labels: dict, extra: Optional[tuple] = None) -> str:
+        items = list(labels.items())
+        if extra is not None:
+            items.append(extra)
+        if not items:
+            return ""
+        escaped = (
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in items
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self, data: bytes) -> str:
+        """
+        写入本 worker 的 snapshot()，合并全部 worker 的指标文件并输出 Prometheus 文本格式。
+        在线程中执行，不读取 self.series。
+        """
+        self.write(data)
+        merged: dict = {}
+        for metric, series in self._retire_dead_workers().items():
+            if metric in METRIC_DEFINITIONS:
+                self._merge_series(merged, metric, series)
+        for name in os.listdir(self.metrics_dir):
+            if not name.endswith(".json") or name == METRICS_RETIRED_FILE:
+                continue
+            try:
+                with open(os.path.join(self.metrics_dir, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # 合并期间刚退出的 worker：计数仍在其文件中，仪表值不再计入
+            alive = self._worker_alive(data.get("pid", 0), data.get("started_at"))
+            for metric, series in data.get("series", {}).items():
+                if metric not in METRIC_DEFINITIONS:
+                    continue
+                if METRIC_DEFINITIONS[metric][0] == "gauge" and not alive:
+                    continue
+                self._merge_series(merged, metric, series)
+
+        lines = []
+        for metric, (kind, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for key, value in sorted(merged.get(metric, {}).items()):
+                labels = json.loads(key)
+                if kind != "histogram":
+                    lines.append(f"{metric}{self._format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, value):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{self._format_labels(labels, ('le', bound))} {cumulative}")
+                cumulative += value[len(LATENCY_BUCKETS)]
+                lines.append(f"{metric}_bucket{self._format_labels(labels, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{metric}_sum{self._format_labels(labels)} {value[-1]}")
+                lines.append(f"{metric}_count{self._format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            if self._dirty:
+                try:
+                    await asyncio.to_thread(self.write, self.snapshot())
+                except OSError as exc:
+                    self._dirty = True
+                    logger.warning("写入指标文件失败: %s", exc)
+                except Exception:
+                    # 刷新任务不能退出，否则本 worker 的指标从此停止更新
+                    self._dirty = True
+                    logger.error("刷新指标失败", exc_info=True)
+
+    async def start(self) -> None:
+        """记录本 worker 的并发槽位并启动后台刷新任务。"""
+        self.set("imagemagick_api_conversion_slots", MAX_CONCURRENT_CONVERSIONS)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            self.flush()
+        except OSError as exc:
+            logger.warning("写入指标文件失败: %s", exc)
+
+
+metrics = MetricsRegistry(METRICS_DIR, METRICS_FLUSH_SECONDS)
+
+# --- 3c. 准入调度 ---
+
+# 各目标格式的相对编码成本（以 JPEG 为 1）
+FORMAT_COST_WEIGHTS = {"avif": 4.0, "heif": 3.0, "gif": 2.0, "webp": 1.5, "jpeg": 1.0, "png": 1.0}
+
+
+class AdmissionScheduler:
+    """
+    按成本加权的转换准入调度器，取代单纯的 asyncio.Semaphore。
+
+    - 同时运行的任务数不超过 max_jobs，且成本之和不超过 budget；
+      单个任务成本按 budget 截断，超大任务最多独占整个 worker
+    - 成本不超过 fast_lane_cost 的任务进入快速通道：优先于常规队列调度，
+      并可使用额外保留的快速槽位，不会被正在运行的大任务完全挡住
+    - 常规队列按客户端分组轮转，单个客户端的突发请求不会饿死其他客户端
+    - 排队总数超过 max_queue 或等待超过 max_wait 时以 429 拒绝，
+      并根据近期任务耗时估算 Retry-After
+    """
+
+    def __init__(
+        self,
+        max_jobs: int,
+        budget: float,
+        fast_lane_cost: float,
+        fast_lane_slots: int,
+        max_queue: int,
+        max_wait: float
+    ):
+        self.max_jobs = max_jobs
+        self.budget = budget
+        self.fast_lane_cost = fast_lane_cost
+        self.fast_lane_slots = fast_lane_slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.running_jobs = 0
+        self.running_cost = 0.0
+        self.fast_lane_running = 0
+        self.fast_queue: deque = deque()
+        self.client_queues: OrderedDict = OrderedDict()
+        self.queued = 0
+        self.average_job_seconds = 1.0
+
+    def _fits(self, cost: float) -> bool:
+        if self.running_jobs >= self.max_jobs:
+            return False
+        return self.running_jobs == 0 or self.running_cost + cost <= self.budget
+
+    def _start(self, ticket: dict, lane: str) -> None:
+        ticket["lane"] = lane
+        ticket["started_at"] = time.monotonic()
+        if lane == "fast":
+            self.fast_lane_running += 1
+        else:
+            self.running_jobs += 1
+            self.running_cost += ticket["cost"]
+        self.queued -= 1
+        ticket["future"].set_result(lane)
+
+    def _dispatch(self) -> None:
+        # 快速通道优先：常规槽位有余量时直接使用，否则使用保留的快速槽位
+        while self.fast_queue:
+            ticket = self.fast_queue[0]
+            if self._fits(ticket["cost"]):
+                lane = "normal"
+            elif self.fast_lane_running < self.fast_lane_slots:
+                lane = "fast"
+            else:
+                break
+            self.fast_queue.popleft()
+            self._start(ticket, lane)
+
+        # 常规队列：按客户端轮转，每次取队首客户端的第一个任务；
+        # 放不下时停止调度，保证大任务不会被后续小任务无限插队
+        while self.client_queues:
+            client, queue = next(iter(self.client_queues.items()))
+            ticket = queue[0]
+            if not self._fits(ticket["cost"]):
+                break
+            queue.popleft()
+            del self.client_queues[client]
+            if queue:
+                self.client_queues[client] = queue
+            self._start(ticket, "normal")
+
+    def _remove(self, ticket: dict) -> None:
+        if ticket in self.fast_queue:
+            self.fast_queue.remove(ticket)
+        else:
+            queue = self.client_queues.get(ticket["client"])
+            if queue is None or ticket not in queue:
+                return
+            queue.remove(ticket)
+            if not queue:
+                del self.client_queues[ticket["client"]]
+        self.queued -= 1
+
+    def retry_after(self) -> int:
+        """根据近期平均任务耗时与排队长度估算客户端的重试等待秒数。"""
+        estimate = self.average_job_seconds * (self.queued / max(1, self.max_jobs) + 1)
+        return max(1, min(TIMEOUT_SECONDS, int(estimate + 0.999)))
+
+    def _reject(self, reason: str) -> HTTPException:
+        metrics.inc("imagemagick_api_admission_rejected_total", reason=reason)
+        logger.warning("转换请求被准入控制拒绝 (%s)，当前排队 %d", reason, self.queued)
+        return HTTPException(
+            status_code=429,
+            detail="Server is busy. Please retry later.",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    def _expire(self, ticket: dict) -> None:
+        if not ticket["future"].done():
+            self._remove(ticket)
+            ticket["future"].set_exception(self._reject("wait_timeout"))
+            self._dispatch()
+
+    async def acquire(self, cost: float, client: str, background: bool = False) -> dict:
+        """
+        排队等待准入，返回需交给 release() 的凭据。
+
+        background=True 用于异步任务：任务数量已由任务队列限制，且没有
+        等待中的 HTTP 连接，因此不受排队上限与最长等待时间约束。
+
+        Raises:
+            HTTPException: 429，队列已满或等待超时
+        """
+        cost = min(max(cost, 0.0), self.budget)
+        if not background and self.queued >= self.max_queue:
+            raise self._reject("queue_full")
+        ticket = {
+            "cost": cost,
+            "client": client,
+            "future": asyncio.get_running_loop().create_future(),
+        }
+        self.queued += 1
+        if cost <= self.fast_lane_cost:
+            self.fast_queue.append(ticket)
+        else:
+            self.client_queues.setdefault(client, deque()).append(ticket)
+        self._dispatch()
+
+        timer = None
+        if not background:
+            timer = asyncio.get_running_loop().call_later(self.max_wait, self._expire, ticket)
+        try:
+            await ticket["future"]
+        except asyncio.CancelledError:
+            # 客户端断开：已获准入则归还，否则从队列移除
+            future = ticket["future"]
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(ticket)
+            else:
+                self._remove(ticket)
+                self._dispatch()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return ticket
+
+    def release(self, ticket: dict) -> None:
+        """归还准入凭据，更新平均耗时并调度后续任务。"""
+        elapsed = time.monotonic() - ticket["started_at"]
+        self.average_job_seconds = 0.8 * self.average_job_seconds + 0.2 * elapsed
+        if ticket["lane"] == "fast":
+            self.fast_lane_running -= 1
+        else:
+            self.running_jobs -= 1
+            self.running_cost -= ticket["cost"]
+        self._dispatch()
+
+
+admission_scheduler = AdmissionScheduler(
+    max_jobs=MAX_CONCURRENT_CONVERSIONS,
+    budget=MAX_CONCURRENT_CONVERSIONS * ADMISSION_SLOT_COST,
+    fast_lane_cost=ADMISSION_FAST_LANE_COST,
+    fast_lane_slots=FAST_LANE_RESERVED_SLOTS,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT_SECONDS,
+)
+
+def client_identity(request: Request) -> str:
+    """公平调度使用的客户端标识：优先取反向代理提供的 X-Forwarded-For 首个地址。"""
+    forwarded = request.headers.get("x-forwarded-for", "")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def estimate_conversion_cost(image: Optional[dict], target_formats: list, input_size: int) -> float:
+    """
+    估算一次转换的成本：百万像素 × 帧数 × 目标格式权重之和。
+
+    image 为输入的 inspect_image() 结果；无法得到尺寸时按文件大小近似（压缩
+    图像约每字节 3 像素）。没有序列编码器时 AVIF/HEIF 只编码第一帧，不乘以帧数。
+    """
+    frames = 1
+    if image is not None and image["width"] and image["height"]:
+        megapixels = image["width"] * image["height"] / 1_000_000
+        frames = max(1, image["frames"])
+    else:
+        megapixels = input_size * 3 / 1_000_000
+    return megapixels * sum(
+        FORMAT_COST_WEIGHTS.get(target_format, 1.0) * (
+            1 if target_format in ["avif", "heif"] and capability_probe.sequence_encoder(target_format) is None
+            else frames
+        )
+        for target_format in target_formats
+    )
+
+# 当前转换每条命令可用的线程数，由 conversion_slot() 按获准入时的负载设置；None 表示不限制
+conversion_threads: ContextVar[Optional[int]] = ContextVar("conversion_threads", default=None)
+
+def plan_job_threads(running_jobs: int, queued: int, cpus: Optional[float] = None) -> Optional[int]:
+    """
+    为刚获准入的任务分配线程数：调度器可用的 CPU（默认为 worker 的份额，
+    转换代理传入整机 CPU 数）由正在运行的任务平分，负载低时单个任务最多用满
+    这些 CPU；有任务排队（已饱和）时退回 min_threads，避免线程数与进程数
+    相乘后超额占用 CPU。
+    """
+    if RESOURCE_PLAN["max_threads"] is None:
+        return None
+    if queued > 0:
+        return RESOURCE_PLAN["min_threads"]
+    if cpus is None:
+        cpus = RESOURCE_PLAN["cpus"] / RESOURCE_PLAN["workers"]
+    share = cpus / max(1, running_jobs)
+    return max(RESOURCE_PLAN["min_threads"], min(max(1, int(cpus)), int(share)))
+
+def with_thread_options(command: list) -> list:
+    """
+    按 conversion_threads 为命令加上显式线程数：magick 使用 -limit thread，
+    heif-enc 使用编码器线程参数；已指定 -limit thread 的命令（分片编码）保持不变。
+    magick compare 等子命令的参数放在子命令名之后。
+    """
+    threads = conversion_threads.get()
+    if threads is None:
+        return command
+    tool = os.path.basename(command[0])
+    if tool == "magick":
+        if any(command[i:i + 2] == ['-limit', 'thread'] for i in range(len(command) - 1)):
+            return command
+        head = 2 if command[1:2] in (['compare'], ['identify']) else 1
+        return command[:head] + ['-limit', 'thread', str(threads)] + command[head:]
+    if tool == "heif-enc":
+        target_format = "avif" if '--avif' in command else "heif"
+        return [command[0]] + capability_probe.heif_enc_thread_options(target_format, threads) + command[1:]
+    return command
+
+@asynccontextmanager
+async def conversion_slot(cost: float, client: str, background: bool = False):
+    """
+    经准入调度器获取转换许可，同时记录排队/执行中的数量和等待时间。
+    获准入后按当前负载设置 conversion_threads，许可内执行的命令据此限制线程数。
+
+    Raises:
+        HTTPException: 429，队列已满或等待超时（响应带 Retry-After）
+    """
+    metrics.inc("imagemagick_api_conversions_queued", 1)
+    report_progress("waiting_for_slot", 0.0)
+    wait_started = time.monotonic()
+    try:
+        ticket = await conversion_broker.acquire(cost, client, background)
+        if ticket is None:
+            ticket = await admission_scheduler.acquire(cost, client, background)
+            ticket["threads"] = plan_job_threads(
+                admission_scheduler.running_jobs + admission_scheduler.fast_lane_running, admission_scheduler.queued
+            )
+    finally:
+        metrics.inc("imagemagick_api_conversions_queued", -1)
+    report_progress("converting", 0.0)
+    metrics.observe("imagemagick_api_semaphore_wait_seconds", time.monotonic() - wait_started, **metric_labels.get())
+    trace_step("queue", time.monotonic() - wait_started)
+    metrics.inc("imagemagick_api_conversions_in_flight", 1)
+    conversion_threads.set(ticket["threads"])
+    try:
+        yield ticket
+    finally:
+        # 不使用 reset(token)：流式响应中许可可能在另一个任务（上下文副本）里释放
+        conversion_threads.set(None)
+        metrics.inc("imagemagick_api_conversions_in_flight", -1)
+        if ticket["lane"] == "broker":
+            conversion_broker.release(ticket)
+        else:
+            admission_scheduler.release(ticket)
+
+
+class ConversionBroker:
+    """
+    跨 worker 的转换准入代理。
+
+    `python3 main.py --broker`（entrypoint.sh 在 uvicorn 之前启动）在 BROKER_SOCKET
+    上监听，持有一个按整机规划的 AdmissionScheduler：并发数为 BROKER_MAX_CONVERSIONS
+    （默认 worker 数 × 每 worker 并发数），排队上限与快速槽位按 worker 数放大，
+    线程数按整机 CPU 分配。因此一个 worker 空闲时，其余 worker 可以用满全部槽位。
+
+    协议为单行 JSON：worker 为每次转换建立一个连接并发送 {"cost", "client",
+    "background"}，代理获准入后回复 {"status": 200, "threads"}，拒绝时回复
+    {"status": 429, "retry_after", "reason"}。许可随连接存在，worker 关闭连接即
+    归还；worker 崩溃或客户端断开时连接随之关闭，不会泄漏许可。编码子进程仍由
+    worker 启动与监管（见 3e 节），代理只负责全局调度。
+
+    worker 侧连不上代理（未启动、已退出或 CONVERSION_BROKER=off）时 acquire()
+    返回 None，由调用方退回 worker 内的调度器；每次申请都会重新尝试连接。
+    """
+
+    def __init__(self, socket_path: str, enabled: bool):
+        self.socket_path = socket_path
+        self.enabled = enabled
+        self.connected: Optional[bool] = None
+        self.scheduler: Optional[AdmissionScheduler] = None
+
+    # --- worker 侧 ---
+
+    def _set_connected(self, connected: bool, error: Optional[Exception] = None) -> None:
+        if connected != self.connected:
+            if connected:
+                logger.info("已连接转换代理 %s，使用全局准入调度", self.socket_path)
+            elif self.connected is not None:
+                logger.warning("转换代理不可用 (%s)，退回 worker 内调度", error)
+        self.connected = connected
+
+    async def acquire(self, cost: float, client: str, background: bool = False) -> Optional[dict]:
+        """
+        向代理申请转换许可，返回需交给 release() 的凭据；代理不可用时返回 None。
+
+        Raises:
+            HTTPException: 429，代理的全局队列已满或等待超时（响应带 Retry-After）
+        """
+        if not self.enabled:
+            return None
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        except OSError as exc:
+            self._set_connected(False, exc)
+            return None
+        try:
+            writer.write(json.dumps({"cost": cost, "client": client, "background": background}).encode() + b"\n")
+            await writer.drain()
+            line = await reader.readline()
+            reply = json.loads(line) if line else None
+        except (OSError, ValueError) as exc:
+            writer.close()
+            self._set_connected(False, exc)
+            return None
+        except asyncio.CancelledError:
+            # 客户端断开：关闭连接即从代理的队列移除或归还许可
+            writer.close()
+            raise
+        if reply is None:
+            writer.close()
+            self._set_connected(False, ConnectionResetError("connection closed by broker"))
+            return None
+        self._set_connected(True)
+        if reply["status"] != 200:
+            writer.close()
+            metrics.inc("imagemagick_api_admission_rejected_total", reason=reply.get("reason", "broker"))
+            raise HTTPException(
+                status_code=429,
+                detail="Server is busy. Please retry later.",
+                headers={"Retry-After": str(reply.get("retry_after", 1))}
+            )
+        return {"lane": "broker", "threads": reply.get("threads"), "writer": writer}
+
+    def release(self, ticket: dict) -> None:
+        """关闭许可对应的连接，代理随即归还槽位。"""
+        ticket["writer"].close()
+
+    def report(self) -> dict:
+        return {
+            "mode": CONVERSION_BROKER,
+            "socket": self.socket_path,
+            "connected": self.connected,
+        }
+
+    # --- 代理进程侧 ---
+
+    @staticmethod
+    async def _wait_closed(reader: asyncio.StreamReader) -> None:
+        try:
+            await reader.read()
+        except OSError:
+            pass
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        closed = None
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                cost = float(request["cost"])
+                client = str(request["client"])
+                background = bool(request.get("background"))
+            except (OSError, ValueError, TypeError, KeyError):
+                return
+            queue_full = not background and self.scheduler.queued >= self.scheduler.max_queue
+            acquiring = asyncio.create_task(self.scheduler.acquire(cost, client, background))
+            closed = asyncio.create_task(self._wait_closed(reader))
+            await asyncio.wait({acquiring, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if not acquiring.done():
+                # worker 在排队期间断开：取消排队（acquire 会把自己移出队列）
+                acquiring.cancel()
+                try:
+                    await acquiring
+                except (asyncio.CancelledError, HTTPException):
+                    pass
+                return
+            try:
+                ticket = acquiring.result()
+            except HTTPException as exc:
+                writer.write(json.dumps({
+                    "status": exc.status_code,
+                    "retry_after": int(exc.headers["Retry-After"]),
+                    "reason": "queue_full" if queue_full else "wait_timeout",
+                }).encode() + b"\n")
+                return
+            try:
+                threads = plan_job_threads(
+                    self.scheduler.running_jobs + self.scheduler.fast_lane_running,
+                    self.scheduler.queued,
+                    RESOURCE_PLAN["cpus"]
+                )
+                writer.write(json.dumps({"status": 200, "threads": threads}).encode() + b"\n")
+                await closed
+            finally:
+                self.scheduler.release(ticket)
+        finally:
+            if closed is not None and not closed.done():
+                closed.cancel()
+            writer.close()
+
+    async def serve(self) -> None:
+        """代理进程主循环：独占 BROKER_SOCKET 并处理各 worker 的许可申请，直到进程被终止。"""
+        max_jobs = BROKER_MAX_CONVERSIONS or RESOURCE_PLAN["workers"] * MAX_CONCURRENT_CONVERSIONS
+        workers = RESOURCE_PLAN["workers"]
+        self.scheduler = AdmissionScheduler(
+            max_jobs=max_jobs,
+            budget=max_jobs * ADMISSION_SLOT_COST,
+            fast_lane_cost=ADMISSION_FAST_LANE_COST,
+            fast_lane_slots=FAST_LANE_RESERVED_SLOTS * workers,
+            max_queue=ADMISSION_MAX_QUEUE * workers,
+            max_wait=ADMISSION_MAX_WAIT_SECONDS,
+        )
+        # 同一 TEMP_DIR 只允许一个代理：持有锁文件后才替换遗留的 socket
+        lock_file = open(f"{self.socket_path}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.error("转换代理已在运行 (%s)", self.socket_path)
+            lock_file.close()
+            return
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        # 绑定时即只允许属主连接：先 bind 再 chmod 会留下一个任意本地用户都能连接、
+        # 占用准入许可的窗口。代理进程此时没有其他线程，临时修改 umask 是安全的
+        previous_umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        finally:
+            os.umask(previous_umask)
+        logger.info(
+            "转换代理已启动: %s，全局最多 %d 个并发转换，%.2f CPU",
+            self.socket_path, max_jobs, RESOURCE_PLAN["cpus"]
+        )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            lock_file.close()
+
+
+conversion_broker = ConversionBroker(BROKER_SOCKET, enabled=CONVERSION_BROKER != "off")
+
+# --- 3d. 会话暂存区 ---
+
+STAGING_RAM_PREFIX = "imagemagick-api-"
+STAGING_RAM_FACTOR = 4  # 内存暂存按上传大小的倍数预留（输入、输出与中间文件）
+# 会话目录名：<属主 PID>-<uuid>；旧版本创建的目录只有 <uuid>
+STAGING_NAME_PATTERN = re.compile(r"^(?:(\d+)-)?[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def directory_size(path: str) -> int:
+    """递归统计目录中文件的总字节数（统计期间被删除的文件忽略）。"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+    return total
+
+def process_start_time(pid: int) -> Optional[float]:
+    """读取 /proc 得到进程的启动时间（Unix 时间戳），无法读取时返回 None。"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm 字段可能含空格，从最后一个右括号之后开始切分；starttime 是第 22 个字段
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError, StopIteration):
+        return None
+
+
+class StagingManager:
+    """
+    会话目录（上传输入、转换输出与中间文件）的分配与孤儿清理。
+
+    - 预估大小放得进内存预算的会话放在 ram_dir（tmpfs），其余落在磁盘 disk_dir；
+      预算按 worker 数平分、在进程内按预估字节数预留，并以 tmpfs 实际剩余空间兜底
+    - 目录名以属主 worker 的 PID 开头。启动时及之后定期清理属主已退出（或 PID 已
+      被复用）的目录，以及本 worker 遗留、已不在登记表中的目录；旧版本命名的目录
+      长时间未修改后清理。只处理符合命名规则的目录，TEMP_DIR 下的隐藏目录
+      （转换缓存、指标、任务、源图存储）不受影响
+    """
+
+    def __init__(self, disk_dir: str, ram_dir: str, ram_budget_bytes: int, sweep_seconds: int):
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        self.ram_budget_bytes = ram_budget_bytes
+        self.sweep_seconds = sweep_seconds
+        self.sessions: dict = {}  # 目录 -> 预留的内存字节数（磁盘目录为 0）
+        self.ram_reserved = 0
+        self.counters = {"ram_sessions": 0, "disk_sessions": 0, "spilled": 0}
+        self.sweeps = {"runs": 0, "dirs": 0, "bytes": 0, "last_at": None}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @property
+    def worker_ram_budget(self) -> int:
+        return self.ram_budget_bytes // max(1, RESOURCE_PLAN["workers"])
+
+    def _ram_free(self) -> int:
+        try:
+            if not os.access(self.ram_dir, os.W_OK):
+                return 0
+            stats = os.statvfs(self.ram_dir)
+        except OSError:
+            return 0
+        return stats.f_bavail * stats.f_frsize
+
+    def _reserve_ram(self, estimated_bytes: int) -> bool:
+        """在本 worker 的内存预算内预留空间；tmpfs 剩余空间须不少于预估的两倍。"""
+        if estimated_bytes <= 0 or self.ram_budget_bytes <= 0:
+            return False
+        with self._lock:
+            if self.ram_reserved + estimated_bytes > self.worker_ram_budget:
+                return False
+            if self._ram_free() < estimated_bytes * 2:
+                return False
+            self.ram_reserved += estimated_bytes
+        return True
+
+    def _register(self, path: str, reserved: int) -> str:
+        with self._lock:
+            self.sessions[path] = reserved
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            self.release(path)
+            raise
+        return path
+
+    def create(self, estimated_bytes: int = 0) -> str:
+        """
+        创建会话目录并登记到本 worker。
+
+        estimated_bytes 为 0（大小未知）或超出剩余内存预算时放在磁盘上。
+        """
+        name = f"{os.getpid()}-{uuid.uuid4()}"
+        if self._reserve_ram(estimated_bytes):
+            self.counters["ram_sessions"] += 1
+            return self._register(os.path.join(self.ram_dir, STAGING_RAM_PREFIX + name), estimated_bytes)
+        self.counters["disk_sessions"] += 1
+        if estimated_bytes > 0:
+            self.counters["spilled"] += 1
+        return self._register(os.path.join(self.disk_dir, name), 0)
+
+    def create_scratch(self, session_dir: str, estimated_bytes: int) -> str:
+        """为中间文件申请内存目录；预算不足时直接使用会话目录。"""
+        if not self._reserve_ram(estimated_bytes):
+            return session_dir
+        name = f"{os.getpid()}-{uuid.uuid4()}"
+        return self._register(os.path.join(self.ram_dir, STAGING_RAM_PREFIX + name), estimated_bytes)
+
+    def release(self, path: str) -> None:
+        """注销目录并归还其内存预留（目录本身由调用方删除）。"""
+        with self._lock:
+            self.ram_reserved -= self.sessions.pop(path, 0)
+
+    def _is_orphan(self, path: str, name: str, stat: os.stat_result, now: float) -> bool:
+        match = STAGING_NAME_PATTERN.match(name)
+        if match is None:
+            return False
+        if match.group(1) is None:
+            # 旧版本命名无法判断属主：超过最长转换时间仍未修改即视为遗留
+            return now - stat.st_mtime > TIMEOUT_SECONDS * 2
+        pid = int(match.group(1))
+        if pid == os.getpid():
+            with self._lock:
+                return path not in self.sessions
+        if not MetricsRegistry._pid_alive(pid):
+            return True
+        # PID 被复用：当前进程在目录最后一次修改之后才启动
+        started = process_start_time(pid)
+        return started is not None and started > stat.st_ctime
+
+    def sweep(self) -> int:
+        """删除无人持有的会话目录，返回本次清理的目录数。"""
+        now = time.time()
+        swept = 0
+        for base, prefix in ((self.disk_dir, ""), (self.ram_dir, STAGING_RAM_PREFIX)):
+            try:
+                entries = list(os.scandir(base))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.name.startswith(prefix):
+                    continue
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if not self._is_orphan(entry.path, entry.name[len(prefix):], stat, now):
+                    continue
+                size = directory_size(entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                swept += 1
+                self.sweeps["bytes"] += size
+                logger.info("已清理遗留会话目录: %s (%.2f MB)", entry.path, size / (1024 * 1024))
+        self.sweeps["runs"] += 1
+        self.sweeps["dirs"] += swept
+        self.sweeps["last_at"] = time.time()
+        return swept
+
+    def report(self) -> dict:
+        """本 worker 的暂存区使用情况与清理计数（/health 使用）。"""
+        with self._lock:
+            ram_sessions = sum(1 for reserved in self.sessions.values() if reserved > 0)
+            disk_sessions = len(self.sessions) - ram_sessions
+            ram_reserved = self.ram_reserved
+        last_at = self.sweeps["last_at"]
+        return {
+            "ram_dir": self.ram_dir,
+            "ram_budget_mb": round(self.ram_budget_bytes / (1024 * 1024), 2),
+            "worker_ram_budget_mb": round(self.worker_ram_budget / (1024 * 1024), 2),
+            "ram_reserved_mb": round(ram_reserved / (1024 * 1024), 2),
+            "ram_free_mb": round(self._ram_free() / (1024 * 1024), 2),
+            "active_dirs": {"ram": ram_sessions, "disk": disk_sessions},
+            "sessions_total": dict(self.counters),
+            "sweeps": {
+                "runs": self.sweeps["runs"],
+                "dirs": self.sweeps["dirs"],
+                "mb": round(self.sweeps["bytes"] / (1024 * 1024), 2),
+                "last_seconds_ago": round(time.time() - last_at, 1) if last_at is not None else None,
+            },
+        }
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as exc:
+                logger.warning("清理遗留会话目录失败: %s", exc)
+            if self.sweep_seconds <= 0:
+                return
+            await asyncio.sleep(self.sweep_seconds)
+
+    async def start(self) -> None:
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+
+staging_area = StagingManager(TEMP_DIR, SCRATCH_RAM_DIR, STAGING_RAM_MAX_MB * 1024 * 1024, STAGING_SWEEP_SECONDS)
+
+# --- 3e. 子进程监管 ---
+
+PROCESS_TERM_GRACE_SECONDS = 2.0  # SIGTERM 后等待进程组退出的时间，超时改发 SIGKILL
+CLIENT_CLOSED_REQUEST = 499  # 客户端在响应前断开（沿用 nginx 的约定）
+# magick 地址空间上限在 -limit memory 与 MAGICK_MAP_LIMIT 之外的余量（代码、线程栈、malloc arena）
+PROCESS_ADDRESS_SPACE_HEADROOM = 2 * 1024 ** 3
+
+def process_rlimits(command: list) -> dict:
+    """
+    为一条命令计算启动后立即设置的 rlimit：{资源: 上限}。
+
+    - RLIMIT_AS（仅 magick）：命令中的 -limit memory（没有时取 MAGICK_MEMORY_LIMIT）
+      + MAGICK_MAP_LIMIT + 余量；ImageMagick 超出 -limit memory 后改用映射/磁盘缓存，
+      地址空间上限只拦截失控的进程
+    - RLIMIT_CPU：TIMEOUT_SECONDS × 分配的线程数，占满多核的进程在超时前也会被终止
+    - RLIMIT_FSIZE：MAGICK_DISK_LIMIT（磁盘像素缓存的上限）
+    - RLIMIT_CORE：0，崩溃时不在会话目录写 core 文件
+
+    PROCESS_RLIMITS=off 时返回空字典。
+    """
+    if PROCESS_RLIMITS != "on":
+        return {}
+    limits = {resource.RLIMIT_CORE: 0}
+    if os.path.basename(command[0]) == "magick":
+        memory = parse_byte_size(MAGICK_MEMORY_LIMIT)
+        for index in range(len(command) - 2):
+            if command[index] == "-limit" and command[index + 1] == "memory":
+                memory = int(command[index + 2])
+        map_limit = parse_byte_size(MAGICK_MAP_LIMIT)
+        if memory and map_limit:
+            limits[resource.RLIMIT_AS] = memory + map_limit + PROCESS_ADDRESS_SPACE_HEADROOM
+    threads = conversion_threads.get() or RESOURCE_PLAN["max_threads"] or os.cpu_count() or 1
+    limits[resource.RLIMIT_CPU] = int(TIMEOUT_SECONDS * threads) + 1
+    disk_limit = parse_byte_size(MAGICK_DISK_LIMIT)
+    if disk_limit:
+        limits[resource.RLIMIT_FSIZE] = disk_limit
+    return limits
+
+
+class SupervisedProcess:
+    """
+    受监管的编码子进程。
+
+    - 在独立的会话/进程组中运行，启动后立即按 process_rlimits() 设置资源上限
+      （不超过继承来的硬限制）
+    - terminate() 先向整个进程组发送 SIGTERM，PROCESS_TERM_GRACE_SECONDS 内未退出再
+      SIGKILL；主进程退出后（回收前 PID 仍被占用）总是 SIGKILL 整个组，清理委托程序
+    - 由本对象经 wait4 回收（pidfd 可读时，旧内核在线程中等待），记录 CPU 时间与
+      峰值 RSS 到 usage 和指标
+    """
+
+    def __init__(self, command: list):
+        self.command = command
+        self.tool = os.path.basename(command[0])
+        self.pid: Optional[int] = None
+        self.returncode: Optional[int] = None
+        self.usage: Optional[dict] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.stdout: Optional[asyncio.StreamReader] = None
+        self.stderr: Optional[asyncio.StreamReader] = None
+        self._popen: Optional[subprocess.Popen] = None
+        self._exited: Optional[asyncio.Future] = None
+        self._terminated = False
+
+    async def start(self, input_data: Optional[bytes] = None, capture_stdout: bool = False) -> None:
+        """
+        启动进程；input_data 不为 None 时写入 stdin 后关闭。
+
+        Raises:
+            OSError: 可执行文件不存在或无法启动
+        """
+        loop = asyncio.get_running_loop()
+        self._popen = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self.pid = self._popen.pid
+        self.started_at = time.monotonic()
+        self._exited = loop.create_future()
+        trace = conversion_trace.get()
+        if trace is not None:
+            trace.add_process(self)
+        try:
+            # 先登记回收，之后任何一步失败时子进程都经正常路径被回收
+            self._watch_exit(loop)
+            for limit, value in process_rlimits(self.command).items():
+                # 只能收紧继承来的限制：非 root 进程提高硬限制会得到 EPERM
+                _, hard = resource.prlimit(self.pid, limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.prlimit(self.pid, limit, (value, value))
+            self.stderr = await self._connect_reader(loop, self._popen.stderr)
+            if capture_stdout:
+                self.stdout = await self._connect_reader(loop, self._popen.stdout)
+            if input_data is not None:
+                # 写管道由事件循环异步写完后关闭；进程提前退出时的 EPIPE 由返回码报告
+                transport, _ = await loop.connect_write_pipe(asyncio.Protocol, self._popen.stdin)
+                transport.write(input_data)
+                transport.close()
+        except BaseException:
+            self._signal_group(signal.SIGKILL)
+            raise
+
+    @staticmethod
+    async def _connect_reader(loop, pipe) -> asyncio.StreamReader:
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    def _watch_exit(self, loop) -> None:
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            def wait_blocking():
+                os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+                return self._reap()
+
+            def on_done(future):
+                if future.exception() is not None:
+                    logger.error("回收子进程失败: %s pid=%d (%s)", self.tool, self.pid, future.exception())
+                    self._exited.set_exception(future.exception())
+                    return
+                self._on_reaped(*future.result())
+
+            loop.run_in_executor(None, wait_blocking).add_done_callback(on_done)
+            return
+
+        def on_exit():
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            self._on_reaped(*self._reap())
+
+        loop.add_reader(pidfd, on_exit)
+
+    def _reap(self) -> tuple:
+        # 主进程已退出但尚未回收，进程组 ID 不会被复用：此时清理组内残留进程是安全的
+        self._signal_group(signal.SIGKILL)
+        _, status, usage = os.wait4(self.pid, 0)
+        return status, usage
+
+    def _on_reaped(self, status: int, usage) -> None:
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.finished_at = time.monotonic()
+        self._popen.returncode = self.returncode  # 已回收，Popen 不再 waitpid
+        self.usage = {
+            "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+            "user_seconds": round(usage.ru_utime, 3),
+            "system_seconds": round(usage.ru_stime, 3),
+            "peak_rss_bytes": usage.ru_maxrss * 1024,
+        }
+        outcome = "terminated" if self._terminated else ("ok" if self.returncode == 0 else "failed")
+        metrics.inc("imagemagick_api_processes_total", 1, tool=self.tool, outcome=outcome)
+        metrics.inc("imagemagick_api_process_cpu_seconds_total", self.usage["cpu_seconds"], tool=self.tool)
+        metrics.inc("imagemagick_api_process_peak_rss_bytes_total", self.usage["peak_rss_bytes"], tool=self.tool)
+        logger.info(
+            "子进程结束: %s pid=%d 返回码=%d CPU=%.2fs 峰值RSS=%.1fMB",
+            self.tool, self.pid, self.returncode, self.usage["cpu_seconds"],
+            self.usage["peak_rss_bytes"] / (1024 * 1024)
+        )
+        self._exited.set_result(self.returncode)
+
+    def _signal_group(self, sig: int) -> None:
+        try:
+            os.killpg(self.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def wait(self) -> int:
+        """等待进程结束并被回收，返回返回码（被信号终止时为负数）。"""
+        return await asyncio.shield(self._exited)
+
+    async def communicate(self) -> bytes:
+        """等待进程结束，返回 stderr 的全部内容。"""
+        stderr = await self.stderr.read()
+        await self.wait()
+        return stderr
+
+    async def terminate(self) -> None:
+        """结束整个进程组并等待回收（先 SIGTERM，宽限期后 SIGKILL）。"""
+        if self.returncode is not None:
+            return
+        self._terminated = True
+        self._signal_group(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.wait(), timeout=PROCESS_TERM_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("子进程未响应 SIGTERM，发送 SIGKILL: %s pid=%d", self.tool, self.pid)
+            self._signal_group(signal.SIGKILL)
+            await self.wait()
+        except asyncio.CancelledError:
+            self._signal_group(signal.SIGKILL)
+            raise
+
+# --- 3f. 请求级性能追踪 ---
+
+# 编码设置中的目录部分（会话目录、暂存目录）不输出，只保留文件名
+TRACE_PATH_PATTERN = re.compile(r"(?<![\w.])/(?:[^/\s]+/)+")
+TRACE_SETTINGS_MAX_CHARS = 2048
+
+
+class ConversionTrace:
+    """
+    单个请求的阶段耗时与子进程资源占用，输出为 Server-Timing 与 X-Conversion-Stats 响应头。
+
+    由 cancel_on_disconnect() 按 trace_requested() 创建并放入 conversion_trace；
+    转换任务与其子任务继承同一个对象，各环节直接向其追加记录：
+    record_upload_metrics() 记录接收与校验耗时和输入尺寸，conversion_slot() 累加
+    排队时间，SupervisedProcess 登记每个编码子进程，Pillow 引擎登记一次步骤。
+    未启用时 conversion_trace 为 None，各环节只多一次 ContextVar 读取。
+
+    响应头在响应体发送之前确定，因此不包含发送耗时；管道模式的流式响应在
+    子进程结束前发出响应头，此时子进程的耗时为截至首个输出块的时间，
+    CPU 与峰值 RSS 不计入。
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.steps: OrderedDict = OrderedDict()  # 名称 -> 秒
+        self.processes: list = []
+        self.settings: list = []
+        self.image: Optional[dict] = None
+
+    def add_step(self, name: str, seconds: float, settings: Optional[str] = None) -> None:
+        """累加一个阶段的耗时（同名阶段合并，如多次排队）。"""
+        self.steps[name] = self.steps.get(name, 0.0) + seconds
+        if settings is not None and settings not in self.settings:
+            self.settings.append(settings)
+
+    def add_process(self, process) -> None:
+        """登记一个已启动的编码子进程（SupervisedProcess），结束后读取其耗时与 rusage。"""
+        self.processes.append(process)
+        settings = TRACE_PATH_PATTERN.sub("", " ".join(process.command))
+        if settings not in self.settings:
+            self.settings.append(settings)
+
+    def record_upload(self, upload: dict) -> None:
+        self.started_at = min(self.started_at, upload["started_at"])
+        self.steps["receive"] = upload["upload_seconds"]
+        self.steps["validate"] = upload["validation_seconds"]
+        self.image = upload["image"]
+
+    def server_timing(self) -> str:
+        now = time.monotonic()
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.steps.items()]
+        for index, process in enumerate(self.processes, start=1):
+            finished_at = process.finished_at if process.finished_at is not None else now
+            entry = f"{process.tool}-{index};dur={(finished_at - process.started_at) * 1000:.1f}"
+            if process.returncode is None:
+                entry += ';desc="running"'
+            entries.append(entry)
+        entries.append(f"total;dur={(now - self.started_at) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def stats(self, output: Optional[dict]) -> str:
+        usages = [process.usage for process in self.processes if process.usage is not None]
+        items = [
+            f"cpu_user={sum(usage['user_seconds'] for usage in usages):.3f}",
+            f"cpu_sys={sum(usage['system_seconds'] for usage in usages):.3f}",
+            f"peak_rss={max((usage['peak_rss_bytes'] for usage in usages), default=0)}",
+            f"processes={len(self.processes)}",
+        ]
+        for prefix, image in (("input", self.image), ("output", output)):
+            if image is not None and image["width"] and image["height"]:
+                items.append(f"{prefix}_pixels={image['width'] * image['height']}")
+                items.append(f"{prefix}_frames={image['frames']}")
+        settings = "; ".join(self.settings)
+        if len(settings) > TRACE_SETTINGS_MAX_CHARS:
+            settings = settings[:TRACE_SETTINGS_MAX_CHARS] + "..."
+        items.append('settings="{}"'.format(settings.replace("\\", "\\\\").replace('"', '\\"')))
+        return ", ".join(items)
+
+    async def apply(self, response: Response) -> None:
+        """为转换响应加上追踪头；输出尺寸与帧数只解析文件头（流式响应不解析）。"""
+        output = None
+        try:
+            if isinstance(response, FileResponse):
+                output = await asyncio.to_thread(inspect_image, response.path)
+            elif not isinstance(response, StreamingResponse):
+                output = inspect_image_stream(io.BytesIO(response.body))
+        except (OSError, ValueError):
+            output = None
+        response.headers["Server-Timing"] = self.server_timing()
+        response.headers["X-Conversion-Stats"] = self.stats(output)
+
+
+# 当前请求的性能追踪；未启用时为 None
+conversion_trace: ContextVar[Optional[ConversionTrace]] = ContextVar("conversion_trace", default=None)
+
+def trace_requested(request: Request) -> bool:
+    """按 CONVERSION_TRACE 与 X-Conversion-Trace 请求头决定是否追踪本次请求。"""
+    if CONVERSION_TRACE == "on":
+        return True
+    if CONVERSION_TRACE == "header":
+        return request.headers.get("x-conversion-trace", "").lower() in ["1", "true", "on", "yes"]
+    return False
+
+def trace_step(name: str, seconds: float, settings: Optional[str] = None) -> None:
+    """向当前请求的追踪记录一个阶段；未启用追踪时不做任何事。"""
+    trace = conversion_trace.get()
+    if trace is not None:
+        trace.add_step(name, seconds, settings)
+
+# --- 4. 辅助函数 ---
+
+MPC_SIGNATURE = b"id=MagickCache"
+
+def detect_image_format(header: bytes) -> Optional[str]:
+    """
+    按魔数识别图像格式（替代已弃用的 imghdr）。
+
+    imghdr 只认 JFIF/Exif 开头的 JPEG，会误拒以 Adobe APP14 等段开头的
+    合法 JPEG（常见于 CMYK 文件）；这里只检查 SOI 与下一个标记。
+
+    "mpc" 是源图存储生成的 ImageMagick 像素缓存（见 SourceStore），不接受上传。
+
+    Returns:
+        "jpeg"、"png"、"gif"、"webp"、"bmp"、"tiff"、"avif"、"heif"、"mpc" 或 None
+    """
+    if header[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:2] == b"BM":
+        return "bmp"
+    if header[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+        return "tiff"
+    if header[4:8] == b"ftyp":
+        brand = header[8:12]
+        if brand in (b"avif", b"avis"):
+            return "avif"
+        if brand in (b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1"):
+            return "heif"
+    if header.startswith(MPC_SIGNATURE):
+        return "mpc"
+    return None
+
+def _inspect_jpeg(f) -> Optional[dict]:
+    """读取第一个 SOF 段：精度、高、宽与颜色分量数（1=灰度，3=YCbCr，4=CMYK）。"""
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        while marker[1] == 0xFF:  # 填充字节
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        if marker[1] in (0xD9, 0xDA):  # 在 SOF 之前遇到 EOI/SOS
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            segment = f.read(6)
+            if len(segment) < 6:
+                return None
+            return {
+                "width": int.from_bytes(segment[3:5], "big"),
+                "height": int.from_bytes(segment[1:3], "big"),
+                "frames": 1,
+                "bit_depth": segment[0],
+                "channels": segment[5],
+            }
+        f.seek(int.from_bytes(length_bytes, "big") - 2, 1)
+
+def _inspect_png(f) -> Optional[dict]:
+    """读取 IHDR 与 acTL（APNG 帧数，存在即为动图），遇到 IDAT 即停止。"""
+    f.seek(8)
+    info = None
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            break
+        size, kind = int.from_bytes(chunk_header[:4], "big"), chunk_header[4:]
+        if kind == b"IHDR":
+            payload = f.read(10)
+            if len(payload) < 10:
+                return None
+            info = {
+                "width": int.from_bytes(payload[:4], "big"),
+                "height": int.from_bytes(payload[4:8], "big"),
+                "frames": 1,
+                "bit_depth": payload[8],
+                "channels": {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(payload[9]),
+            }
+            f.seek(size - 10 + 4, 1)
+            continue
+        if kind == b"acTL" and info is not None:
+            info["frames"] = max(1, int.from_bytes(f.read(4), "big"))
+            info["animated"] = True
+            f.seek(size - 4 + 4, 1)
+            continue
+        if kind in (b"IDAT", b"IEND"):
+            break
+        f.seek(size + 4, 1)
+    return info
+
+def _inspect_gif(f) -> Optional[dict]:
+    """读取逻辑屏幕尺寸，并跳过数据子块统计图像描述符（帧）数量。"""
+    f.seek(6)
+    screen = f.read(7)
+    if len(screen) < 7:
+        return None
+    width, height = int.from_bytes(screen[:2], "little"), int.from_bytes(screen[2:4], "little")
+    flags = screen[4]
+    if flags & 0x80:
+        f.seek(3 * (2 << (flags & 0x07)), 1)
+    frames = 0
+    while True:
+        block = f.read(1)
+        if not block or block == b"\x3b":
+            break
+        if block == b"\x2c":
+            frames += 1
+            descriptor = f.read(9)
+            if len(descriptor) < 9:
+                break
+            if descriptor[8] & 0x80:
+                f.seek(3 * (2 << (descriptor[8] & 0x07)), 1)
+            f.read(1)  # LZW 最小码长
+        elif block == b"\x21":
+            f.read(1)  # 扩展标签
+        else:
+            break
+        # 跳过数据子块
+        while True:
+            size = f.read(1)
+            if not size or size[0] == 0:
+                break
+            f.seek(size[0], 1)
+    return {"width": width, "height": height, "frames": frames, "bit_depth": 8, "channels": None}
+
+def _inspect_webp(f) -> Optional[dict]:
+    """读取 VP8X 画布或 VP8/VP8L 帧头中的尺寸，统计 ANMF 帧数；存在 ANIM 块即为动图。"""
+    f.seek(12)
+    width = height = 0
+    frames = 0
+    animated = False
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            break
+        fourcc, size = chunk_header[:4], int.from_bytes(chunk_header[4:], "little")
+        payload_start = f.tell()
+        if fourcc == b"VP8X":
+            payload = f.read(10)
+            width = int.from_bytes(payload[4:7], "little") + 1
+            height = int.from_bytes(payload[7:10], "little") + 1
+        elif fourcc == b"ANIM":
+            animated = True
+        elif fourcc == b"ANMF":
+            frames += 1
+        elif fourcc == b"VP8 ":
+            frames = max(frames, 1)
+            payload = f.read(10)
+            if not width and len(payload) == 10 and payload[3:6] == b"\x9d\x01\x2a":
+                width = int.from_bytes(payload[6:8], "little") & 0x3FFF
+                height = int.from_bytes(payload[8:10], "little") & 0x3FFF
+        elif fourcc == b"VP8L":
+            frames = max(frames, 1)
+            payload = f.read(5)
+            if not width and len(payload) == 5 and payload[0] == 0x2F:
+                bits = int.from_bytes(payload[1:5], "little")
+                width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        f.seek(payload_start + size + (size & 1))
+    return {
+        "width": width, "height": height, "frames": frames, "bit_depth": 8, "channels": None, "animated": animated,
+    }
+
+def _inspect_bmp(f) -> Optional[dict]:
+    """读取 DIB 头（BITMAPCOREHEADER 或 BITMAPINFOHEADER 及其扩展）。"""
+    f.seek(14)
+    header = f.read(16)
+    if len(header) < 12:
+        return None
+    if int.from_bytes(header[:4], "little") == 12:
+        width, height = int.from_bytes(header[4:6], "little"), int.from_bytes(header[6:8], "little")
+        bits_per_pixel = int.from_bytes(header[10:12], "little")
+    else:
+        if len(header) < 16:
+            return None
+        width = abs(int.from_bytes(header[4:8], "little", signed=True))
+        height = abs(int.from_bytes(header[8:12], "little", signed=True))  # 负值表示自上而下存储
+        bits_per_pixel = int.from_bytes(header[14:16], "little")
+    return {
+        "width": width,
+        "height": height,
+        "frames": 1,
+        "bit_depth": 16 if bits_per_pixel > 32 else 8,
+        "channels": 4 if bits_per_pixel in (32, 64) else 3,
+    }
+
+def _inspect_tiff(f) -> Optional[dict]:
+    """遍历 IFD 链（含 BigTIFF），每个 IFD 计为一页，尺寸取最大的一页。"""
+    header = f.read(16)
+    byteorder = "little" if header[:2] == b"II" else "big"
+    if int.from_bytes(header[2:4], byteorder) == 43:
+        count_size, entry_size, offset_size = 8, 20, 8
+        offset = int.from_bytes(header[8:16], byteorder)
+    else:
+        count_size, entry_size, offset_size = 2, 12, 4
+        offset = int.from_bytes(header[4:8], byteorder)
+    type_sizes = {1: 1, 3: 2, 4: 4, 16: 8}
+    info = {"width": 0, "height": 0, "frames": 0, "bit_depth": 8, "channels": None}
+    visited = set()
+    while offset and offset not in visited and len(visited) < 10000:
+        visited.add(offset)
+        f.seek(offset)
+        count = int.from_bytes(f.read(count_size), byteorder)
+        entries = f.read(count * entry_size)
+        if len(entries) < count * entry_size:
+            break
+        tags = {}
+        for i in range(count):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag = int.from_bytes(entry[:2], byteorder)
+            value_size = type_sizes.get(int.from_bytes(entry[2:4], byteorder))
+            if tag not in (256, 257, 258, 277) or value_size is None:
+                continue
+            value_count = int.from_bytes(entry[4:4 + offset_size], byteorder)
+            field = entry[4 + offset_size:]
+            if value_count * value_size > offset_size:
+                # 值放不下时字段中存的是偏移量，只需读取第一个值
+                position = f.tell()
+                f.seek(int.from_bytes(field, byteorder))
+                field = f.read(value_size)
+                f.seek(position)
+            tags[tag] = int.from_bytes(field[:value_size], byteorder)
+        info["frames"] += 1
+        if tags.get(256, 0) * tags.get(257, 0) > info["width"] * info["height"]:
+            info["width"], info["height"] = tags[256], tags[257]
+        info["bit_depth"] = max(info["bit_depth"], tags.get(258, 8))
+        info["channels"] = info["channels"] or tags.get(277)
+        offset = int.from_bytes(f.read(offset_size), byteorder)
+    return info if info["frames"] else None
+
+def _iter_bmff_boxes(f, start: int, end: int):
+    """遍历 ISO BMFF 的一层 box，产出 (类型, 数据起点, 数据终点)。"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind, header_size = int.from_bytes(header[:4], "big"), header[4:8], 8
+        if size == 1:
+            size, header_size = int.from_bytes(f.read(8), "big"), 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield kind, offset + header_size, min(offset + size, end)
+        offset += size
+
+def _find_bmff_boxes(f, start: int, end: int, path: list):
+    """按类型路径逐层查找 box，产出所有匹配 box 的 (数据起点, 数据终点)。"""
+    for kind, box_start, box_end in _iter_bmff_boxes(f, start, end):
+        if kind != path[0]:
+            continue
+        if len(path) == 1:
+            yield box_start, box_end
+        else:
+            yield from _find_bmff_boxes(f, box_start, box_end, path[1:])
+
+def _inspect_heif(f) -> Optional[dict]:
+    """
+    读取 meta/iprp/ipco 中的 ispe（尺寸）与 pixi（位深），以及图像序列
+    moov/trak 的 stsz 样本数（帧数）。
+
+    网格图像的各个图块也带 ispe，因此取面积最大的一项（即完整画布）。
+    """
+    file_size = f.seek(0, os.SEEK_END)
+    info = {"width": 0, "height": 0, "frames": 1, "bit_depth": 8, "channels": None}
+    for meta_start, meta_end in _find_bmff_boxes(f, 0, file_size, [b"meta"]):
+        # meta 是 FullBox：跳过 version/flags
+        for ipco_start, ipco_end in _find_bmff_boxes(f, meta_start + 4, meta_end, [b"iprp", b"ipco"]):
+            for kind, start, _ in _iter_bmff_boxes(f, ipco_start, ipco_end):
+                f.seek(start + 4)
+                if kind == b"ispe":
+                    payload = f.read(8)
+                    width, height = int.from_bytes(payload[:4], "big"), int.from_bytes(payload[4:], "big")
+                    if width * height > info["width"] * info["height"]:
+                        info["width"], info["height"] = width, height
+                elif kind == b"pixi":
+                    payload = f.read(2)
+                    if len(payload) == 2:
+                        info["channels"] = payload[0]
+                        info["bit_depth"] = max(info["bit_depth"], payload[1])
+    stsz_path = [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stsz"]
+    for stsz_start, _ in _find_bmff_boxes(f, 0, file_size, stsz_path):
+        f.seek(stsz_start + 8)  # version/flags + sample_size
+        info["frames"] = max(info["frames"], int.from_bytes(f.read(4), "big"))
+    return info
+
+def _inspect_mpc(f) -> Optional[dict]:
+    """
+    解析 MPC 文本头（到换页符为止）中的 columns/rows/depth 与通道信息。
+
+    每一帧都以 id=MagickCache 开头的文本头写入 .mpc 文件（像素在配套的
+    .cache 文件中），因此按签名出现次数计算帧数。
+    """
+    header = f.read(64 * 1024).split(b"\x0c", 1)[0]
+    fields = dict(
+        token.split(b"=", 1) for token in header.split() if b"=" in token
+    )
+    if b"columns" not in fields or b"rows" not in fields:
+        # 截断或非 MPC 的 id=ImageMagick 文本头：按无法识别处理
+        return None
+    info = {
+        "width": int(fields[b"columns"]),
+        "height": int(fields[b"rows"]),
+        "frames": 0,
+        "bit_depth": int(fields.get(b"depth", b"8")),
+        "channels": None,
+    }
+    if b"number-channels" in fields:
+        info["channels"] = int(fields[b"number-channels"])
+    f.seek(0)
+    tail = b""
+    while True:
+        chunk = f.read(1024 * 1024)
+        if not chunk:
+            break
+        block = tail + chunk
+        info["frames"] += block.count(MPC_SIGNATURE)
+        # 保留不足一个签名长度的尾部，跨块的签名不会被重复计数
+        tail = block[-(len(MPC_SIGNATURE) - 1):]
+    info["frames"] = max(1, info["frames"])
+    return info
+
+IMAGE_INSPECTORS = {
+    "jpeg": _inspect_jpeg,
+    "png": _inspect_png,
+    "gif": _inspect_gif,
+    "webp": _inspect_webp,
+    "bmp": _inspect_bmp,
+    "tiff": _inspect_tiff,
+    "avif": _inspect_heif,
+    "heif": _inspect_heif,
+    "mpc": _inspect_mpc,
+}
+
+def inspect_image_stream(f) -> Optional[dict]:
+    """对已打开的二进制文件对象（含 io.BytesIO）执行 inspect_image() 的解析。"""
+    try:
+        image_format = detect_image_format(f.read(16))
+        if image_format is None:
+            return None
+        f.seek(0)
+        info = IMAGE_INSPECTORS[image_format](f)
+    except (OSError, IndexError, ValueError):
+        return None
+    if info is None:
+        return None
+    info["format"] = image_format
+    info.setdefault("animated", info["frames"] > 1)
+    return info
+
+@functools.lru_cache(maxsize=256)
+def _inspect_image_cached(path: str, size: int, mtime_ns: int) -> Optional[dict]:
+    try:
+        with open(path, "rb") as f:
+            return inspect_image_stream(f)
+    except OSError:
+        return None
+
+def inspect_image(path: str) -> Optional[dict]:
+    """
+    只解析文件头/容器结构，返回尺寸、帧数、位深与是否为动图，不解码像素。
+
+    支持 JPEG、PNG/APNG、GIF、WebP、BMP、TIFF、HEIF/AVIF。结果按
+    (路径, 大小, 修改时间) 缓存，同一请求中的多次调用只读一次文件头。
+
+    Returns:
+        {"format", "width", "height", "frames", "bit_depth", "channels", "animated"}，
+        无法识别或解析时返回 None；channels 未知时为 None
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    info = _inspect_image_cached(path, stat.st_size, stat.st_mtime_ns)
+    return dict(info) if info is not None else None
+
+def validate_image_header(file_header: bytes) -> bool:
+    """
+    验证文件头是否属于受支持的图像格式（魔数检测）。
+
+    此函数通过检查文件头部的魔数（magic bytes）来验证文件的真实类型，
+    防止恶意文件通过修改扩展名绕过验证。流式接收时在第一个数据块上调用，
+    非图像文件无需完整上传即可被拒绝。
+
+    Args:
+        file_header: 文件开头的至少 32 个字节（文件更短时为全部内容）。
+
+    Returns:
+        True 如果文件是有效的图像，False 否则。
+    """
+    return detect_image_format(file_header) not in (None, "mpc")
+
+def check_pixel_limit(image: Optional[dict]) -> None:
+    """
+    在启动任何子进程之前拒绝解压炸弹：单帧像素数超过 MAX_INPUT_MEGAPIXELS 时返回 400。
+
+    文件头无法解析时放行，由 ImageMagick 自身的资源限制兜底。
+    """
+    if image is None or MAX_INPUT_MEGAPIXELS <= 0:
+        return
+    megapixels = image["width"] * image["height"] / 1_000_000
+    if megapixels > MAX_INPUT_MEGAPIXELS:
+        logger.warning(f"图像像素数超限: {image['width']}x{image['height']} ({megapixels:.1f} MP)")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Image dimensions too large: {image['width']}x{image['height']} "
+                   f"({megapixels:.1f} MP). Max is {MAX_INPUT_MEGAPIXELS:g} MP."
+        )
+
+def cleanup_temp_dir(temp_dir: str):
+    """
+    在后台任务中安全地清理临时会话目录。
+    (继承自 ocrmypdf-hfs 实践)
+
+    Args:
+        temp_dir: 要递归删除的目录路径（内存模式的上传为 None）。
+    """
+    if temp_dir:
+        staging_area.release(temp_dir)
+    try:
+        if temp_dir and os.path.exists(temp_dir):
+            logger.info(f"后台清理：正在删除临时目录: {temp_dir}")
+            shutil.rmtree(temp_dir)
+            logger.info(f"后台清理：已成功删除 {temp_dir}")
+    except Exception as cleanup_error:
+        logger.error(f"后台清理：删除 {temp_dir} 失败: {cleanup_error}", exc_info=True)
+
+def create_session_dir(estimated_bytes: int = 0) -> str:
+    """
+    创建唯一的临时会话目录并返回其路径。
+
+    estimated_bytes 为会话预计占用的字节数：放得进内存暂存预算时目录位于
+    SCRATCH_RAM_DIR，否则（包括大小未知时）位于 TEMP_DIR，见 StagingManager。
+    """
+    return staging_area.create(estimated_bytes)
+
+async def receive_upload(request: Request, memory_limit: int = 0, ram_staging: bool = True) -> dict:
+    """
+    以流式方式解析 multipart/form-data 请求体，把文件字段直接写入会话目录。
+
+    与先由 Starlette 完整落盘、再 copyfileobj 复制一遍相比：
+    - 文件数据只写一次，同时计算 SHA-256（用作转换缓存的键）
+    - 第一个数据块到达即检查扩展名和魔数，非图像文件立即拒绝
+    - Content-Length 或累计字节数超过 MAX_FILE_SIZE_MB 时立即中止接收
+
+    Args:
+        request: 原始请求对象（请求体尚未被读取）
+        memory_limit: 大于 0 且 Content-Length 不超过该值时，文件保留在内存中
+            （data 字段），不创建会话目录；供管道模式使用，见 materialize_upload()
+        ram_staging: 为 False 时会话目录总在磁盘上（文件需要移入 TEMP_DIR 下其他
+            目录或长时间保留的异步任务与源图存储使用）
+
+    Returns:
+        字典，包含 temp_dir、input_path（内存模式下均为 None）、data（仅内存模式）、
+        filename、extension、size、sha256、image（inspect_image() 的结果）、
+        client（公平调度标识）、耗时（started_at、upload_seconds、validation_seconds）
+        以及其余文本字段 fields
+
+    Raises:
+        HTTPException: 请求体或文件不合法（含像素数超限）时返回 400/422；失败时会话目录已被清理
+    """
+    started_at = time.monotonic()
+    validation_seconds = 0.0
+    content_type, content_params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = content_params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Request body must be multipart/form-data.")
+
+    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        logger.warning(f"请求体过大: {int(content_length) / (1024 * 1024):.2f}MB (最大: {MAX_FILE_SIZE_MB}MB)")
+        raise HTTPException(status_code=400, detail=f"File too large. Max size is {MAX_FILE_SIZE_MB}MB.")
+
+    in_memory = memory_limit > 0 and content_length.isdigit() and int(content_length) <= memory_limit
+    staging_bytes = int(content_length) * STAGING_RAM_FACTOR if content_length.isdigit() and ram_staging else 0
+    temp_dir = None if in_memory else create_session_dir(staging_bytes)
+    state = {
+        "temp_dir": temp_dir,
+        "input_path": None,
+        "data": None,
+        "filename": None,
+        "extension": None,
+        "size": 0,
+        "sha256": None,
+        "image": None,
+        "client": client_identity(request),
+        "fields": {},
+    }
+    digest = hashlib.sha256()
+    part = {}
+    events = []
+    output = None
+    header_buffer = b""
+    header_validated = False
+
+    def on_header_value(data, start, end):
+        part["header_value"] = part.get("header_value", b"") + data[start:end]
+
+    def on_header_field(data, start, end):
+        part["header_field"] = part.get("header_field", b"") + data[start:end]
+
+    def on_header_end():
+        part.setdefault("headers", {})[part.pop("header_field", b"").lower()] = part.pop("header_value", b"")
+
+    callbacks = {
+        "on_part_begin": lambda: (part.clear(), events.append(("begin", None))),
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers", dict(part.get("headers", {})))),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+    }
+    parser = MultipartParser(boundary, callbacks)
+    current = None  # 当前 part：("file", None) / ("field", name) / ("skip", None)
+
+    def check_header(final: bool) -> None:
+        nonlocal header_buffer, header_validated, validation_seconds
+        if header_validated or (len(header_buffer) < 32 and not final):
+            return
+        check_started = time.monotonic()
+        valid = validate_image_header(header_buffer[:32])
+        validation_seconds += time.monotonic() - check_started
+        if not valid:
+            logger.warning(f"文件内容验证失败: {state['filename']} - 文件头魔数不匹配图像格式")
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid image file content. The file does not appear to be a valid image."
+            )
+        header_validated = True
+        output.write(header_buffer)
+        header_buffer = b""
+
+    def handle_events() -> None:
+        nonlocal current, output, header_buffer, validation_seconds
+        for kind, payload in events:
+            if kind == "headers":
+                _, disposition = parse_options_header(payload.get(b"content-disposition", b""))
+                name = disposition.get(b"name", b"").decode("utf-8", errors="replace")
+                filename = disposition.get(b"filename")
+                if name == "file" and filename is not None and state["filename"] is None:
+                    state["filename"] = filename.decode("utf-8", errors="replace")
+                    check_started = time.monotonic()
+                    state["extension"] = validate_upload_filename(state["filename"])
+                    validation_seconds += time.monotonic() - check_started
+                    if in_memory:
+                        output = io.BytesIO()
+                    else:
+                        state["input_path"] = os.path.join(temp_dir, f"input{state['extension']}")
+                        output = open(state["input_path"], "wb")
+                    current = ("file", None)
+                elif filename is None and name:
+                    current = ("field", name)
+                    state["fields"][name] = b""
+                else:
+                    current = ("skip", None)
+            elif kind == "data" and current is not None:
+                if current[0] == "file":
+                    state["size"] += len(payload)
+                    if state["size"] > max_bytes:
+                        logger.warning(f"文件过大: 已超过 {MAX_FILE_SIZE_MB}MB，中止接收")
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"File too large. Max size is {MAX_FILE_SIZE_MB}MB."
+                        )
+                    digest.update(payload)
+                    if header_validated:
+                        # 写入页缓存的开销很小，直接在事件循环中写入
+                        output.write(payload)
+                    else:
+                        header_buffer += payload
+                        check_header(final=False)
+                elif current[0] == "field":
+                    value = state["fields"][current[1]] + payload
+                    if len(value) > MAX_FORM_FIELD_BYTES:
+                        raise HTTPException(status_code=400, detail=f"Form field too large: {current[1]}")
+                    state["fields"][current[1]] = value
+            elif kind == "end" and current is not None:
+                if current[0] == "file":
+                    check_header(final=True)
+                    if in_memory:
+                        state["data"] = output.getvalue()
+                    output.close()
+                current = None
+        events.clear()
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            handle_events()
+        parser.finalize()
+        handle_events()
+
+        if state["filename"] is None or not header_validated:
+            raise HTTPException(status_code=422, detail="Multipart field 'file' with a filename is required.")
+
+        # 只解析文件头得到尺寸与帧数，超过像素上限的输入不会进入转换
+        check_started = time.monotonic()
+        if in_memory:
+            state["image"] = inspect_image_stream(io.BytesIO(state["data"]))
+        else:
+            state["image"] = await asyncio.to_thread(inspect_image, state["input_path"])
+        validation_seconds += time.monotonic() - check_started
+        check_pixel_limit(state["image"])
+    except BaseException:
+        if output is not None:
+            output.close()
+        if temp_dir is not None:
+            cleanup_temp_dir(temp_dir)
+        raise
+
+    state["sha256"] = digest.hexdigest()
+    state["started_at"] = started_at
+    state["validation_seconds"] = validation_seconds
+    state["upload_seconds"] = time.monotonic() - started_at - validation_seconds
+    state["fields"] = {
+        name: value.decode("utf-8", errors="replace") for name, value in state["fields"].items()
+    }
+    logger.info(
+        f"流式接收完成: '{state['filename']}' ({state['size']} 字节) -> '{state['input_path'] or '内存'}'"
+    )
+    return state
+
+def materialize_upload(upload: dict) -> None:
+    """把内存模式的上传写入新的会话目录，之后与普通上传一样走文件路径。"""
+    if upload["data"] is None:
+        return
+    upload["temp_dir"] = create_session_dir(len(upload["data"]) * STAGING_RAM_FACTOR)
+    upload["input_path"] = os.path.join(upload["temp_dir"], f"input{upload['extension']}")
+    with open(upload["input_path"], "wb") as f:
+        f.write(upload["data"])
+    upload["data"] = None
+
+def multipart_openapi(extra_properties: Optional[dict] = None) -> dict:
+    """
+    为流式接收上传的端点生成 OpenAPI 请求体描述。
+
+    这些端点直接读取 request.stream()，不再声明 File/Form 参数，
+    因此需要手动补充文档中的 multipart 结构。
+    """
+    properties = {"file": {"type": "string", "format": "binary", "description": "要转换的图像文件 (支持动图)"}}
+    properties.update(extra_properties or {})
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {"type": "object", "properties": properties, "required": ["file"]}
+                }
+            },
+        }
+    }
+
+# --- 4a. 转换结果缓存 ---
+
+async def get_encoder_versions() -> dict:
+    """
+    从能力快照返回 magick / heif-enc 的版本标识。
+
+    编码器升级后输出字节可能变化，因此版本号是缓存键的一部分。
+    """
+    snapshot = await capability_probe.get()
+    magick = snapshot["dependencies"]["magick"]
+    heif_enc = snapshot["dependencies"]["heif_enc"]
+    return {
+        "magick": magick.get("version", magick["status"]),
+        "heif_enc": heif_enc.get("version", heif_enc["status"]),
+    }
+
+
+class ConversionCache:
+    """
+    按内容寻址的转换结果磁盘缓存。
+
+    - 键 = SHA-256(输入内容 + 规范化参数 + 编码器版本)
+    - 条目以原子 rename 写入，多个 uvicorn worker 可安全共享同一目录
+    - 以 mtime 作为 LRU 时间戳（命中时刷新），超出字节预算时淘汰最旧条目
+    - single_flight() 让相同键的并发请求只执行一次转换：进程内使用
+      asyncio.Lock，跨进程使用 flock 文件锁。锁文件是 .locks/ 下按键前缀分片的
+      固定集合（CACHE_LOCK_PREFIX_CHARS 个十六进制字符），从不删除：淘汰条目时
+      删除锁文件会让后来者在新 inode 上立即拿到锁，破坏去重；按键创建的锁文件
+      也会在失败或取消的转换后永久残留。代价是落在同一分片的不同键跨 worker
+      互相串行，分片数足够大时很少发生
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._local_locks: dict = {}
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(input_digest: str, params: dict, encoder_versions: dict) -> str:
+        """根据输入摘要、转换参数和编码器版本生成缓存键。"""
+        material = json.dumps(
+            {"input": input_digest, "params": params, "encoders": encoder_versions},
+            sort_keys=True,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, ".locks", key[:CACHE_LOCK_PREFIX_CHARS])
+
+    def fetch(self, key: str, destination: str) -> bool:
+        """
+        命中时把缓存条目硬链接（或复制）到 destination 并刷新其 LRU 时间戳。
+
+        使用链接而不是直接返回缓存路径，可避免响应发送期间条目被淘汰。
+        """
+        if not self.enabled:
+            return False
+        entry = self._entry_path(key)
+        try:
+            try:
+                os.link(entry, destination)
+            except OSError as exc:
+                if not os.path.exists(entry):
+                    return False
+                logger.debug("缓存条目无法硬链接，改为复制: %s", exc)
+                shutil.copyfile(entry, destination)
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open_entry(self, key: str):
+        """
+        命中时返回以只读方式打开的缓存条目并刷新其 LRU 时间戳，未命中返回 None。
+
+        已打开的文件在条目被淘汰后仍可完整读取，管道模式直接从中流式发送。
+        """
+        if not self.enabled:
+            return None
+        entry = self._entry_path(key)
+        try:
+            f = open(entry, "rb")
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return f
+
+    def open_staging(self, key: str) -> Optional[tuple]:
+        """为边生成边写入的结果创建暂存文件，返回 (路径, 文件对象)；缓存禁用时返回 None。"""
+        if not self.enabled:
+            return None
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = f"{entry}.{uuid.uuid4().hex}.tmp"
+        return staging, open(staging, "wb")
+
+    def commit(self, key: str, staging: str) -> None:
+        """把暂存文件原子地发布为缓存条目（超出预算时丢弃），随后按预算淘汰旧条目。"""
+        try:
+            if os.path.getsize(staging) <= self.max_bytes:
+                os.replace(staging, self._entry_path(key))
+        finally:
+            if os.path.exists(staging):
+                os.unlink(staging)
+        self.evict()
+
+    def store(self, key: str, source: str) -> None:
+        """把转换结果原子地写入缓存，随后按预算淘汰旧条目。"""
+        if not self.enabled:
+            return
+        if os.path.getsize(source) > self.max_bytes:
+            return
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = f"{entry}.{uuid.uuid4().hex}.tmp"
+        try:
+            try:
+                os.link(source, staging)
+            except OSError:
+                shutil.copyfile(source, staging)
+        except OSError:
+            if os.path.exists(staging):
+                os.unlink(staging)
+            raise
+        self.commit(key, staging)
+
+    def store_bytes(self, key: str, content: bytes) -> None:
+        """把内存中的转换结果写入缓存（管道模式的 Pillow 引擎使用）。"""
+        if not self.enabled or len(content) > self.max_bytes:
+            return
+        staging, f = self.open_staging(key)
+        with f:
+            f.write(content)
+        self.commit(key, staging)
+
+    def evict(self) -> None:
+        """
+        淘汰最久未使用的条目直到总大小回到预算内。
+
+        通过非阻塞 flock 保证同一时刻只有一个 worker 在扫描缓存目录。
+        """
+        lock_path = os.path.join(self.cache_dir, ".evict.lock")
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            total = 0
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir() or shard.name.startswith("."):
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".lock"):
+                        # 旧版本按键创建的锁文件，已不再使用
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+                        continue
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except FileNotFoundError:
+                    continue
+            logger.info("转换缓存淘汰完成，当前占用 %.2f MB", total / (1024 * 1024))
+
+    @asynccontextmanager
+    async def single_flight(self, key: str):
+        """
+        对同一缓存键的转换进行串行化。
+
+        等待者不占用准入调度器的许可；拿到锁后应再次 fetch()，
+        大多数情况下会直接命中前一个请求写入的结果。
+        """
+        if not self.enabled:
+            yield
+            return
+        local_lock = self._local_locks.setdefault(key, asyncio.Lock())
+        try:
+            async with local_lock:
+                lock_path = self._lock_path(key)
+                os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+                with open(lock_path, "a") as lock_file:
+                    # 跨 worker 文件锁：非阻塞轮询，保证等待可被取消
+                    delay = 0.01
+                    while True:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            await asyncio.sleep(delay)
+                            delay = min(delay * 2, 0.2)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            if not local_lock.locked() and self._local_locks.get(key) is local_lock:
+                del self._local_locks[key]
+
+
+conversion_cache = ConversionCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+
+# --- 4b. 进程内快速转换引擎 ---
+
+# Pillow 的编解码在 C 层释放 GIL，线程池即可并行；大小与并发许可数一致
+fast_path_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_CONVERSIONS,
+    thread_name_prefix="fast-path",
+)
+
+def select_conversion_engine(source, image: Optional[dict], target_format: str) -> str:
+    """
+    为一次转换选择引擎："pillow"（进程内）、"magick"（子进程）、
+    "magick-sharded"（大型动图分片并行编码）或 "magick-sequence"（动图编码为
+    AVIF/HEIF 图像序列，需要支持序列的编码器，否则 "magick" 只输出第一帧）。
+
+    小尺寸静态 JPEG/PNG/WebP 之间的转换由 Pillow 完成，省去 magick 进程
+    启动和 coder 初始化；动图、GIF、AVIF/HEIF 以及 Pillow 无法无损表示的
+    像素格式（CMYK、16 位等）仍交给 magick CLI。
+
+    Args:
+        source: 输入文件路径或内存中的文件对象（Pillow 只读取文件头）
+        image: 输入的 inspect_image() 结果
+        target_format: 目标格式
+    """
+    if image is not None and image["animated"]:
+        if target_format in ["avif", "heif"] and capability_probe.sequence_encoder(target_format) is not None:
+            return "magick-sequence"
+        return "magick-sharded" if should_shard_animation(image, target_format) else "magick"
+    if Image is None or FAST_PATH_MAX_MEGAPIXELS <= 0:
+        return "magick"
+    if target_format not in ["jpeg", "png", "webp"]:
+        return "magick"
+    if image is None or image["format"] not in ["jpeg", "png", "webp"] or image["bit_depth"] > 8:
+        return "magick"
+    if image["width"] * image["height"] > FAST_PATH_MAX_MEGAPIXELS * 1_000_000:
+        return "magick"
+    if target_format == "webp" and not pil_features.check("webp"):
+        return "magick"
+    try:
+        with Image.open(source) as pil_image:
+            if pil_image.mode not in ["RGB", "RGBA", "L", "LA", "P"]:
+                return "magick"
+    except Exception as exc:
+        logger.debug("Pillow 无法识别输入，使用 magick: %s", exc)
+        return "magick"
+    return "pillow"
+
+def convert_with_pillow(
+    input_path,
+    output_path,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> None:
+    """
+    使用 Pillow 执行转换，参数语义与 build_format_options() 和
+    build_resize_options() 保持一致。
+
+    与 magick 默认行为一致地保留 ICC 与 EXIF，不做自动旋转；thumbnail
+    与 -thumbnail 一致只保留 ICC。JPEG 缩小时用 draft() 在解码阶段按
+    1/2、1/4、1/8 缩小（对应 -define jpeg:size）。在线程池中同步执行。
+    input_path/output_path 也可以是文件对象（管道模式在内存中转换）。
+    """
+    with Image.open(input_path) as image:
+        if resize is not None and image.format == "JPEG":
+            width = resize["width"] or resize["height"]
+            height = resize["height"] or resize["width"]
+            image.draft(image.mode, (width * 2, height * 2))
+        image.load()
+        icc_profile = image.info.get("icc_profile")
+        exif = image.info.get("exif")
+        save_args = {}
+        if icc_profile:
+            save_args["icc_profile"] = icc_profile
+        if exif and not (resize is not None and resize["thumbnail"]):
+            save_args["exif"] = exif
+        if resize is not None:
+            image = resize_with_pillow(image, resize)
+
+        if target_format == "webp":
+            if image.mode not in ["RGB", "RGBA"]:
+                has_alpha = image.mode in ["LA"] or "transparency" in image.info
+                image = image.convert("RGBA" if has_alpha else "RGB")
+            if mode == "lossless":
+                # 映射: setting(0) -> method(6), setting(100) -> method(0)
+                webp_method = round(6 - (setting / 100.0) * 6)
+                save_args.update(lossless=True, quality=100, method=webp_method)
+            else:
+                save_args.update(quality=setting, method=4)
+            image.save(output_path, format="WEBP", **save_args)
+
+        elif target_format == "jpeg":
+            if image.mode not in ["RGB", "L"]:
+                image = image.convert("RGB")
+            quality = 100 if mode == "lossless" else setting
+            # 与 ImageMagick 默认一致：quality >= 90 时不做色度抽样
+            save_args.update(quality=quality, subsampling=0 if quality >= 90 else 2)
+            image.save(output_path, format="JPEG", **save_args)
+
+        elif target_format == "png":
+            if mode == "lossless":
+                # 映射: setting(0) -> compression(9), setting(100) -> compression(0)
+                save_args["compress_level"] = min(9, int((100 - setting) * 0.09))
+            else:
+                # 通过量化（减少颜色、不抖动）模拟 "有损"
+                colors = max(2, int(256 * (setting / 100.0)))
+                if image.mode not in ["RGB", "RGBA"]:
+                    image = image.convert("RGBA")
+                quantize_method = Image.Quantize.FASTOCTREE if image.mode == "RGBA" else Image.Quantize.MEDIANCUT
+                image = image.quantize(colors=colors, method=quantize_method, dither=Image.Dither.NONE)
+            image.save(output_path, format="PNG", **save_args)
+
+def resize_with_pillow(image, resize: dict):
+    """按 build_resize_options() 的 contain/cover/fill 语义缩放 Pillow 图像。"""
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if resize["fit"] == "fill":
+        return image.resize((resize["width"], resize["height"]), Image.Resampling.LANCZOS)
+    if resize["fit"] == "cover":
+        return ImageOps.fit(image, (resize["width"], resize["height"]), Image.Resampling.LANCZOS)
+    # contain: 只缩小不放大，与 "WxH>" 一致
+    width, height = image.size
+    scale = min(
+        resize["width"] / width if resize["width"] else 1.0,
+        resize["height"] / height if resize["height"] else 1.0,
+    )
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+def engine_version(engine: str, encoder_versions: dict, target_format: Optional[str] = None) -> str:
+    """返回用于缓存键的引擎版本标识。"""
+    if engine == "pillow":
+        return f"Pillow {PIL.__version__}"
+    if engine == "magick-sharded":
+        webpmux = "webpmux" if capability_probe.has("webpmux") else "no webpmux"
+        return f"{encoder_versions.get('magick', 'unknown')}; {webpmux}"
+    if engine == "magick-sequence":
+        return f"{encoder_versions.get('magick', 'unknown')}; sequence via {capability_probe.sequence_encoder(target_format)}"
+    return encoder_versions.get("magick", "unknown")
+
+# --- 4c. 大型动图分片并行编码 ---
+
+def should_shard_animation(animation: Optional[dict], target_format: str) -> bool:
+    """判断动图转换（animation 为 inspect_image() 的结果）是否达到分片并行编码的阈值。"""
+    if animation is None or animation["frames"] < 2 or target_format not in ["gif", "webp"]:
+        return False
+    if target_format == "webp" and not capability_probe.has("webpmux"):
+        return False
+    if (RESOURCE_PLAN["max_threads"] or os.cpu_count() or 1) < 2:
+        return False
+    frames = animation["frames"]
+    total_pixels = animation["width"] * animation["height"] * frames
+    if ANIMATION_SHARD_MIN_FRAMES > 0 and frames >= ANIMATION_SHARD_MIN_FRAMES:
+        return True
+    if ANIMATION_SHARD_MIN_MEGAPIXELS > 0 and total_pixels >= ANIMATION_SHARD_MIN_MEGAPIXELS * 1_000_000:
+        return True
+    return False
+
+def read_miff_timing(path: str) -> dict:
+    """从 MIFF 文本头中读取 delay / ticks-per-second / iterations。"""
+    with open(path, "rb") as f:
+        header = f.read(8192).split(b":\x1a", 1)[0].decode("latin-1")
+    timing = {"delay": 0, "ticks-per-second": 100, "iterations": 0}
+    for token in header.split():
+        key, _, value = token.partition("=")
+        if key in timing and value.isdigit():
+            timing[key] = int(value)
+    return timing
+
+async def run_conversion_tasks_in_parallel(command_groups: list) -> None:
+    """并行执行多组命令；任一组失败时取消其余组并抛出其异常。"""
+    await run_in_parallel([run_conversion_commands(group) for group in command_groups])
+
+async def run_in_parallel(coroutines: list) -> None:
+    """并行运行多个协程；任一失败时取消其余协程并抛出其异常。"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run_sharded_animation(
+    input_path: str,
+    output_path: str,
+    work_dir: str,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> None:
+    """
+    分片并行编码大型动图，调用方负责持有并发许可。
+
+    1. 一次 -coalesce（并按需缩放），把完整帧写成 8 位 MIFF（保留每帧延时与循环次数）
+    2. 按帧区间切分，每片一个单线程 magick 进程并行编码
+       - GIF：每片完成量化（最耗时的部分）并写成未优化的 GIF
+       - WebP：每帧独立编码为静态 WebP
+    3. 重新组装
+       - GIF：合并各片后统一 -layers optimize，保持跨片的帧间优化正确
+       - WebP：webpmux 按原始延时与循环次数封装，不再重新编码
+    """
+    frames_dir = os.path.join(work_dir, "frames")
+    os.makedirs(frames_dir, exist_ok=True)
+    await run_conversion_commands([[
+        'magick', *build_limit_options(inspect_image(input_path), [resize]), input_path, '-coalesce', *build_resize_options(resize),
+        '-depth', '8', '-compress', 'Zip', '-quality', '10',
+        '+adjoin', os.path.join(frames_dir, 'frame-%05d.miff'),
+    ]])
+    frame_paths = sorted(
+        os.path.join(frames_dir, name) for name in os.listdir(frames_dir) if name.endswith(".miff")
+    )
+    if not frame_paths:
+        raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+
+    # 分片数即并行进程数，取本次许可分配的线程数（未规划时按 CPU 数）
+    parallelism = conversion_threads.get() or os.cpu_count() or 1
+    shard_count = max(1, min(parallelism, len(frame_paths) // 8))
+    shard_size = -(-len(frame_paths) // shard_count)
+    shards = [frame_paths[i:i + shard_size] for i in range(0, len(frame_paths), shard_size)]
+    logger.info("动图分片编码: %d 帧, %d 片", len(frame_paths), len(shards))
+
+    # 去掉 -layers optimize：帧间优化必须在组装后对完整序列进行
+    options = without_layer_optimization(build_format_options(target_format, mode, setting))
+
+    if target_format == "gif":
+        shard_outputs = [os.path.join(work_dir, f"shard-{i:03d}.gif") for i in range(len(shards))]
+        await run_conversion_tasks_in_parallel([
+            [['magick', '-limit', 'thread', '1'] + shard + options + [shard_outputs[i]]]
+            for i, shard in enumerate(shards)
+        ])
+        await run_conversion_commands([
+            ['magick'] + shard_outputs + ['-layers', 'optimize', output_path]
+        ])
+        return
+
+    encoded_dir = os.path.join(work_dir, "encoded")
+    os.makedirs(encoded_dir, exist_ok=True)
+    groups = []
+    start = 0
+    for shard in shards:
+        groups.append([
+            ['magick', '-limit', 'thread', '1'] + shard + options
+            + ['-scene', str(start), '+adjoin', os.path.join(encoded_dir, 'frame-%05d.webp')]
+        ])
+        start += len(shard)
+    await run_conversion_tasks_in_parallel(groups)
+
+    mux_command = ['webpmux']
+    for index, frame_path in enumerate(frame_paths):
+        timing = read_miff_timing(frame_path)
+        duration_ms = round(timing["delay"] * 1000 / max(1, timing["ticks-per-second"]))
+        # 帧已 coalesce 为完整画布：不 dispose、不 blend，直接替换
+        mux_command.extend([
+            '-frame', os.path.join(encoded_dir, f'frame-{index:05d}.webp'), f'+{duration_ms}+0+0+0-b'
+        ])
+    loop_count = read_miff_timing(frame_paths[0])["iterations"]
+    mux_command.extend(['-loop', str(loop_count), '-o', output_path])
+    await run_conversion_commands([mux_command])
+
+# --- 4d. AVIF/HEIF 动图序列 ---
+
+# 每帧最多重复的次数：heif-enc 的序列只有统一的帧时长，帧延时不同时以其最大公约数为
+# 时长单位、按延时重复帧（重复帧几乎不占码率）；超过该倍数时放大时长单位，延时取近似值
+SEQUENCE_MAX_FRAME_REPEAT = 4
+# 帧延时为 0 时按浏览器的处理方式视为 100ms
+SEQUENCE_DEFAULT_FRAME_MS = 100
+
+def sequence_frame_repeats(durations_ms: list) -> tuple:
+    """
+    把各帧延时（毫秒）换算为统一的帧时长与每帧重复次数，返回 (帧时长毫秒, 重复次数列表)。
+    """
+    durations_ms = [d if d > 0 else SEQUENCE_DEFAULT_FRAME_MS for d in durations_ms]
+    unit = functools.reduce(math.gcd, durations_ms)
+    total = sum(durations_ms)
+    if total // unit > len(durations_ms) * SEQUENCE_MAX_FRAME_REPEAT:
+        unit = math.ceil(total / (len(durations_ms) * SEQUENCE_MAX_FRAME_REPEAT))
+    return unit, [max(1, round(d / unit)) for d in durations_ms]
+
+def build_heif_enc_sequence_command(
+    target_format: str,
+    mode: str,
+    setting: int,
+    frame_paths: list,
+    duration_ms: int,
+    output_path: str
+) -> list:
+    """构建 heif-enc 图像序列编码命令（--sequence，时间基为毫秒）。"""
+    command = build_heif_enc_command(target_format, mode, setting, frame_paths[0], output_path)
+    return command[:-1] + ['--sequence', '--timebase', '1000', '--duration', str(duration_ms)] + frame_paths
+
+async def run_sequence_animation(
+    input_path: str,
+    output_path: str,
+    work_dir: str,
+    image: Optional[dict],
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> None:
+    """
+    把动图编码为 AVIF/HEIF 图像序列（需要 heif-enc --sequence），调用方负责持有并发许可。
+
+    一次 -coalesce（并按需缩放）写出完整帧 PNG，同时为每帧写一个 1x1 的 MIFF 记录
+    延时；按延时换算帧时长与重复次数后由 heif-enc 编码。
+    """
+    frames_dir = os.path.join(work_dir, f"sequence-{target_format}")
+    os.makedirs(frames_dir, exist_ok=True)
+    base = (
+        ['magick', *build_limit_options(image, [resize]), input_path, '-coalesce', *build_resize_options(resize)]
+    )
+
+    # 帧数多时不压缩的 PNG 会占用大量磁盘，使用最快的压缩级别
+    await run_conversion_commands([base + [
+        '(', '-clone', '0--1', '-sample', '1x1!', '+adjoin',
+        '-write', os.path.join(frames_dir, 'timing-%05d.miff'), '-delete', '0--1', ')',
+        '-define', 'png:compression-level=1', '+adjoin', os.path.join(frames_dir, 'frame-%05d.png'),
+    ]])
+    frame_paths = sorted(
+        os.path.join(frames_dir, name) for name in os.listdir(frames_dir)
+        if name.startswith("frame-") and name.endswith(".png")
+    )
+    if not frame_paths:
+        raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+    durations_ms = []
+    for frame_path in frame_paths:
+        timing = read_miff_timing(frame_path.replace("frame-", "timing-")[:-4] + ".miff")
+        durations_ms.append(round(timing["delay"] * 1000 / max(1, timing["ticks-per-second"])))
+    duration_ms, repeats = sequence_frame_repeats(durations_ms)
+
+    sequence = []
+    for frame_path, count in zip(frame_paths, repeats):
+        sequence.append(frame_path)
+        for index in range(1, count):
+            repeated_path = f"{frame_path[:-4]}-{index}.png"
+            os.link(frame_path, repeated_path)
+            sequence.append(repeated_path)
+    logger.info("AVIF/HEIF 序列编码: %d 帧, 帧时长 %dms, 展开为 %d 帧", len(frame_paths), duration_ms, len(sequence))
+    await run_conversion_commands([
+        build_heif_enc_sequence_command(target_format, mode, setting, sequence, duration_ms, output_path)
+    ])
+
+# --- 5. API 端点 ---
+
+@app.get("/", summary="上传界面")
+async def root(request: Request):
+    """
+    返回用户友好的HTML上传表单页面。
+    提供图形化界面进行图像转换，支持4套主题切换。
+    """
+    return templates.TemplateResponse("index.html", {"request": request})
+
+@app.get("/health", summary="服务健康检查")
+async def health_check():
+    """Report dependency failures as a non-2xx response before serving conversions."""
+    snapshot = await capability_probe.get()
+    dependencies = {
+        "magick": snapshot["dependencies"]["magick"],
+        "heif_enc": snapshot["dependencies"]["heif_enc"],
+    }
+    magick = dependencies["magick"]
+    heif_enc = dependencies["heif_enc"]
+    base_response = {
+        "dependencies": dependencies,
+        "optional_dependencies": {"webpmux": snapshot["dependencies"]["webpmux"]},
+        "coders": snapshot["coders"],
+        "sequence_encoders": {f: capability_probe.sequence_encoder(f) for f in HEIF_CODERS},
+        "checked_seconds_ago": round(time.monotonic() - snapshot["checked_at"], 1),
+        "imagemagick": magick.get("version", "Not available"),
+        "avif_encoder": heif_enc.get("path") or "Not available (AVIF/HEIF conversion will fail)",
+        "resource_limits": {
+            "max_file_size_mb": MAX_FILE_SIZE_MB,
+            "timeout_seconds": TIMEOUT_SECONDS,
+        },
+        "resource_plan": dict(RESOURCE_PLAN, mode=RESOURCE_PLANNING),
+        "staging": staging_area.report(),
+        "broker": conversion_broker.report(),
+    }
+
+    if any(item["status"] != "available" for item in dependencies.values()):
+        base_response["status"] = "unhealthy"
+        return JSONResponse(status_code=503, content=base_response)
+
+    temp_dir = snapshot["temp_dir"]
+    if temp_dir["status"] != "available":
+        base_response["status"] = "unhealthy"
+        base_response["disk_space"] = temp_dir
+        return JSONResponse(status_code=503, content=base_response)
+
+    base_response["status"] = "healthy"
+    base_response["disk_space"] = {
+        "free_mb": temp_dir["free_mb"],
+        "temp_dir": temp_dir["temp_dir"],
+    }
+    return base_response
+
+@app.get("/health/live", summary="存活检查")
+async def liveness_check():
+    """事件循环能响应即视为存活；不做任何 I/O，适合高频轮询。"""
+    return {"status": "alive"}
+
+@app.get("/health/ready", summary="就绪检查")
+async def readiness_check():
+    """
+    根据缓存的能力快照判断是否可以接收转换请求。
+
+    不触发任何探测：快照尚未生成、已过期（后台刷新停止）或显示依赖
+    不可用时返回 503。
+    """
+    snapshot = capability_probe.snapshot
+    if snapshot is None:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    age = time.monotonic() - snapshot["checked_at"]
+    if not capability_probe.is_healthy(snapshot) or age > 3 * max(CAPABILITY_REFRESH_SECONDS, 5):
+        return JSONResponse(
+            status_code=503,
+            content={"status": "unhealthy", "checked_seconds_ago": round(age, 1)}
+        )
+    return {"status": "ready", "checked_seconds_ago": round(age, 1)}
+
+@app.get("/metrics", summary="Prometheus 指标", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """
+    以 Prometheus 文本格式输出全部 worker 合并后的指标。
+
+    包含上传、校验、并发许可等待、每次编码器调用和请求总耗时的直方图
+    （按 target_format / mode 标注），执行中/排队中的转换数，以及输入/输出
+    字节计数。
+    """
+    return PlainTextResponse(
+        await asyncio.to_thread(metrics.render, metrics.snapshot()),
+        media_type="text/plain; version=0.0.4"
+    )
+
+def needs_coalesce(image: Optional[dict], file_extension: str) -> bool:
+    """
+    判断输入是否为动图、需要 -coalesce 与逐帧处理。
+
+    依据文件内容而非扩展名或目标格式（见 inspect_image）：PNG 的 acTL 块、
+    WebP 的 ANIM 块、GIF 的多个图像描述符、HEIF/AVIF 的图像序列、多页 TIFF。
+    静态 PNG/WebP 以及转为 GIF/WebP 的静态图不再付出动图路径的开销。
+    文件头无法解析时按扩展名保守判断。
+    """
+    if image is None:
+        return file_extension.lower() in ['.gif', '.webp', '.apng', '.png']
+    return image["animated"]
+
+def without_layer_optimization(options: list) -> list:
+    """去掉编码参数中的 -layers optimize（单帧图像或分片编码时没有完整的帧序列可优化）。"""
+    options = list(options)
+    if '-layers' in options:
+        index = options.index('-layers')
+        del options[index:index + 2]
+    return options
+
+def build_format_options(target_format: str, mode: str, setting: int) -> list:
+    """
+    把 (target_format, mode, setting) 映射为 ImageMagick 编码参数。
+
+    AVIF/HEIF 由 heif-enc 编码，此处不产生参数。
+
+    Args:
+        target_format: 目标格式 (avif, webp, jpeg, png, gif, heif)
+        mode: 转换模式 (lossy, lossless)
+        setting: 质量/压缩参数 (0-100)
+
+    Returns:
+        追加在输入文件之后、输出文件之前的参数列表
+    """
+    options = []
+
+    # --- 无损 (lossless) 模式逻辑 ---
+    if mode == "lossless":
+        # 'setting' (0-100) 代表压缩速度 (0=最佳/最慢, 100=最快/最差)
+
+        if target_format == "webp":
+            # WebP method (0-6), 6 是最慢/最佳
+            # 映射: setting(0) -> method(6), setting(100) -> method(0)
+            # 使用线性插值确保精确映射
+            webp_method = round(6 - (setting / 100.0) * 6)
+            # WebP 无损模式下 quality 应始终为 100
+            options.extend(['-define', 'webp:lossless=true'])
+            options.extend(['-define', f'webp:method={webp_method}'])
+            options.extend(['-quality', '100'])
+
+        elif target_format == "jpeg":
+            # JPEG 几乎没有通用的无损模式，使用-quality 100作为最佳有损替代
+            options.extend(['-quality', '100'])
+
+        elif target_format == "png":
+            # PNG 始终无损
+            # 映射: setting(0) -> compression(9), setting(100) -> compression(0)
+            png_compression = min(9, int((100 - setting) * 0.09))
+            # Magick -quality 映射: 91=级别0, 100=级别9
+            options.extend(['-quality', str(91 + png_compression)])
+
+        elif target_format == "gif":
+            # GIF 始终是基于调色板的无损
+            # -layers optimize 用于优化动图帧
+            options.extend(['-layers', 'optimize'])
+
+    # --- 有损 (lossy) 模式逻辑 ---
+    elif mode == "lossy":
+        # 'setting' (0-100) 代表 质量 (0=最差, 100=最佳)
+        quality = setting
+
+        if target_format == "webp":
+            options.extend(['-quality', str(quality)])
+            options.extend(['-define', 'webp:method=4']) # 默认使用较快的速度
+
+        elif target_format == "jpeg":
+            options.extend(['-quality', str(quality)])
+
+        elif target_format == "png":
+            # PNG 本身无损，通过量化（减少颜色）模拟 "有损"
+            # 映射: quality(100) -> 256色, quality(0) -> 2色
+            colors = max(2, int(256 * (quality / 100.0)))
+            options.extend(['-colors', str(colors), '+dither'])
+
+        elif target_format == "gif":
+            # GIF "有损" 通过减少调色板颜色实现
+            colors = max(2, int(256 * (quality / 100.0)))
+            options.extend(['-colors', str(colors), '+dither'])
+            options.extend(['-layers', 'optimize'])
+
+    return options
+
+def parse_dimension(value: Optional[str], name: str) -> Optional[int]:
+    """
+    解析表单中的宽/高字段；空值返回 None。
+
+    Raises:
+        HTTPException: 422，非整数或超出 1..MAX_RESIZE_DIMENSION
+    """
+    if value is None or str(value).strip() == "":
+        return None
+    try:
+        dimension = int(value)
+    except ValueError:
+        dimension = 0
+    if not (1 <= dimension <= MAX_RESIZE_DIMENSION):
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid {name}: {value}. Must be between 1 and {MAX_RESIZE_DIMENSION}"
+        )
+    return dimension
+
+def parse_resize_options(
+    width: Optional[int],
+    height: Optional[int],
+    fit: str = "contain",
+    thumbnail: bool = False
+) -> Optional[dict]:
+    """
+    组合缩放参数；未指定宽和高时返回 None（保持原尺寸）。
+
+    Returns:
+        {"width", "height", "fit", "thumbnail"} 或 None
+
+    Raises:
+        HTTPException: 422，fit/thumbnail 缺少尺寸或取值非法
+    """
+    if fit not in get_args(ResizeFit):
+        raise HTTPException(
+            status_code=422,
+            detail=f"Invalid fit: {fit}. Must be one of {list(get_args(ResizeFit))}"
+        )
+    if width is None and height is None:
+        if thumbnail:
+            raise HTTPException(status_code=422, detail="thumbnail requires width and/or height.")
+        return None
+    if fit in ["cover", "fill"] and (width is None or height is None):
+        raise HTTPException(status_code=422, detail=f"fit={fit} requires both width and height.")
+    return {"width": width, "height": height, "fit": fit, "thumbnail": thumbnail}
+
+def build_resize_options(resize: Optional[dict]) -> list:
+    """
+    把缩放参数映射为 ImageMagick 参数（位于 -coalesce 之后、编码参数之前）。
+
+    thumbnail=True 时使用 -thumbnail：速度更快，并去除除颜色配置文件外的元数据。
+    """
+    if resize is None:
+        return []
+    operator = '-thumbnail' if resize["thumbnail"] else '-resize'
+    geometry = f"{resize['width'] or ''}x{resize['height'] or ''}"
+    if resize["fit"] == "fill":
+        return [operator, f"{geometry}!"]
+    if resize["fit"] == "cover":
+        return [operator, f"{geometry}^", '-gravity', 'center', '-extent', geometry, '+repage']
+    return [operator, f"{geometry}>"]
+
+def build_decode_options(image: Optional[dict], resize: Optional[dict]) -> list:
+    """
+    构建放在输入文件之前的解码参数。
+
+    JPEG 输入需要缩小时使用 -define jpeg:size（libjpeg 按 1/2、1/4、1/8 在
+    解码阶段缩小），请求目标的两倍尺寸以保留足够细节供后续重采样；
+    5000 万像素的照片生成 512px 缩略图时不会被完整解码。
+    """
+    if resize is None or image is None or image["format"] != "jpeg":
+        return []
+    width = resize["width"] or resize["height"]
+    height = resize["height"] or resize["width"]
+    return ['-define', f'jpeg:size={width * 2}x{height * 2}']
+
+def resize_area(resize: Optional[dict]) -> int:
+    """缩放框的面积，用于多尺寸输出按从大到小排序；不缩放视为最大。"""
+    if resize is None:
+        return MAX_RESIZE_DIMENSION * MAX_RESIZE_DIMENSION + 1
+    width = resize["width"] or resize["height"]
+    height = resize["height"] or resize["width"]
+    return width * height
+
+# ImageMagick (Q16-HDRI) 像素缓存：每像素 4 通道 × 4 字节
+MAGICK_BYTES_PER_PIXEL = 16
+MIN_CONVERSION_MEMORY_BYTES = 64 * 1024 * 1024
+# -limit area 相对文件头尺寸的余量：area 决定像素缓存能否留在内存，达到上限的图像
+# （比首帧更大的 TIFF 页、按画布大小合成的动图帧、中间结果）会静默落到 map/磁盘缓存，
+# 因此不按精确像素数设置；实际内存占用由 -limit memory 约束
+LIMIT_AREA_HEADROOM = 2
+
+def resized_dimensions(width: int, height: int, resize: Optional[dict]) -> tuple:
+    """按 build_resize_options() 的语义计算缩放后（cover 为裁剪前）的尺寸。"""
+    if resize is None:
+        return width, height
+    if resize["fit"] == "fill":
+        return resize["width"], resize["height"]
+    if resize["fit"] == "cover":
+        scale = max(resize["width"] / width, resize["height"] / height)
+    else:
+        scale = min(
+            resize["width"] / width if resize["width"] else 1.0,
+            resize["height"] / height if resize["height"] else 1.0,
+            1.0,
+        )
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+def build_limit_options(image: Optional[dict], resizes: Optional[list] = None) -> list:
+    """
+    按文件头中的尺寸为单次 magick 调用生成 -limit 参数（放在输入文件之前）。
+
+    area 为源图与各缩放结果（含中间结果）的像素数乘以 LIMIT_AREA_HEADROOM，只作为
+    防止像素缓存被挤出内存的宽松上限；memory 按像素缓存估算（源图与工作副本，动图乘以
+    帧数），下限 64MiB、上限为全局 MAGICK_MEMORY_LIMIT。
+    小任务不再各自按全局上限占用内存，超出估算的部分照常溢出到磁盘缓存。
+    文件头无法解析时不添加参数，沿用全局限制。
+    """
+    if image is None or not image["width"] or not image["height"]:
+        return []
+    dimensions = [(image["width"], image["height"])] + [
+        resized_dimensions(image["width"], image["height"], resize) for resize in (resizes or [])
+    ]
+    # 缩放分水平、垂直两遍进行，中间结果可能是 (目标宽 × 源高)，按最大宽 × 最大高计算
+    area = max(width for width, _ in dimensions) * max(height for _, height in dimensions)
+    memory = max(MIN_CONVERSION_MEMORY_BYTES, area * MAGICK_BYTES_PER_PIXEL * max(1, image["frames"]) * 2)
+    memory_ceiling = parse_byte_size(MAGICK_MEMORY_LIMIT)
+    if memory_ceiling:
+        memory = min(memory, memory_ceiling)
+    return ['-limit', 'area', str(area * LIMIT_AREA_HEADROOM), '-limit', 'memory', str(memory)]
+
+def build_heif_enc_command(
+    target_format: str,
+    mode: str,
+    setting: int,
+    encoder_input_path: str,
+    output_path: str
+) -> list:
+    """构建 heif-enc 编码命令（AVIF/HEIF 目标格式）。"""
+    command = ['heif-enc']
+    if target_format == "avif":
+        command.append('--avif')
+    if mode == "lossless":
+        command.append('--lossless')
+    else:
+        command.extend(['--quality', str(setting)])
+    command.extend(['--output', output_path, encoder_input_path])
+    return command
+
+def heif_enc_reads_directly(input_path: str) -> bool:
+    """
+    判断 heif-enc 是否可以直接读取输入文件，从而省去 PNG 中间文件。
+
+    heif-enc 按扩展名识别 JPEG/PNG 输入，因此要求扩展名与魔数一致；
+    CMYK JPEG 交给 ImageMagick 转换色彩空间。
+    """
+    extension = os.path.splitext(input_path)[1].lower()
+    image = inspect_image(input_path)
+    if image is None:
+        return False
+    if extension == ".png":
+        return image["format"] == "png"
+    if extension in [".jpg", ".jpeg"]:
+        return image["format"] == "jpeg" and image["channels"] in (1, 3)
+    return False
+
+def create_scratch_dir(session_dir: str, estimated_bytes: int) -> str:
+    """
+    为中间文件选择工作目录。
+
+    内存暂存区的预算与剩余空间足够（预估大小的两倍）时，在 SCRATCH_RAM_DIR
+    中创建新的暂存目录；否则直接使用会话目录。调用方在转换结束后负责
+    删除返回的目录（与会话目录相同时随会话一起清理）。
+    """
+    try:
+        return staging_area.create_scratch(session_dir, estimated_bytes)
+    except OSError:
+        return session_dir
+
+def estimate_decoded_bytes(input_path: str) -> int:
+    """
+    估计第一帧解码为 RGBA 后的像素数据大小（即不压缩 PNG 中间文件的大小）。
+
+    文件头无法解析时按 20 倍压缩率估算。
+    """
+    image = inspect_image(input_path)
+    if image is None or not image["width"] or not image["height"]:
+        return os.path.getsize(input_path) * 20 + 1024 * 1024
+    bytes_per_sample = 2 if image["bit_depth"] > 8 else 1
+    return image["width"] * image["height"] * 4 * bytes_per_sample + 1024 * 1024
+
+# 中间 PNG 只用于把像素交给 heif-enc：关闭 zlib 压缩和行过滤，
+# 避免为一个马上被丢弃的文件付出完整的压缩开销。
+FAST_PNG_DEFINES = ['-define', 'png:compression-level=0', '-define', 'png:compression-filter=0']
+
+def build_conversion_commands(
+    input_path: str,
+    output_path: str,
+    scratch_dir: str,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> list:
+    """
+    根据目标格式和模式构建需要依次执行的命令列表。
+
+    Args:
+        input_path: 会话目录中的输入文件路径
+        output_path: 期望的输出文件路径
+        scratch_dir: 中间文件目录（见 create_scratch_dir）
+        target_format: 目标格式 (avif, webp, jpeg, png, gif, heif)
+        mode: 转换模式 (lossy, lossless)
+        setting: 质量/压缩参数 (0-100)
+        resize: parse_resize_options() 的结果，None 表示保持原尺寸
+
+    Returns:
+        命令列表，每个元素是一条 argv 列表
+    """
+    # Debian 的 ImageMagick 包不一定编译了 HEIF coder；在这种环境里
+    # 仅使用 output.avif/output.heif 后缀会静默写出 PNG。AVIF/HEIF 因此
+    # 由已校验存在的 heif-enc 负责。heif-enc 能直接读取的 JPEG/PNG 不经
+    # ImageMagick；其余输入由 ImageMagick 规范化为不压缩的 PNG 中间文件。
+    image = inspect_image(input_path)
+    if target_format in ["avif", "heif"]:
+        if resize is None and heif_enc_reads_directly(input_path):
+            return [build_heif_enc_command(target_format, mode, setting, input_path, output_path)]
+        encoder_input_path = os.path.join(scratch_dir, "encoder-input.png")
+        # heif-enc 只消费单张静态输入；明确选择第一帧，避免
+        # ImageMagick 按未知 AVIF/HEIF coder 静默生成错误格式。
+        return [
+            ['magick'] + build_limit_options(image, [resize]) + build_decode_options(image, resize)
+            + [f'{input_path}[0]']
+            + build_resize_options(resize) + FAST_PNG_DEFINES + [encoder_input_path],
+            build_heif_enc_command(target_format, mode, setting, encoder_input_path, output_path),
+        ]
+
+    if needs_coalesce(image, os.path.splitext(input_path)[1]):
+        return [build_animated_command(input_path, output_path, image, target_format, mode, setting, resize)]
+    return [build_static_command(input_path, output_path, image, target_format, mode, setting, resize)]
+
+def build_static_command(
+    input_spec: str,
+    output_spec: str,
+    image: Optional[dict],
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> list:
+    """
+    静态输入的最简 magick 调用：可启用 JPEG 解码期缩小，不做 -coalesce
+    与帧间优化。
+
+    input_spec / output_spec 为文件路径，或管道模式下的 "jpeg:-" 形式；
+    image 为输入的 inspect_image() 结果。
+    """
+    return (
+        ['magick']
+        + build_limit_options(image, [resize])
+        + build_decode_options(image, resize)
+        + [input_spec]
+        + build_resize_options(resize)
+        + without_layer_optimization(build_format_options(target_format, mode, setting))
+        + [output_spec]
+    )
+
+def build_animated_command(
+    input_spec: str,
+    output_spec: str,
+    image: Optional[dict],
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> list:
+    """
+    动图输入的 magick 调用：先 -coalesce 把每帧还原为完整画布，再逐帧缩放
+    并编码；GIF 输出保留 -layers optimize 重新做帧间优化。参数同 build_static_command()。
+    """
+    return (
+        ['magick']
+        + build_limit_options(image, [resize])
+        + [input_spec, '-coalesce']
+        + build_resize_options(resize)
+        + build_format_options(target_format, mode, setting)
+        + [output_spec]
+    )
+
+def build_rendition_commands(input_path: str, scratch_dir: str, renditions: list) -> list:
+    """
+    为多个输出版本构建“只解码一次”的命令列表。
+
+    ImageMagick 读取（并按需 -coalesce）输入后写入内存寄存器 mpr:source。
+    版本按缩放尺寸分组，并按从大到小的顺序生成每个尺寸的寄存器；fit=contain
+    时每个尺寸从上一个（更大的）尺寸缩小，重采样的像素逐级减少。每个版本
+    在 -respect-parentheses 括号内从对应寄存器克隆并以各自参数 -write，
+    编码设置不会泄漏到下一个版本。AVIF/HEIF 版本在原尺寸时直接读取
+    heif-enc 支持的输入，否则每个尺寸共享一个不压缩的第一帧 PNG 中间文件。
+
+    Args:
+        input_path: 会话目录中的输入文件路径
+        scratch_dir: 中间文件目录（见 create_scratch_dir）
+        renditions: 字典列表，包含 target_format/mode/setting/resize/output_path
+
+    Returns:
+        命令列表，每个元素是一条 argv 列表
+    """
+    image = inspect_image(input_path)
+    animated = needs_coalesce(image, os.path.splitext(input_path)[1])
+    groups = []
+    for rendition in sorted(renditions, key=lambda r: resize_area(r["resize"]), reverse=True):
+        if groups and groups[-1]["resize"] == rendition["resize"]:
+            groups[-1]["renditions"].append(rendition)
+        else:
+            groups.append({"resize": rendition["resize"], "renditions": [rendition]})
+
+    def box_contains(outer: dict, inner: dict) -> bool:
+        return all(
+            outer[key] is None or (inner[key] is not None and inner[key] <= outer[key])
+            for key in ["width", "height"]
+        )
+
+    branches = []
+    heif_commands = []
+    contain_registers = []
+    for index, group in enumerate(groups):
+        resize = group["resize"]
+        register = 'mpr:source'
+        if resize is not None:
+            base = 'mpr:source'
+            if resize["fit"] == "contain":
+                # 从能容纳当前框的最小已生成尺寸继续缩小，结果与从源图缩小一致
+                for previous, previous_register in reversed(contain_registers):
+                    if box_contains(previous, resize):
+                        base = previous_register
+                        break
+            register = f'mpr:size{index}'
+            branches.append([base] + build_resize_options(resize) + ['-write', register])
+            if resize["fit"] == "contain":
+                contain_registers.append((resize, register))
+
+        heif_renditions = [r for r in group["renditions"] if r["target_format"] in ["avif", "heif"]]
+        if heif_renditions:
+            if resize is None and heif_enc_reads_directly(input_path):
+                encoder_input_path = input_path
+            else:
+                encoder_input_path = os.path.join(scratch_dir, f"encoder-input-{index}.png")
+                # 与单次转换一致：heif-enc 只消费第一帧
+                branches.append([register, '-delete', '1--1'] + FAST_PNG_DEFINES + ['-write', encoder_input_path])
+            for rendition in heif_renditions:
+                heif_commands.append(build_heif_enc_command(
+                    rendition["target_format"],
+                    rendition["mode"],
+                    rendition["setting"],
+                    encoder_input_path,
+                    rendition["output_path"],
+                ))
+        for rendition in group["renditions"]:
+            if rendition["target_format"] in ["avif", "heif"]:
+                continue
+            options = build_format_options(rendition["target_format"], rendition["mode"], rendition["setting"])
+            branches.append(
+                [register]
+                + (options if animated else without_layer_optimization(options))
+                + ['-write', rendition["output_path"]]
+            )
+
+    commands = []
+    if branches:
+        # 所有版本都需要缩小时，按最大尺寸启用 JPEG 解码期缩小
+        decode_resize = groups[0]["resize"]
+        cmd = (
+            ['magick', '-respect-parentheses']
+            + build_limit_options(image, [r["resize"] for r in renditions])
+            + build_decode_options(image, decode_resize)
+            + [input_path]
+        )
+        # 只有 AVIF/HEIF 版本时只用第一帧，不必 coalesce 整个序列
+        if animated and any(r["target_format"] not in ["avif", "heif"] for r in renditions):
+            cmd.append('-coalesce')
+        cmd.extend(['-write', 'mpr:source', '+delete'])
+        for index, branch in enumerate(branches):
+            cmd.append('(')
+            cmd.extend(branch)
+            if index < len(branches) - 1:
+                cmd.append('+delete')
+            cmd.append(')')
+        cmd.append('null:')
+        commands.append(cmd)
+    commands.extend(heif_commands)
+    return commands
+
+async def run_conversion_commands(commands: list) -> None:
+    """
+    依次执行转换命令，任一命令失败即抛出 HTTPException。
+
+    调用方负责获取并发许可；超时以 asyncio.TimeoutError 形式向上传播。
+    """
+    for index, command in enumerate(commands):
+        command = with_thread_options(command)
+        logger.info("正在执行命令: %s", ' '.join(command))
+        command_started = time.monotonic()
+        process = SupervisedProcess(command)
+        try:
+            await process.start()
+        except OSError as exc:
+            logger.error("无法启动图像转换进程: %s", exc)
+            raise HTTPException(
+                status_code=503,
+                detail="Image conversion dependency is unavailable."
+            ) from exc
+        try:
+            stderr = await asyncio.wait_for(
+                process.communicate(),
+                timeout=TIMEOUT_SECONDS
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # 超时或任务被取消（含客户端断开）时结束整个进程组并回收，避免其继续占用 CPU 与内存
+            await process.terminate()
+            raise
+        finally:
+            metrics.observe(
+                "imagemagick_api_command_seconds", time.monotonic() - command_started,
+                tool=os.path.basename(command[0]), **metric_labels.get()
+            )
+        if process.returncode != 0:
+            error_detail = stderr.decode(errors="replace")
+            if process.returncode < 0:
+                # 被信号终止：通常是 rlimit（SIGXCPU、SIGXFSZ）或地址空间耗尽后的崩溃
+                error_detail += f" (terminated by {signal.Signals(-process.returncode).name})"
+            logger.error("Image conversion command failed: %s", error_detail)
+            raise HTTPException(
+                status_code=500,
+                detail="Image conversion failed. Please check your input file and parameters."
+            )
+        report_progress("converting", (index + 1) / len(commands))
+
+def validate_upload_filename(filename: str) -> str:
+    """
+    校验上传文件名的扩展名。
+
+    Args:
+        filename: 客户端提供的文件名
+
+    Returns:
+        小写的文件扩展名（含点号）
+
+    Raises:
+        HTTPException: 文件名缺失或扩展名不受支持时返回 400
+    """
+    if not filename:
+        raise HTTPException(status_code=400, detail="Filename is required.")
+
+    file_ext = os.path.splitext(filename)[1].lower()
+    allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heif', '.heic', '.bmp', '.tiff', '.tif'}
+    if file_ext not in allowed_extensions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file format: {file_ext}. Allowed formats: {', '.join(allowed_extensions)}"
+        )
+    return file_ext
+
+def record_upload_metrics(upload: dict, labels: dict) -> None:
+    """记录上传阶段（接收、校验）的耗时与输入字节数；启用追踪时同时记入当前请求。"""
+    metrics.observe("imagemagick_api_upload_seconds", upload["upload_seconds"], **labels)
+    metrics.observe("imagemagick_api_validation_seconds", upload["validation_seconds"], **labels)
+    metrics.inc("imagemagick_api_input_bytes_total", upload["size"], **labels)
+    trace = conversion_trace.get()
+    if trace is not None:
+        trace.record_upload(upload)
+
+def conversion_cache_key(
+    upload: dict,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict],
+    engine: str,
+    encoder_versions: dict
+) -> str:
+    """单次转换的缓存键；文件路径与管道模式的输出字节相同，共用同一个键。"""
+    return conversion_cache.make_key(
+        upload["sha256"],
+        {
+            "target_format": target_format,
+            "mode": mode,
+            "setting": setting,
+            "resize": resize,
+            "engine": engine,
+            "engine_version": engine_version(engine, encoder_versions, target_format),
+        },
+        encoder_versions,
+    )
+
+async def run_conversion(
+    upload: dict,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> dict:
+    """
+    核心图像转换逻辑（内部函数）。
+    同步端点与异步任务共用，避免代码重复。
+
+    Args:
+        upload: receive_upload() 的结果（输入已写入会话目录）
+        target_format: 目标格式 (avif, webp, jpeg, png, gif, heif)
+        mode: 转换模式 (lossy, lossless)
+        setting: 质量/压缩参数 (0-100)
+        resize: parse_resize_options() 的结果，None 表示保持原尺寸
+
+    Returns:
+        字典，包含 output_path、media_type、filename、engine、cache_status，以及
+        animation（动图转 AVIF/HEIF 时为 "sequence" 或 "first-frame"，否则为 None）。
+        成功时会话目录保留给调用方清理；失败或取消时本函数立即清理。
+    """
+    logger.info(f"开始转换: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+
+    # 上传已在 receive_upload() 中完成扩展名、魔数和大小校验并写入会话目录
+    temp_dir = upload["temp_dir"]
+    scratch_dir = temp_dir
+    succeeded = False
+    input_path = upload["input_path"]
+    output_path = os.path.join(temp_dir, f"output.{target_format}")
+    labels = {"target_format": target_format, "mode": mode}
+    labels_token = metric_labels.set(labels)
+    status_code = 500
+    record_upload_metrics(upload, labels)
+
+    logger.info(f"正在临时目录中处理: {temp_dir}")
+
+    try:
+        # 预检查: 依据能力快照确认目标格式的编码器可用（AVIF/HEIF 需要 heif-enc）。
+        await capability_probe.get()
+        require_conversion_capabilities([target_format])
+
+        # 1. 查询转换结果缓存；相同键的并发请求只执行一次转换，
+        # 等待者不占用并发许可，拿到锁后直接复用前一个请求的结果。
+        # 引擎选择只读取文件头，且结果取决于输入内容，因此可以计入缓存键。
+        engine = await asyncio.to_thread(select_conversion_engine, input_path, upload["image"], target_format)
+        encoder_versions = await get_encoder_versions()
+        cache_key = conversion_cache_key(upload, target_format, mode, setting, resize, engine, encoder_versions)
+        cache_status = "HIT"
+        if not conversion_cache.fetch(cache_key, output_path):
+            async with conversion_cache.single_flight(cache_key):
+                if not conversion_cache.fetch(cache_key, output_path):
+                    cache_status = "MISS"
+                    # 2. 动态构建转换命令（AVIF/HEIF 的中间文件优先放在内存文件系统）
+                    if target_format in ["avif", "heif"] and engine != "magick-sequence" and (
+                        resize is not None or not heif_enc_reads_directly(input_path)
+                    ):
+                        scratch_dir = create_scratch_dir(temp_dir, estimate_decoded_bytes(input_path))
+                    commands = build_conversion_commands(
+                        input_path, output_path, scratch_dir, target_format, mode, setting, resize
+                    )
+
+                    # 3. 异步执行转换 (经准入调度器按成本限制并发)
+                    cost = estimate_conversion_cost(upload["image"], [target_format], upload["size"])
+                    async with conversion_slot(cost, upload["client"], upload.get("background", False)):
+                        logger.info("获取并发许可，开始图像处理 (引擎: %s)", engine)
+                        if engine == "pillow":
+                            pillow_started = time.monotonic()
+                            try:
+                                await asyncio.wait_for(
+                                    asyncio.get_running_loop().run_in_executor(
+                                        fast_path_executor,
+                                        convert_with_pillow,
+                                        input_path, output_path, target_format, mode, setting, resize,
+                                    ),
+                                    timeout=TIMEOUT_SECONDS
+                                )
+                            except (OSError, ValueError) as exc:
+                                # Pillow 无法处理的个别文件回退到 magick CLI
+                                logger.warning("Pillow 转换失败，回退到 magick: %s", exc)
+                                engine = "magick"
+                            finally:
+                                metrics.observe(
+                                    "imagemagick_api_command_seconds", time.monotonic() - pillow_started,
+                                    tool="pillow", **labels
+                                )
+                                trace_step(
+                                    "pillow", time.monotonic() - pillow_started,
+                                    f"pillow {target_format} {mode} {setting} resize={resize}"
+                                )
+                        if engine == "magick-sharded":
+                            await run_sharded_animation(
+                                input_path, output_path, temp_dir, target_format, mode, setting, resize
+                            )
+                        elif engine == "magick-sequence":
+                            await run_sequence_animation(
+                                input_path, output_path, temp_dir, upload["image"], target_format, mode, setting, resize
+                            )
+                        elif engine == "magick":
+                            await run_conversion_commands(commands)
+
+                    if os.path.exists(output_path):
+                        try:
+                            await asyncio.to_thread(conversion_cache.store, cache_key, output_path)
+                        except OSError as exc:
+                            logger.warning("写入转换缓存失败: %s", exc)
+        logger.info("转换缓存%s: %s", "命中" if cache_status == "HIT" else "未命中", cache_key)
+        metrics.inc("imagemagick_api_cache_requests_total", result=cache_status)
+
+        # 4. 检查命令执行结果
+        if not os.path.exists(output_path):
+            error_message = "转换命令成功执行，但未找到输出文件。"
+            logger.error(error_message)
+            raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+
+        # 5. 成功：准备并返回文件响应
+        logger.info(f"转换成功。输出文件: '{output_path}'")
+        
+        original_filename_base = os.path.splitext(upload["filename"])[0]
+        download_filename = f"{original_filename_base}.{target_format}"
+        
+        # 动态设置 MimeType
+        media_type = f"image/{target_format}"
+        if target_format == "heif":
+            media_type = "image/heif" # HEIF 的 MimeType
+
+        # 动图转 AVIF/HEIF：标明输出的是完整序列还是（缺少序列编码器时的）第一帧
+        animation = None
+        if target_format in ["avif", "heif"] and upload["image"] is not None and upload["image"]["animated"]:
+            animation = "sequence" if engine == "magick-sequence" else "first-frame"
+
+        metrics.inc("imagemagick_api_output_bytes_total", os.path.getsize(output_path), **labels)
+        status_code = 200
+        succeeded = True
+
+        return {
+            "output_path": output_path,
+            "media_type": media_type,
+            "filename": download_filename,
+            "engine": engine,
+            "cache_status": cache_status,
+            "animation": animation,
+        }
+
+    except asyncio.TimeoutError:
+        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {upload['filename']}")
+        status_code = 504
+        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
+    except asyncio.CancelledError:
+        # 客户端断开或任务被取消：编码进程已被终止，按 499 记录指标
+        status_code = CLIENT_CLOSED_REQUEST
+        raise
+    except HTTPException as http_exc:
+        # 重新抛出已知的 HTTP 异常
+        status_code = http_exc.status_code
+        raise http_exc
+    except Exception as e:
+        # 捕获所有其他意外错误
+        logger.error(f"发生意外错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        # 内存文件系统中的中间文件不需要随响应保留，立即清理
+        if scratch_dir != temp_dir:
+            cleanup_temp_dir(scratch_dir)
+        # 失败或取消时立即清理；成功时由调用方在响应发送后清理
+        if not succeeded and os.path.exists(temp_dir):
+            cleanup_temp_dir(temp_dir)
+        metrics.observe(
+            "imagemagick_api_request_seconds", time.monotonic() - upload["started_at"],
+            status=str(status_code), **labels
+        )
+        metric_labels.reset(labels_token)
+
+# 管道模式：magick 可从 stdin 读取、向 stdout 写出的格式（TIFF、HEIF 等需要可随机访问的文件）
+PIPE_INPUT_FORMATS = ["jpeg", "png", "gif", "webp", "bmp"]
+PIPE_TARGET_FORMATS = ["jpeg", "png", "gif", "webp"]
+PIPE_CHUNK_BYTES = 64 * 1024
+
+def content_disposition(filename: str) -> str:
+    """与 FileResponse 一致的 Content-Disposition（非 ASCII 文件名使用 RFC 5987 编码）。"""
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+async def iterate_file(f):
+    """分块读取已打开的文件并在结束后关闭，用于 StreamingResponse。"""
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, PIPE_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+async def stream_magick_pipe(command: list, data: bytes, cost: float, client: str, cache_key: str, labels: dict):
+    """
+    在准入许可内运行一条管道命令：上传内容写入 stdin，stdout 分块产出。
+
+    异步生成器的第一次迭代会一直执行到拿到第一个输出块，因此排队 429、进程
+    启动失败或输出前的转换错误都以 HTTPException 抛给调用方，尚未发送响应头。
+    之后按客户端的读取速度从 stdout 读取：客户端变慢时管道写满，magick 随之
+    阻塞（背压）。输出同时写入缓存暂存文件，进程成功结束后才发布为缓存条目。
+    迭代中止（客户端断开、超时）时终止进程并释放许可。
+    """
+    async with conversion_slot(cost, client):
+        command = with_thread_options(command)
+        logger.info("正在执行管道命令: %s", ' '.join(command))
+        command_started = time.monotonic()
+        deadline = command_started + TIMEOUT_SECONDS
+        process = SupervisedProcess(command)
+        try:
+            await process.start(input_data=data, capture_stdout=True)
+        except OSError as exc:
+            logger.error("无法启动图像转换进程: %s", exc)
+            raise HTTPException(
+                status_code=503,
+                detail="Image conversion dependency is unavailable."
+            ) from exc
+
+        stderr_reader = asyncio.ensure_future(process.stderr.read())
+        staging = None
+        output_bytes = 0
+        completed = False
+        try:
+            chunk = await asyncio.wait_for(process.stdout.read(PIPE_CHUNK_BYTES), timeout=TIMEOUT_SECONDS)
+            if chunk:
+                staging = await asyncio.to_thread(conversion_cache.open_staging, cache_key)
+            while chunk:
+                output_bytes += len(chunk)
+                if staging is not None:
+                    staging[1].write(chunk)
+                yield chunk
+                chunk = await asyncio.wait_for(
+                    process.stdout.read(PIPE_CHUNK_BYTES), timeout=max(0.0, deadline - time.monotonic())
+                )
+            await asyncio.wait_for(process.wait(), timeout=max(0.0, deadline - time.monotonic()))
+            stderr = await stderr_reader
+            if process.returncode != 0:
+                logger.error("Image conversion command failed: %s", stderr.decode(errors="replace"))
+                raise HTTPException(
+                    status_code=500,
+                    detail="Image conversion failed. Please check your input file and parameters."
+                )
+            if output_bytes == 0:
+                logger.error("管道命令成功执行，但没有输出。")
+                raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+            completed = True
+        finally:
+            if process.returncode is None:
+                # 超时、客户端断开或任务被取消时结束整个进程组并回收，避免其继续占用 CPU
+                await process.terminate()
+            stderr_reader.cancel()
+            metrics.observe(
+                "imagemagick_api_command_seconds", time.monotonic() - command_started,
+                tool="magick", **labels
+            )
+            if staging is not None:
+                staging[1].close()
+                if completed:
+                    try:
+                        await asyncio.to_thread(conversion_cache.commit, cache_key, staging[0])
+                    except OSError as exc:
+                        logger.warning("写入转换缓存失败: %s", exc)
+                else:
+                    os.unlink(staging[0])
+            metrics.inc("imagemagick_api_output_bytes_total", output_bytes, **labels)
+
+async def run_pipe_conversion(
+    upload: dict,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> Optional[Response]:
+    """
+    管道模式转换：内存中的上传经 stdin 交给 magick，stdout 以 StreamingResponse
+    流式返回；Pillow 引擎直接在内存中完成。整个过程不创建会话目录。
+
+    输入或目标格式需要可随机访问的文件（TIFF、HEIF/AVIF 等）、以及分片编码
+    的大型动图返回 None，由调用方调用 materialize_upload() 后走文件路径。
+    缓存命中时直接从缓存条目流式发送。管道模式不参与 single-flight：输入
+    不超过 PIPE_MAX_MB，重复转换的代价低于让相同请求等待整个响应发送完成。
+    """
+    image = upload["image"]
+    if (
+        target_format not in PIPE_TARGET_FORMATS
+        or image is None
+        or image["format"] not in PIPE_INPUT_FORMATS
+    ):
+        return None
+    engine = await asyncio.to_thread(select_conversion_engine, io.BytesIO(upload["data"]), image, target_format)
+    if engine not in ["pillow", "magick"]:
+        return None
+
+    logger.info(f"开始管道转换: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+    labels = {"target_format": target_format, "mode": mode}
+    labels_token = metric_labels.set(labels)
+    status_code = 500
+    streaming = False
+    record_upload_metrics(upload, labels)
+    filename = f"{os.path.splitext(upload['filename'])[0]}.{target_format}"
+    media_type = f"image/{target_format}"
+
+    def finish(status: int) -> None:
+        metrics.observe(
+            "imagemagick_api_request_seconds", time.monotonic() - upload["started_at"],
+            status=str(status), **labels
+        )
+
+    try:
+        await capability_probe.get()
+        require_conversion_capabilities([target_format])
+        encoder_versions = await get_encoder_versions()
+        cache_key = conversion_cache_key(upload, target_format, mode, setting, resize, engine, encoder_versions)
+
+        cached = await asyncio.to_thread(conversion_cache.open_entry, cache_key)
+        metrics.inc("imagemagick_api_cache_requests_total", result="HIT" if cached is not None else "MISS")
+        if cached is not None:
+            logger.info("转换缓存命中: %s", cache_key)
+            metrics.inc("imagemagick_api_output_bytes_total", os.fstat(cached.fileno()).st_size, **labels)
+            status_code = 200
+            return StreamingResponse(
+                iterate_file(cached),
+                media_type=media_type,
+                headers={
+                    "Content-Disposition": content_disposition(filename),
+                    "Content-Length": str(os.fstat(cached.fileno()).st_size),
+                    "X-Cache": "HIT",
+                    "X-Conversion-Engine": engine,
+                }
+            )
+
+        cost = estimate_conversion_cost(image, [target_format], upload["size"])
+        if engine == "pillow":
+            output = io.BytesIO()
+            async with conversion_slot(cost, upload["client"]):
+                pillow_started = time.monotonic()
+                try:
+                    await asyncio.wait_for(
+                        asyncio.get_running_loop().run_in_executor(
+                            fast_path_executor,
+                            convert_with_pillow,
+                            io.BytesIO(upload["data"]), output, target_format, mode, setting, resize,
+                        ),
+                        timeout=TIMEOUT_SECONDS
+                    )
+                except (OSError, ValueError) as exc:
+                    logger.warning("Pillow 转换失败，回退到 magick: %s", exc)
+                    engine = "magick"
+                finally:
+                    metrics.observe(
+                        "imagemagick_api_command_seconds", time.monotonic() - pillow_started,
+                        tool="pillow", **labels
+                    )
+                    trace_step(
+                        "pillow", time.monotonic() - pillow_started,
+                        f"pillow {target_format} {mode} {setting} resize={resize}"
+                    )
+            if engine == "pillow":
+                content = output.getvalue()
+                try:
+                    await asyncio.to_thread(conversion_cache.store_bytes, cache_key, content)
+                except OSError as exc:
+                    logger.warning("写入转换缓存失败: %s", exc)
+                metrics.inc("imagemagick_api_output_bytes_total", len(content), **labels)
+                status_code = 200
+                return Response(
+                    content=content,
+                    media_type=media_type,
+                    headers={
+                        "Content-Disposition": content_disposition(filename),
+                        "X-Cache": "MISS",
+                        "X-Conversion-Engine": "pillow",
+                    }
+                )
+
+        builder = build_animated_command if image["animated"] else build_static_command
+        command = builder(
+            f"{image['format']}:-", f"{target_format}:-", image, target_format, mode, setting, resize
+        )
+        chunks = stream_magick_pipe(command, upload["data"], cost, upload["client"], cache_key, labels)
+        first_chunk = await chunks.__anext__()
+
+        async def body():
+            body_status = 500
+            try:
+                yield first_chunk
+                async for chunk in chunks:
+                    yield chunk
+                body_status = 200
+            finally:
+                await chunks.aclose()
+                finish(body_status)
+
+        status_code = 200
+        streaming = True
+        return StreamingResponse(
+            body(),
+            media_type=media_type,
+            headers={
+                "Content-Disposition": content_disposition(filename),
+                "X-Cache": "MISS",
+                "X-Conversion-Engine": "magick-pipe",
+            }
+        )
+
+    except asyncio.TimeoutError:
+        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {upload['filename']}")
+        status_code = 504
+        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
+    except asyncio.CancelledError:
+        # 客户端断开或任务被取消：编码进程已被终止，按 499 记录指标
+        status_code = CLIENT_CLOSED_REQUEST
+        raise
+    except HTTPException as http_exc:
+        status_code = http_exc.status_code
+        raise http_exc
+    except Exception as e:
+        logger.error(f"发生意外错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        if not streaming:
+            finish(status_code)
+        metric_labels.reset(labels_token)
+
+async def wait_for_disconnect(request: Request) -> None:
+    """在请求体读完之后等待客户端断开（ASGI http.disconnect 消息）。"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def cancel_on_disconnect(request: Request, conversion) -> Response:
+    """
+    执行转换协程；客户端在响应前断开时取消它。
+
+    取消会终止正在运行的编码进程组并释放准入许可，不再为已离开的客户端继续编码。
+    流式响应开始后的断开由 StreamingResponse 自身处理（见 stream_magick_pipe）。
+    按 trace_requested() 启用追踪时，成功的响应带 Server-Timing 与 X-Conversion-Stats。
+
+    Raises:
+        HTTPException: 499，客户端已断开（响应不会被送达，仅用于日志与指标）
+    """
+    # 追踪对象在创建转换任务之前放入上下文，任务复制上下文后与本函数共享同一个对象
+    trace = ConversionTrace() if trace_requested(request) else None
+    conversion_trace.set(trace)
+    task = asyncio.ensure_future(conversion)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if not task.done():
+            task.cancel()
+        watcher.cancel()
+        await asyncio.gather(task, watcher, return_exceptions=True)
+    if task.cancelled():
+        logger.warning("客户端在响应前断开，已取消转换: %s", request.url.path)
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request.")
+    response = task.result()
+    if trace is not None:
+        await trace.apply(response)
+    return response
+
+async def _perform_conversion(
+    background_tasks: BackgroundTasks,
+    upload: dict,
+    target_format: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None,
+    quality_target: Optional[dict] = None
+) -> Response:
+    """
+    执行转换并以文件响应返回（同步端点使用）。
+
+    Args:
+        background_tasks: FastAPI后台任务对象（响应发送后清理会话目录）
+        upload: receive_upload() 的结果
+        target_format: 目标格式
+        mode: 转换模式
+        setting: 质量/压缩参数；给出 quality_target 时为搜索的质量上限
+        resize: parse_resize_options() 的结果
+        quality_target: parse_quality_target() 的结果，给出时按目标大小/画质搜索质量
+
+    Returns:
+        Response: 转换后的图像（管道模式为流式响应，否则为 FileResponse）
+    """
+    if quality_target is not None:
+        if upload["data"] is not None:
+            await asyncio.to_thread(materialize_upload, upload)
+        result = await run_quality_search(upload, target_format, setting, resize, quality_target)
+        background_tasks.add_task(cleanup_temp_dir, upload["temp_dir"])
+        return FileResponse(
+            path=result["output_path"],
+            media_type=result["media_type"],
+            filename=result["filename"],
+            headers={
+                "X-Cache": result["cache_status"],
+                "X-Conversion-Engine": result["engine"],
+                **quality_search_headers(result["search"]),
+            }
+        )
+    if upload["data"] is not None:
+        response = await run_pipe_conversion(upload, target_format, mode, setting, resize)
+        if response is not None:
+            return response
+        await asyncio.to_thread(materialize_upload, upload)
+    result = await run_conversion(upload, target_format, mode, setting, resize)
+    background_tasks.add_task(cleanup_temp_dir, upload["temp_dir"])
+    headers = {"X-Cache": result["cache_status"], "X-Conversion-Engine": result["engine"]}
+    if result["animation"] is not None:
+        headers["X-Animation"] = result["animation"]
+    return FileResponse(
+        path=result["output_path"],
+        media_type=result["media_type"],
+        filename=result["filename"],
+        headers=headers
+    )
+
+@app.post(
+    "/",
+    response_class=FileResponse,
+    summary="简化上传转换",
+    openapi_extra=multipart_openapi({
+        "target_format": {"type": "string", "default": "heif", "description": "目标格式；auto 按 Accept 请求头协商"},
+        "mode": {"type": "string", "default": "lossless", "description": "转换模式"},
+        "setting": {"type": "integer", "default": 0, "minimum": 0, "maximum": 100, "description": "质量参数"},
+        "width": {"type": "integer", "minimum": 1, "maximum": MAX_RESIZE_DIMENSION, "description": "缩放目标宽度（可选）"},
+        "height": {"type": "integer", "minimum": 1, "maximum": MAX_RESIZE_DIMENSION, "description": "缩放目标高度（可选）"},
+        "fit": {"type": "string", "enum": list(get_args(ResizeFit)), "default": "contain", "description": "缩放适配方式"},
+        "thumbnail": {"type": "boolean", "default": False, "description": "缩略图模式（更快，去除元数据）"},
+        "max_bytes": {"type": "integer", "minimum": 1, "description": "输出字节预算：搜索不超过预算的最高质量（可选）"},
+        "min_ssim": {"type": "number", "exclusiveMinimum": 0, "maximum": 1, "description": "最低 SSIM：搜索满足阈值的最低质量（可选）"},
+    })
+)
+async def upload_convert(request: Request, background_tasks: BackgroundTasks):
+    """
+    通过HTML表单上传并转换图像。
+
+    这个端点接收表单数据（而非URL路径参数），适合从网页表单调用。
+    内部调用与 /convert/{format}/{mode}/{setting} 相同的转换逻辑。
+
+    - **file**: 图像文件
+    - **target_format**: 目标格式 (avif, webp, jpeg, png, gif, heif, auto)，默认 webp
+    - **mode**: 转换模式 (lossy, lossless)，默认 lossy
+    - **setting**: 质量/压缩参数 (0-100)，默认 80
+    - **width** / **height** / **fit** / **thumbnail**: 可选缩放参数，含义同 /convert 的查询参数
+    - **max_bytes** / **min_ssim**: 可选质量搜索目标，含义同 /convert 的查询参数
+    """
+    # 表单字段可能位于文件之后，因此先流式接收整个请求体再验证参数；
+    # 此时还不知道目标格式，小文件一律先留在内存中，不适用管道时再落盘
+    upload = await receive_upload(request, memory_limit=int(PIPE_MAX_MB * 1024 * 1024))
+    fields = upload["fields"]
+    target_format = fields.get("target_format", "heif")
+    mode = fields.get("mode", "lossless")
+
+    try:
+        # 验证参数
+        valid_formats = list(get_args(NegotiableFormat))
+        if target_format not in valid_formats:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid target_format: {target_format}. Must be one of {valid_formats}"
+            )
+
+        valid_modes = ["lossy", "lossless"]
+        if mode not in valid_modes:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid mode: {mode}. Must be one of {valid_modes}"
+            )
+
+        try:
+            setting = int(fields.get("setting", "0"))
+        except ValueError:
+            setting = -1
+        if not (0 <= setting <= 100):
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid setting: {fields.get('setting')}. Must be between 0 and 100"
+            )
+
+        resize = parse_resize_options(
+            parse_dimension(fields.get("width"), "width"),
+            parse_dimension(fields.get("height"), "height"),
+            fields.get("fit") or "contain",
+            fields.get("thumbnail", "").lower() in ["1", "true", "on", "yes"],
+        )
+
+        max_bytes = min_ssim = None
+        if fields.get("max_bytes"):
+            try:
+                max_bytes = int(fields["max_bytes"])
+            except ValueError:
+                max_bytes = 0
+            if max_bytes < 1:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Invalid max_bytes: {fields['max_bytes']}. Must be a positive integer"
+                )
+        if fields.get("min_ssim"):
+            try:
+                min_ssim = float(fields["min_ssim"])
+            except ValueError:
+                min_ssim = 0.0
+            if not (0 < min_ssim <= 1):
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Invalid min_ssim: {fields['min_ssim']}. Must be greater than 0 and at most 1"
+                )
+        quality_target = parse_quality_target(target_format, mode, max_bytes, min_ssim)
+    except HTTPException:
+        cleanup_temp_dir(upload["temp_dir"])
+        raise
+
+    logger.info(f"收到表单上传请求: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+
+    if target_format == "auto":
+        return await cancel_on_disconnect(request, _perform_auto_conversion(
+            background_tasks, upload, request.headers.get("accept", ""), mode, setting, resize
+        ))
+
+    # 调用核心转换逻辑
+    return await cancel_on_disconnect(request, _perform_conversion(
+        background_tasks=background_tasks,
+        upload=upload,
+        target_format=target_format,
+        mode=mode,
+        setting=setting,
+        resize=resize,
+        quality_target=quality_target
+    ))
+
+# --- 5a. 按 Accept 协商输出格式 ---
+
+# auto 候选的优先顺序（通常压缩率从高到低）；HEIF 浏览器不支持，不参与协商
+AUTO_PREFERRED_FORMATS = ["avif", "webp"]
+
+# auto 模式下 setting 按 JPEG 质量理解，换算为各编码器主观质量相近的设置
+AUTO_QUALITY_SCALE = {"avif": 0.8, "webp": 1.0, "jpeg": 1.0}
+
+def parse_accept(accept: str) -> dict:
+    """解析 Accept 请求头，返回 {媒体类型: q 值}（媒体类型小写，不含其余参数）。"""
+    accepted = {}
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = max(0.0, min(1.0, float(value)))
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.lower()] = max(quality, accepted.get(media_type.lower(), 0.0))
+    return accepted
+
+def negotiate_formats(accept: str, image: Optional[dict], mode: str) -> list:
+    """
+    按 Accept 请求头和输入特征给出 auto 目标的候选格式，首选在前。
+
+    只有客户端显式声明（q > 0）的现代格式才会成为候选，按 q 值、再按
+    AUTO_PREFERRED_FORMATS 排序；没有序列编码器时 AVIF 只能编码第一帧，动图不参与。
+    最后总是追加一个通用格式作为兜底：动图为 GIF，可能带透明通道或
+    无损模式为 PNG，其余为 JPEG。编码能力缺失的格式被剔除。
+    """
+    accepted = parse_accept(accept or "")
+    animated = image is not None and image["animated"]
+    candidates = []
+    for target_format in AUTO_PREFERRED_FORMATS:
+        if accepted.get(f"image/{target_format}", 0.0) <= 0:
+            continue
+        if target_format == "avif" and animated and capability_probe.sequence_encoder("avif") is None:
+            continue
+        candidates.append(target_format)
+    candidates.sort(key=lambda f: -accepted[f"image/{f}"])
+
+    has_alpha = (
+        image is None
+        or image["channels"] in (2, 4)
+        or (image["channels"] is None and image["format"] != "jpeg")
+    )
+    if animated:
+        candidates.append("gif")
+    elif has_alpha or mode == "lossless":
+        candidates.append("png")
+    else:
+        candidates.append("jpeg")
+
+    def available(target_format: str) -> bool:
+        if target_format in ["avif", "heif"]:
+            return capability_probe.has("heif-enc")
+        return capability_probe.can_write(target_format)
+
+    return [f for f in candidates if available(f)]
+
+def equivalent_setting(target_format: str, mode: str, setting: int) -> int:
+    """把 auto 请求的 setting（JPEG 质量尺度）换算为目标编码器的设置；无损模式原样使用。"""
+    if mode == "lossless":
+        return setting
+    return max(1, min(100, round(setting * AUTO_QUALITY_SCALE.get(target_format, 1.0))))
+
+async def _perform_auto_conversion(
+    background_tasks: BackgroundTasks,
+    upload: dict,
+    accept: str,
+    mode: str,
+    setting: int,
+    resize: Optional[dict] = None
+) -> Response:
+    """
+    target_format=auto：按 Accept 协商候选格式，编码前 AUTO_CANDIDATES 个并返回最小的结果。
+
+    只有一个候选时等同于普通转换（可走管道、Pillow 与缓存）。多个候选时共用
+    一次解码（与 /renditions 相同的 mpr: 寄存器命令），在一个准入许可内并行
+    执行各编码器，每个候选的结果独立写入转换缓存，再次请求时直接比较缓存结果。
+    响应总是带 Vary: Accept，X-Auto-Candidates 列出各候选的字节数。
+    """
+    await capability_probe.get()
+    candidates = negotiate_formats(accept, upload["image"], mode)[:max(1, AUTO_CANDIDATES)]
+    if not candidates:
+        cleanup_temp_dir(upload["temp_dir"])
+        raise HTTPException(status_code=503, detail="No output format is available for this input.")
+    logger.info("auto 协商候选格式: %s (Accept: %s)", candidates, accept)
+
+    if len(candidates) == 1:
+        response = await _perform_conversion(
+            background_tasks=background_tasks,
+            upload=upload,
+            target_format=candidates[0],
+            mode=mode,
+            setting=equivalent_setting(candidates[0], mode, setting),
+            resize=resize
+        )
+        response.headers["Vary"] = "Accept"
+        return response
+
+    await asyncio.to_thread(materialize_upload, upload)
+    temp_dir = upload["temp_dir"]
+    scratch_dir = temp_dir
+    cleanup_scheduled = False
+    input_path = upload["input_path"]
+    labels = {"target_format": "auto", "mode": mode}
+    labels_token = metric_labels.set(labels)
+    status_code = 500
+    record_upload_metrics(upload, labels)
+
+    try:
+        encoder_versions = await get_encoder_versions()
+        animated = upload["image"] is not None and upload["image"]["animated"]
+        outputs = []
+        for target_format in candidates:
+            candidate_setting = equivalent_setting(target_format, mode, setting)
+            params = {"target_format": target_format, "mode": mode, "setting": candidate_setting, "resize": resize}
+            # 动图的 AVIF/HEIF 候选编码为完整序列（协商时已确认有序列编码器），与 /renditions 的第一帧结果区分
+            sequence = animated and target_format in ["avif", "heif"]
+            if sequence:
+                params["animation"] = "sequence"
+            outputs.append({
+                "target_format": target_format,
+                "mode": mode,
+                "setting": candidate_setting,
+                "resize": resize,
+                "sequence": sequence,
+                "output_path": os.path.join(temp_dir, f"output-auto.{target_format}"),
+                # 与 /renditions 使用相同的键，两者的单次解码结果可以互相复用
+                "cache_key": conversion_cache.make_key(upload["sha256"], params, encoder_versions),
+            })
+
+        misses = [o for o in outputs if not conversion_cache.fetch(o["cache_key"], o["output_path"])]
+        metrics.inc("imagemagick_api_cache_requests_total", len(outputs) - len(misses), result="HIT")
+        metrics.inc("imagemagick_api_cache_requests_total", len(misses), result="MISS")
+
+        if misses:
+            sequence_misses = [o for o in misses if o["sequence"]]
+            rendition_misses = [o for o in misses if not o["sequence"]]
+            if any(
+                o["target_format"] in ["avif", "heif"] and (resize is not None or not heif_enc_reads_directly(input_path))
+                for o in rendition_misses
+            ):
+                scratch_dir = create_scratch_dir(temp_dir, estimate_decoded_bytes(input_path))
+            commands = build_rendition_commands(input_path, scratch_dir, rendition_misses) if rendition_misses else []
+            # 第一条 magick 命令写出全部非 AVIF/HEIF 结果（及 heif-enc 的中间文件）；
+            # heif-enc 直接读取输入时与之没有依赖，所有编码器同时运行
+            magick_commands = [c for c in commands if os.path.basename(c[0]) == "magick"]
+            heif_commands = [c for c in commands if os.path.basename(c[0]) == "heif-enc"]
+            independent = all(c[-1] == input_path for c in heif_commands)
+            cost = estimate_conversion_cost(upload["image"], [o["target_format"] for o in misses], upload["size"])
+            async with conversion_slot(cost, upload["client"]):
+                logger.info("获取并发许可，开始 auto 候选编码: %s", [o["target_format"] for o in misses])
+                if independent:
+                    groups = [[c] for c in magick_commands + heif_commands]
+                else:
+                    await run_conversion_commands(magick_commands)
+                    groups = [[c] for c in heif_commands]
+                # 并行的编码进程（含动图序列）平分本次许可分配的线程数
+                threads = conversion_threads.get()
+                if threads is not None and groups + sequence_misses:
+                    conversion_threads.set(max(1, threads // len(groups + sequence_misses)))
+                await run_in_parallel(
+                    [run_conversion_commands(group) for group in groups]
+                    + [
+                        run_sequence_animation(
+                            input_path, o["output_path"], temp_dir, upload["image"],
+                            o["target_format"], mode, o["setting"], resize,
+                        )
+                        for o in sequence_misses
+                    ]
+                )
+
+            for output in misses:
+                if not os.path.exists(output["output_path"]):
+                    logger.error("auto 候选未生成输出: %s", output["target_format"])
+                    raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+                try:
+                    await asyncio.to_thread(conversion_cache.store, output["cache_key"], output["output_path"])
+                except OSError as exc:
+                    logger.warning("写入转换缓存失败: %s", exc)
+
+        sizes = {o["target_format"]: os.path.getsize(o["output_path"]) for o in outputs}
+        # 大小相同时取协商顺序靠前的格式
+        best = min(outputs, key=lambda o: (sizes[o["target_format"]], candidates.index(o["target_format"])))
+        logger.info("auto 选择 %s: %s", best["target_format"], sizes)
+
+        background_tasks.add_task(cleanup_temp_dir, temp_dir)
+        cleanup_scheduled = True
+        metrics.inc("imagemagick_api_output_bytes_total", sizes[best["target_format"]], **labels)
+        status_code = 200
+        media_type = "image/heif" if best["target_format"] == "heif" else f"image/{best['target_format']}"
+        return FileResponse(
+            path=best["output_path"],
+            media_type=media_type,
+            filename=f"{os.path.splitext(upload['filename'])[0]}.{best['target_format']}",
+            headers={
+                "Vary": "Accept",
+                "X-Cache": "MISS" if misses else "HIT",
+                "X-Conversion-Engine": "magick",
+                "X-Auto-Candidates": ", ".join(f"{f}={size}" for f, size in sizes.items()),
+            }
+        )
+
+    except asyncio.TimeoutError:
+        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {upload['filename']}")
+        status_code = 504
+        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
+    except asyncio.CancelledError:
+        # 客户端断开或任务被取消：编码进程已被终止，按 499 记录指标
+        status_code = CLIENT_CLOSED_REQUEST
+        raise
+    except HTTPException as http_exc:
+        status_code = http_exc.status_code
+        raise http_exc
+    except Exception as e:
+        logger.error(f"发生意外错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        if scratch_dir != temp_dir:
+            cleanup_temp_dir(scratch_dir)
+        if not cleanup_scheduled:
+            cleanup_temp_dir(temp_dir)
+        metrics.observe(
+            "imagemagick_api_request_seconds", time.monotonic() - upload["started_at"],
+            status=str(status_code), **labels
+        )
+        metric_labels.reset(labels_token)
+
+@app.post(
+    "/convert/{target_format}/{mode}/{setting}",
+    summary="动态转换图像 (支持动图)",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "转换成功，返回图像文件"},
+        400: {"description": "请求无效（例如文件过大）"},
+        422: {"description": "路径参数验证失败（例如格式不支持）"},
+        429: {"description": "服务器繁忙（排队已满或等待超时），请按 Retry-After 重试"},
+        500: {"description": "服务器内部转换失败"},
+        504: {"description": "转换处理超时"}
+    },
+    openapi_extra=multipart_openapi()
+)
 async def convert_image_dynamic(
+    request: Request,
     background_tasks: BackgroundTasks,
+    target_format: NegotiableFormat,
+    mode: ConversionMode,
+    setting: int = Path(..., ge=0, le=100, description="质量(有损) 或 压缩速度(无损) (0-100)"),
+    width: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标宽度"),
+    height: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标高度"),
+    fit: ResizeFit = Query("contain", description="缩放适配方式"),
+    thumbnail: bool = Query(False, description="缩略图模式（更快，去除元数据）"),
+    max_bytes: Optional[int] = Query(None, ge=1, description="输出字节预算：在 setting 以内搜索不超过预算的最高质量"),
+    min_ssim: Optional[float] = Query(None, gt=0, le=1, description="最低 SSIM：在 setting 以内搜索满足阈值的最低质量")
+):
+    """
+    通过动态 URL 路径接收图像文件，执行转换并返回结果。
+
+    - **target_format**: 目标格式 (avif, webp, jpeg, png, gif, heif)，或 auto（按 Accept 请求头协商，返回最小的候选结果，带 Vary: Accept）
+    - **mode**: 转换模式 (lossless, lossy)
+    - **setting**: 模式设置 (0-100)
+        - mode=lossy: 0=最差质量, 100=最佳质量
+        - mode=lossless: 0=最慢/最佳压缩, 100=最快/最差压缩
+    - **width** / **height**: 可选缩放目标尺寸（只给一个时按比例计算另一个）
+    - **fit**: contain=等比缩小到框内（不放大），cover=等比填满后居中裁剪，fill=拉伸到精确尺寸
+    - **thumbnail**: 使用 -thumbnail（更快，只保留颜色配置文件）；JPEG 输入会在解码阶段缩小
+    - **max_bytes** / **min_ssim**: 按目标搜索质量（仅 lossy，jpeg/webp/avif/heif）。setting 作为质量上限，
+      源图只解码一次，探测点并行编码；所选质量见 X-Quality-Setting 响应头，摘要见 X-Quality-Search
+    """
+    # 路径与查询参数先校验，再流式接收上传文件
+    resize = parse_resize_options(width, height, fit, thumbnail)
+    quality_target = parse_quality_target(target_format, mode, max_bytes, min_ssim)
+    pipe_eligible = target_format in PIPE_TARGET_FORMATS and quality_target is None
+    upload = await receive_upload(request, memory_limit=int(PIPE_MAX_MB * 1024 * 1024) if pipe_eligible else 0)
+    logger.info(f"收到API转换请求: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+
+    if target_format == "auto":
+        return await cancel_on_disconnect(request, _perform_auto_conversion(
+            background_tasks, upload, request.headers.get("accept", ""), mode, setting, resize
+        ))
+
+    # 调用核心转换逻辑
+    return await cancel_on_disconnect(request, _perform_conversion(
+        background_tasks=background_tasks,
+        upload=upload,
+        target_format=target_format,
+        mode=mode,
+        setting=setting,
+        resize=resize,
+        quality_target=quality_target
+    ))
+
+def parse_rendition_specs(specs: str) -> list:
+    """
+    解析 "format/mode/setting[/size]" 形式、以逗号或空白分隔的版本列表。
+
+    size 可选，取 "WxH"、"W" 或 "xH"。重复项会被合并；非法项以 422 拒绝。
+
+    Args:
+        specs: 例如 "avif/lossy/60, webp/lossy/80/1024, jpeg/lossy/85/320x320"
+
+    Returns:
+        (target_format, mode, setting, width, height) 元组列表，保持请求顺序；
+        未指定尺寸时 width 与 height 为 None
+    """
+    valid_formats = list(get_args(TargetFormat))
+    valid_modes = list(get_args(ConversionMode))
+    parsed = []
+    for item in specs.replace(",", " ").split():
+        parts = item.strip().lower().split("/")
+        if len(parts) not in [3, 4] or parts[0] not in valid_formats or parts[1] not in valid_modes:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid rendition spec: {item}. Expected format/mode/setting[/size], "
+                       f"format in {valid_formats}, mode in {valid_modes}"
+            )
+        try:
+            setting = int(parts[2])
+        except ValueError:
+            setting = -1
+        if not (0 <= setting <= 100):
+            raise HTTPException(
+                status_code=422,
+                detail=f"Invalid rendition spec: {item}. Setting must be between 0 and 100"
+            )
+        width = height = None
+        if len(parts) == 4:
+            width_text, _, height_text = parts[3].partition("x")
+            width = parse_dimension(width_text, "width")
+            height = parse_dimension(height_text, "height")
+            if width is None and height is None:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Invalid rendition spec: {item}. Size must be WxH, W or xH"
+                )
+        spec = (parts[0], parts[1], setting, width, height)
+        if spec not in parsed:
+            parsed.append(spec)
+
+    if not parsed:
+        raise HTTPException(status_code=422, detail="At least one rendition spec is required.")
+    if len(parsed) > MAX_RENDITIONS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Too many renditions: {len(parsed)}. Maximum is {MAX_RENDITIONS}"
+        )
+    return parsed
+
+async def _perform_renditions(
+    background_tasks: BackgroundTasks,
+    upload: dict,
+    specs: list,
+    fit: str = "contain",
+    thumbnail: bool = False
+) -> FileResponse:
+    """
+    一次上传、一次解码生成多个版本，并以 ZIP 打包返回。
+
+    每个版本仍独立查询/写入转换缓存，只有未命中的版本参与本次解码。
+
+    Args:
+        background_tasks: FastAPI后台任务对象
+        upload: receive_upload() 的结果（本函数负责清理会话目录）
+        specs: parse_rendition_specs() 的结果
+        fit: 所有带尺寸版本共用的缩放适配方式
+        thumbnail: 所有带尺寸版本是否使用缩略图模式
+
+    Returns:
+        FileResponse: 包含全部版本的 ZIP 文件
+    """
+    logger.info(f"开始多版本转换: {len(specs)} 个版本 (文件: {upload['filename']})")
+
+    temp_dir = upload["temp_dir"]
+    scratch_dir = temp_dir
+    cleanup_scheduled = False
+    input_path = upload["input_path"]
+    original_filename_base = os.path.splitext(upload["filename"])[0]
+    # 多版本请求的指标统一归入 renditions 标签，避免按组合产生无界的标签基数
+    labels = {"target_format": "renditions", "mode": "mixed"}
+    labels_token = metric_labels.set(labels)
+    status_code = 500
+    record_upload_metrics(upload, labels)
+
+    try:
+        await capability_probe.get()
+        require_conversion_capabilities([spec[0] for spec in specs])
+
+        encoder_versions = await get_encoder_versions()
+
+        renditions = []
+        for index, (target_format, mode, setting, width, height) in enumerate(specs):
+            resize = parse_resize_options(width, height, fit, thumbnail)
+            size_suffix = "" if resize is None else f"-{width or ''}x{height or ''}"
+            renditions.append({
+                "target_format": target_format,
+                "mode": mode,
+                "setting": setting,
+                "resize": resize,
+                "output_path": os.path.join(temp_dir, f"output-{index}.{target_format}"),
+                "archive_name": f"{original_filename_base}-{target_format}-{mode}-{setting}{size_suffix}.{target_format}",
+                "cache_key": conversion_cache.make_key(
+                    upload["sha256"],
+                    {"target_format": target_format, "mode": mode, "setting": setting, "resize": resize},
+                    encoder_versions,
+                ),
+            })
+
+        misses = [r for r in renditions if not conversion_cache.fetch(r["cache_key"], r["output_path"])]
+        logger.info("多版本转换缓存命中 %d/%d", len(renditions) - len(misses), len(renditions))
+        metrics.inc("imagemagick_api_cache_requests_total", len(renditions) - len(misses), result="HIT")
+        metrics.inc("imagemagick_api_cache_requests_total", len(misses), result="MISS")
+
+        if misses:
+            if any(
+                r["target_format"] in ["avif", "heif"] and (r["resize"] is not None or not heif_enc_reads_directly(input_path))
+                for r in misses
+            ):
+                scratch_dir = create_scratch_dir(temp_dir, estimate_decoded_bytes(input_path))
+            commands = build_rendition_commands(input_path, scratch_dir, misses)
+            cost = estimate_conversion_cost(
+                upload["image"], [r["target_format"] for r in misses], upload["size"]
+            )
+            async with conversion_slot(cost, upload["client"]):
+                logger.info("获取并发许可，开始多版本图像处理")
+                await run_conversion_commands(commands)
+
+            for rendition in misses:
+                if not os.path.exists(rendition["output_path"]):
+                    logger.error("多版本转换未生成输出: %s", rendition["archive_name"])
+                    raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+                try:
+                    await asyncio.to_thread(conversion_cache.store, rendition["cache_key"], rendition["output_path"])
+                except OSError as exc:
+                    logger.warning("写入转换缓存失败: %s", exc)
+
+        # 图像已是压缩格式，ZIP 只做存储不再压缩
+        archive_path = os.path.join(temp_dir, "renditions.zip")
+
+        def write_archive():
+            with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED) as archive:
+                for rendition in renditions:
+                    archive.write(rendition["output_path"], arcname=rendition["archive_name"])
+
+        await asyncio.to_thread(write_archive)
+
+        background_tasks.add_task(cleanup_temp_dir, temp_dir)
+        cleanup_scheduled = True
+        metrics.inc("imagemagick_api_output_bytes_total", os.path.getsize(archive_path), **labels)
+        status_code = 200
+
+        return FileResponse(
+            path=archive_path,
+            media_type="application/zip",
+            filename=f"{original_filename_base}-renditions.zip",
+            headers={"X-Cache": "MISS" if misses else "HIT"}
+        )
+
+    except asyncio.TimeoutError:
+        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {upload['filename']}")
+        status_code = 504
+        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
+    except asyncio.CancelledError:
+        # 客户端断开或任务被取消：编码进程已被终止，按 499 记录指标
+        status_code = CLIENT_CLOSED_REQUEST
+        raise
+    except HTTPException as http_exc:
+        status_code = http_exc.status_code
+        raise http_exc
+    except Exception as e:
+        logger.error(f"发生意外错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        if scratch_dir != temp_dir:
+            cleanup_temp_dir(scratch_dir)
+        if not cleanup_scheduled and os.path.exists(temp_dir):
+            cleanup_temp_dir(temp_dir)
+        metrics.observe(
+            "imagemagick_api_request_seconds", time.monotonic() - upload["started_at"],
+            status=str(status_code), **labels
+        )
+        metric_labels.reset(labels_token)
+
+@app.post(
+    "/renditions",
+    summary="一次上传生成多个版本 (单次解码)",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "转换成功，返回包含全部版本的 ZIP 文件", "content": {"application/zip": {}}},
+        400: {"description": "请求无效（例如文件过大）"},
+        422: {"description": "版本列表无效或超过上限"},
+        429: {"description": "服务器繁忙（排队已满或等待超时），请按 Retry-After 重试"},
+        500: {"description": "服务器内部转换失败"},
+        504: {"description": "转换处理超时"}
+    },
+    openapi_extra=multipart_openapi({
+        "specs": {
+            "type": "string",
+            "description": "逗号分隔的 format/mode/setting[/size] 列表，例如 avif/lossy/60,webp/lossy/80/1024,jpeg/lossy/85/320x320",
+        },
+        "fit": {"type": "string", "enum": list(get_args(ResizeFit)), "default": "contain", "description": "带尺寸版本的缩放适配方式"},
+        "thumbnail": {"type": "boolean", "default": False, "description": "带尺寸版本使用缩略图模式"},
+    })
+)
+async def convert_renditions(request: Request, background_tasks: BackgroundTasks):
+    """
+    上传一次源图，按多个 (format, mode, setting) 生成版本并打包为 ZIP 返回。
+
+    源图只上传、校验和解码一次：ImageMagick 通过 mpr: 内存寄存器为每个
+    版本克隆解码结果，AVIF/HEIF 版本共享同一个 heif-enc 中间文件。
+    带尺寸（第四段 WxH、W 或 xH）的版本按从大到小依次缩放，所有尺寸共用
+    同一次解码。ZIP 内文件名为 `{原文件名}-{format}-{mode}-{setting}[-WxH].{format}`。
+    """
+    upload = await receive_upload(request)
+    fields = upload["fields"]
+    fit = fields.get("fit") or "contain"
+    thumbnail = fields.get("thumbnail", "").lower() in ["1", "true", "on", "yes"]
+    try:
+        parsed_specs = parse_rendition_specs(fields.get("specs", ""))
+        for _, _, _, width, height in parsed_specs:
+            parse_resize_options(width, height, fit, thumbnail)
+    except HTTPException:
+        cleanup_temp_dir(upload["temp_dir"])
+        raise
+    logger.info(f"收到多版本转换请求: {len(parsed_specs)} 个版本 (文件: {upload['filename']})")
+
+    return await cancel_on_disconnect(request, _perform_renditions(
+        background_tasks=background_tasks,
+        upload=upload,
+        specs=parsed_specs,
+        fit=fit,
+        thumbnail=thumbnail
+    ))
+
+# --- 5b. 按目标大小 / 目标画质搜索质量 ---
+
+# 支持质量搜索的目标格式：有损模式下 setting 即编码质量（PNG/GIF 的 setting 是调色板颜色数）
+QUALITY_SEARCH_FORMATS = ["jpeg", "webp", "avif", "heif"]
+# 每轮最多并行探测的质量点数；实际取本次许可分配的线程数
+QUALITY_SEARCH_MAX_PROBES = 4
+METRIC_VALUE_PATTERN = re.compile(rb"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+def parse_quality_target(
+    target_format: str,
+    mode: str,
+    max_bytes: Optional[int],
+    min_ssim: Optional[float]
+) -> Optional[dict]:
+    """
+    组合质量搜索目标；两者都未指定时返回 None（按固定 setting 转换）。
+
+    Returns:
+        {"max_bytes", "min_ssim"} 或 None
+
+    Raises:
+        HTTPException: 422，非有损模式或目标格式不支持按质量搜索
+    """
+    if max_bytes is None and min_ssim is None:
+        return None
+    if mode != "lossy" or target_format not in QUALITY_SEARCH_FORMATS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"max_bytes/min_ssim require mode=lossy and target_format in {QUALITY_SEARCH_FORMATS}"
+        )
+    return {"max_bytes": max_bytes, "min_ssim": min_ssim}
+
+async def measure_ssim(reference_path: str, candidate_path: str) -> float:
+    """
+    用 magick compare 计算候选结果相对参考图的 SSIM（1 表示完全相同）。
+
+    compare 在图像存在差异时以 1 退出，只有 2 及以上（或被信号终止）才是失败；
+    指标写在 stderr。调用方负责获取并发许可。
+    """
+    command = with_thread_options(['magick', 'compare', '-metric', 'SSIM', reference_path, candidate_path, 'null:'])
+    logger.info("正在执行命令: %s", ' '.join(command))
+    command_started = time.monotonic()
+    process = SupervisedProcess(command)
+    try:
+        await process.start()
+    except OSError as exc:
+        logger.error("无法启动图像转换进程: %s", exc)
+        raise HTTPException(
+            status_code=503,
+            detail="Image conversion dependency is unavailable."
+        ) from exc
+    try:
+        stderr = await asyncio.wait_for(process.communicate(), timeout=TIMEOUT_SECONDS)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        await process.terminate()
+        raise
+    finally:
+        metrics.observe(
+            "imagemagick_api_command_seconds", time.monotonic() - command_started,
+            tool="magick", **metric_labels.get()
+        )
+    match = METRIC_VALUE_PATTERN.search(stderr)
+    if process.returncode not in (0, 1) or match is None:
+        logger.error("SSIM 计算失败: %s", stderr.decode(errors="replace"))
+        raise HTTPException(status_code=500, detail="Image quality measurement failed.")
+    return float(match.group())
+
+async def last_passing(low: int, high: int, passes, parallelism: int) -> Optional[int]:
+    """
+    在 [low, high] 中查找单调谓词的边界：passes(q) 在区间前部为真、之后为假，
+    返回最后一个为真的 q；全为假时返回 None。
+
+    每轮把剩余区间等分，并行求值 parallelism 个点（parallelism=1 即二分查找）。
+    结果不严格单调时以第一个为假的点为界，忽略其后为真的点。
+    """
+    best = None
+    while low <= high:
+        count = min(parallelism, high - low + 1)
+        points = sorted({low + (high - low) * (i + 1) // (count + 1) for i in range(count)})
+        tasks = [asyncio.ensure_future(passes(q)) for q in points]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        first_failing = next((q for q, ok in zip(points, results) if not ok), None)
+        passing = [q for q, ok in zip(points, results) if ok and (first_failing is None or q < first_failing)]
+        if passing:
+            best = passing[-1]
+            low = best + 1
+        if first_failing is not None:
+            high = first_failing - 1
+    return best
+
+async def search_quality(
+    input_path: str,
+    work_dir: str,
+    image: Optional[dict],
+    target_format: str,
+    setting: int,
+    resize: Optional[dict],
+    target: dict
+) -> dict:
+    """
+    在 [0, setting] 内搜索满足目标的质量，调用方负责获取并发许可。
+
+    源图只解码（并缩放）一次，写成 MPC 参考图；每个探测点直接从 MPC 编码
+    （AVIF/HEIF 由 heif-enc 读取同一次解码写出的 PNG 中间文件），需要 SSIM 时
+    以该参考图比较。探测点按本次许可的线程数并行，编码进程平分线程。
+
+    - 只给 max_bytes：不超过预算的最高质量
+    - 只给 min_ssim：满足 SSIM 的最低质量（即最小的结果）
+    - 两者都给：先按 SSIM 选取，超出预算时退回预算内的最高质量，并标记目标未满足
+    - 无法满足时返回最接近的结果（预算取最低质量，SSIM 取最高质量），met=False
+
+    Returns:
+        {"setting", "path", "size", "ssim", "probes", "met"}
+    """
+    reference_path = os.path.join(work_dir, "reference.mpc")
+    encoder_input_path = os.path.join(work_dir, "encoder-input.png")
+    heif_target = target_format in ["avif", "heif"]
+    if image is not None and image["format"] == "mpc" and resize is None and not heif_target:
+        # 源图存储中的 MPC 已是解码结果，直接作为参考图
+        reference_path = input_path
+    else:
+        decode = (
+            ['magick'] + build_limit_options(image, [resize]) + build_decode_options(image, resize)
+            + [f'{input_path}[0]'] + build_resize_options(resize)
+        )
+        if heif_target:
+            decode += ['-write', reference_path] + FAST_PNG_DEFINES + [encoder_input_path]
+        else:
+            decode += [reference_path]
+        await run_conversion_commands([decode])
+    reference_image = await asyncio.to_thread(inspect_image, reference_path)
+
+    probes: dict = {}
+    probe_locks: dict = {}
+
+    async def probe(quality: int) -> dict:
+        async with probe_locks.setdefault(quality, asyncio.Lock()):
+            if quality not in probes:
+                output_path = os.path.join(work_dir, f"probe-{quality:03d}.{target_format}")
+                if heif_target:
+                    command = build_heif_enc_command(target_format, "lossy", quality, encoder_input_path, output_path)
+                else:
+                    command = (
+                        ['magick'] + build_limit_options(reference_image) + [reference_path]
+                        + without_layer_optimization(build_format_options(target_format, "lossy", quality))
+                        + [output_path]
+                    )
+                await run_conversion_commands([command])
+                if not os.path.exists(output_path):
+                    raise HTTPException(status_code=500, detail="Conversion completed but output file not found.")
+                result = {"setting": quality, "path": output_path, "size": os.path.getsize(output_path), "ssim": None}
+                if target["min_ssim"] is not None:
+                    result["ssim"] = await measure_ssim(reference_path, output_path)
+                logger.info("质量探测 %s=%d: %d 字节, SSIM %s", target_format, quality, result["size"], result["ssim"])
+                probes[quality] = result
+        return probes[quality]
+
+    async def below_ssim(quality: int) -> bool:
+        return (await probe(quality))["ssim"] < target["min_ssim"]
+
+    async def within_budget(quality: int) -> bool:
+        return (await probe(quality))["size"] <= target["max_bytes"]
+
+    threads = conversion_threads.get()
+    parallelism = max(1, min(QUALITY_SEARCH_MAX_PROBES, threads or RESOURCE_PLAN["max_threads"] or os.cpu_count() or 1))
+    if threads is not None:
+        conversion_threads.set(max(1, threads // parallelism))
+
+    low, high = 0, setting
+    chosen = None
+    met = True
+    if target["min_ssim"] is not None:
+        # 低于 SSIM 阈值的质量位于区间前部，边界之后第一个点即满足阈值的最低质量
+        failing = await last_passing(low, high, below_ssim, parallelism)
+        chosen = low if failing is None else failing + 1
+        if chosen > high:
+            chosen = high
+            met = False
+    if target["max_bytes"] is not None:
+        if chosen is None or (await probe(chosen))["size"] > target["max_bytes"]:
+            ceiling = high if chosen is None else chosen - 1
+            fitting = await last_passing(low, ceiling, within_budget, parallelism)
+            if chosen is not None:
+                met = False
+            if fitting is None:
+                fitting = low
+                met = False
+            chosen = fitting
+    result = dict(await probe(chosen))
+    result["probes"] = len(probes)
+    result["met"] = met
+    return result
+
+async def run_quality_search(
+    upload: dict,
+    target_format: str,
+    setting: int,
+    resize: Optional[dict],
+    target: dict
+) -> dict:
+    """
+    按目标大小或目标画质选择质量并转换（_perform_conversion 的搜索模式）。
+
+    结果与所选质量分别写入转换缓存（所选质量以 JSON 附属条目保存），
+    重复请求直接命中。会话目录的清理约定与 run_conversion() 相同。
+
+    Returns:
+        run_conversion() 的字段，另加 search（search_quality() 的结果，不含 path）
+    """
+    logger.info(f"开始质量搜索: {target_format}/lossy/<={setting} {target} (文件: {upload['filename']})")
+
+    temp_dir = upload["temp_dir"]
+    scratch_dir = temp_dir
+    succeeded = False
+    input_path = upload["input_path"]
+    output_path = os.path.join(temp_dir, f"output.{target_format}")
+    labels = {"target_format": target_format, "mode": "lossy"}
+    labels_token = metric_labels.set(labels)
+    status_code = 500
+    record_upload_metrics(upload, labels)
+
+    try:
+        await capability_probe.get()
+        require_conversion_capabilities([target_format])
+        if upload["image"] is not None and upload["image"]["animated"]:
+            raise HTTPException(status_code=422, detail="max_bytes/min_ssim only support still images.")
+        # 计算 SSIM 时 magick 需要解码 AVIF/HEIF 候选结果
+        decoder = HEIF_CODERS.get(target_format)
+        if target["min_ssim"] is not None and decoder is not None and not capability_probe.can_read(decoder):
+            raise HTTPException(
+                status_code=503,
+                detail=f"min_ssim is not available for {target_format}: ImageMagick cannot decode {decoder}."
+            )
+
+        encoder_versions = await get_encoder_versions()
+        params = {
+            "target_format": target_format,
+            "mode": "lossy",
+            "setting": setting,
+            "resize": resize,
+            "max_bytes": target["max_bytes"],
+            "min_ssim": target["min_ssim"],
+            "engine": "magick-search",
+        }
+        cache_key = conversion_cache.make_key(upload["sha256"], params, encoder_versions)
+        meta_key = conversion_cache.make_key(upload["sha256"], dict(params, entry="search"), encoder_versions)
+
+        def fetch_cached() -> Optional[dict]:
+            meta_file = conversion_cache.open_entry(meta_key)
+            if meta_file is None:
+                return None
+            with meta_file:
+                search = json.loads(meta_file.read())
+            return search if conversion_cache.fetch(cache_key, output_path) else None
+
+        cache_status = "HIT"
+        search = await asyncio.to_thread(fetch_cached)
+        if search is None:
+            async with conversion_cache.single_flight(cache_key):
+                search = await asyncio.to_thread(fetch_cached)
+                if search is None:
+                    cache_status = "MISS"
+                    # MPC 参考图（每像素 16 字节）与 heif-enc 的 PNG 中间文件优先放在内存文件系统
+                    scratch_dir = create_scratch_dir(temp_dir, estimate_decoded_bytes(input_path) * 5)
+                    parallelism = min(QUALITY_SEARCH_MAX_PROBES, RESOURCE_PLAN["max_threads"] or os.cpu_count() or 1)
+                    cost = estimate_conversion_cost(upload["image"], [target_format] * parallelism, upload["size"])
+                    async with conversion_slot(cost, upload["client"], upload.get("background", False)):
+                        logger.info("获取并发许可，开始质量搜索")
+                        result = await search_quality(
+                            input_path, scratch_dir, upload["image"], target_format, setting, resize, target
+                        )
+                    await asyncio.to_thread(shutil.move, result.pop("path"), output_path)
+                    search = result
+                    try:
+                        await asyncio.to_thread(conversion_cache.store, cache_key, output_path)
+                        await asyncio.to_thread(
+                            conversion_cache.store_bytes, meta_key, json.dumps(search).encode("utf-8")
+                        )
+                    except OSError as exc:
+                        logger.warning("写入转换缓存失败: %s", exc)
+        logger.info("质量搜索%s: 选择 %s=%d (%s)", "命中缓存" if cache_status == "HIT" else "完成",
+                    target_format, search["setting"], search)
+        metrics.inc("imagemagick_api_cache_requests_total", result=cache_status)
+
+        media_type = "image/heif" if target_format == "heif" else f"image/{target_format}"
+        metrics.inc("imagemagick_api_output_bytes_total", os.path.getsize(output_path), **labels)
+        status_code = 200
+        succeeded = True
+        return {
+            "output_path": output_path,
+            "media_type": media_type,
+            "filename": f"{os.path.splitext(upload['filename'])[0]}.{target_format}",
+            "engine": "magick-search",
+            "cache_status": cache_status,
+            "search": search,
+        }
+
+    except asyncio.TimeoutError:
+        logger.error(f"Magick 处理超时 (>{TIMEOUT_SECONDS}s): {upload['filename']}")
+        status_code = 504
+        raise HTTPException(status_code=504, detail=f"Conversion timed out after {TIMEOUT_SECONDS} seconds.")
+    except asyncio.CancelledError:
+        # 客户端断开或任务被取消：编码进程已被终止，按 499 记录指标
+        status_code = CLIENT_CLOSED_REQUEST
+        raise
+    except HTTPException as http_exc:
+        status_code = http_exc.status_code
+        raise http_exc
+    except Exception as e:
+        logger.error(f"发生意外错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        if scratch_dir != temp_dir:
+            cleanup_temp_dir(scratch_dir)
+        if not succeeded and os.path.exists(temp_dir):
+            cleanup_temp_dir(temp_dir)
+        metrics.observe(
+            "imagemagick_api_request_seconds", time.monotonic() - upload["started_at"],
+            status=str(status_code), **labels
+        )
+        metric_labels.reset(labels_token)
+
+def quality_search_headers(search: dict) -> dict:
+    """质量搜索结果的响应头：所选质量与搜索摘要。"""
+    summary = f"probes={search['probes']}, met={'true' if search['met'] else 'false'}, size={search['size']}"
+    if search["ssim"] is not None:
+        summary += f", ssim={search['ssim']:.4f}"
+    return {"X-Quality-Setting": str(search["setting"]), "X-Quality-Search": summary}
+
+# --- 6. 异步任务 API ---
+
+JOB_ACTIVE_STATES = ("queued", "running")
+JOB_ID_PATTERN = "^[0-9a-f]{32}$"
+
+
+class JobStore:
+    """
+    基于本地磁盘的异步转换任务存储，多个 worker 共享。
+
+    - 每个任务一个目录 JOBS_DIR/<job_id>/，状态写在 job.json（原子替换），
+      结果文件与之同目录；任意 worker 都能查询状态与下载结果
+    - 任务由接收上传的 worker 执行，只有该 worker 写 job.json；其他 worker
+      通过创建 cancel 标记文件请求取消，执行方轮询标记后中止转换
+    - 排队与执行中的任务总数受 max_pending 限制（提交时加文件锁计数）
+    - 结束的任务在 ttl 秒后由后台清理；执行 worker 退出后遗留的活动任务
+      在查询或清理时标记为失败
+    """
+
+    def __init__(self, jobs_dir: str, max_pending: int, ttl_seconds: int):
+        self.jobs_dir = jobs_dir
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self.tasks: dict = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def read(self, job_id: str) -> Optional[dict]:
+        """读取任务状态；执行 worker 已退出的活动任务会被标记为失败。"""
+        try:
+            with open(os.path.join(self.job_dir(job_id), "job.json")) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job["status"] in JOB_ACTIVE_STATES and not MetricsRegistry._pid_alive(job["worker_pid"]):
+            job.update(status="failed", error="Worker exited before the job finished.", status_code=500)
+            job["expires_at"] = time.time() + self.ttl_seconds
+            self.write(job)
+        return job
+
+    def write(self, job: dict) -> None:
+        job["updated_at"] = time.time()
+        path = os.path.join(self.job_dir(job["job_id"]), "job.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def _count_pending(self) -> int:
+        pending = 0
+        for job_id in os.listdir(self.jobs_dir):
+            job = self.read(job_id) if os.path.isdir(self.job_dir(job_id)) else None
+            if job is not None and job["status"] in JOB_ACTIVE_STATES:
+                pending += 1
+        return pending
+
+    def create(
+        self,
+        target_format: str,
+        mode: str,
+        setting: int,
+        filename: str,
+        resize: Optional[dict] = None
+    ) -> dict:
+        """
+        登记新任务。
+
+        Raises:
+            HTTPException: 429，排队/执行中的任务已达上限
+        """
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with open(os.path.join(self.jobs_dir, ".submit.lock"), "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._count_pending() >= self.max_pending:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many pending jobs. Please retry later.",
+                    headers={"Retry-After": str(admission_scheduler.retry_after())}
+                )
+            job_id = uuid.uuid4().hex
+            os.makedirs(self.job_dir(job_id))
+            job = {
+                "job_id": job_id,
+                "status": "queued",
+                "stage": "queued",
+                "progress": 0.0,
+                "target_format": target_format,
+                "mode": mode,
+                "setting": setting,
+                "resize": resize,
+                "filename": filename,
+                "worker_pid": os.getpid(),
+                "created_at": time.time(),
+                "expires_at": None,
+                "error": None,
+                "status_code": None,
+                "result": None,
+            }
+            self.write(job)
+        return job
+
+    def request_cancel(self, job_id: str) -> None:
+        """请求取消任务：本 worker 执行的任务直接取消，否则留下标记由执行方处理。"""
+        open(os.path.join(self.job_dir(job_id), "cancel"), "w").close()
+        task = self.tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+
+    async def run(self, job: dict, upload: dict) -> None:
+        """在本 worker 中执行任务，并持续更新 job.json 中的状态与进度。"""
+        job_dir = self.job_dir(job["job_id"])
+        cancel_marker = os.path.join(job_dir, "cancel")
+
+        def on_progress(stage: str, fraction: float) -> None:
+            # 排队 0-0.1，编码 0.1-0.9，收尾 0.9-1.0；进度只增不减
+            progress = 0.05 if stage == "waiting_for_slot" else 0.1 + 0.8 * fraction
+            if stage != job["stage"] or progress > job["progress"]:
+                job["stage"] = stage
+                job["progress"] = round(max(job["progress"], progress), 3)
+                if stage != "waiting_for_slot":
+                    job["status"] = "running"
+                self.write(job)
+
+        conversion_progress.set(on_progress)
+        conversion = asyncio.ensure_future(
+            run_conversion(upload, job["target_format"], job["mode"], job["setting"], job["resize"])
+        )
+        try:
+            while not conversion.done():
+                await asyncio.wait({conversion}, timeout=0.5)
+                if not conversion.done() and os.path.exists(cancel_marker):
+                    conversion.cancel()
+            result = await conversion
+            result_path = os.path.join(job_dir, f"result.{job['target_format']}")
+            os.replace(result["output_path"], result_path)
+            job.update(
+                status="succeeded",
+                stage="done",
+                progress=1.0,
+                result={
+                    "path": result_path,
+                    "size": os.path.getsize(result_path),
+                    "media_type": result["media_type"],
+                    "filename": result["filename"],
+                    "engine": result["engine"],
+                    "cache_status": result["cache_status"],
+                    "animation": result["animation"],
+                },
+            )
+            logger.info("异步任务完成: %s", job["job_id"])
+        except asyncio.CancelledError:
+            if not conversion.done():
+                conversion.cancel()
+                await asyncio.gather(conversion, return_exceptions=True)
+            job.update(status="cancelled", stage="cancelled", error="Job was cancelled.", status_code=None)
+            logger.info("异步任务已取消: %s", job["job_id"])
+        except HTTPException as exc:
+            job.update(status="failed", stage="failed", error=exc.detail, status_code=exc.status_code)
+            logger.warning("异步任务失败: %s (%s)", job["job_id"], exc.detail)
+        except Exception:
+            # 发布结果时的文件系统错误等：任务必须进入终态，否则会一直显示 running 并占用配额
+            job.update(
+                status="failed", stage="failed",
+                error="An unexpected server error occurred.", status_code=500
+            )
+            logger.error("异步任务发生意外错误: %s", job["job_id"], exc_info=True)
+        finally:
+            if os.path.exists(upload["temp_dir"]):
+                cleanup_temp_dir(upload["temp_dir"])
+            job["expires_at"] = time.time() + self.ttl_seconds
+            if os.path.isdir(job_dir):
+                self.write(job)
+            self.tasks.pop(job["job_id"], None)
+
+    def submit(self, job: dict, upload: dict) -> None:
+        self.tasks[job["job_id"]] = asyncio.create_task(self.run(job, upload))
+
+    def sweep(self) -> None:
+        """删除过期任务目录（以及缺少 job.json 的残留目录）。"""
+        if not os.path.isdir(self.jobs_dir):
+            return
+        now = time.time()
+        for job_id in os.listdir(self.jobs_dir):
+            job_dir = self.job_dir(job_id)
+            if not os.path.isdir(job_dir):
+                continue
+            job = self.read(job_id)
+            if job is None:
+                expired = now - os.path.getmtime(job_dir) > self.ttl_seconds
+            else:
+                expired = job["expires_at"] is not None and job["expires_at"] < now
+            if expired:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                logger.info("已清理过期异步任务: %s", job_id)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(min(60, max(1, self.ttl_seconds)))
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as exc:
+                logger.warning("清理异步任务失败: %s", exc)
+
+    async def start(self) -> None:
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        """停止清理任务，并取消本 worker 仍在执行的任务。"""
+        tasks = list(self.tasks.values())
+        if self._sweeper is not None:
+            tasks.append(self._sweeper)
+            self._sweeper = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+job_store = JobStore(JOBS_DIR, JOB_MAX_PENDING, JOB_RESULT_TTL_SECONDS)
+
+def job_status_response(job: dict) -> dict:
+    """任务状态的对外表示（隐藏本地路径）。"""
+    response = {key: value for key, value in job.items() if key not in ("result", "worker_pid")}
+    response["status_url"] = f"/jobs/{job['job_id']}"
+    if job["status"] == "succeeded":
+        response["result_url"] = f"/jobs/{job['job_id']}/result"
+        response["result_size"] = job["result"]["size"]
+        response["media_type"] = job["result"]["media_type"]
+    return response
+
+def get_job_or_404(job_id: str) -> dict:
+    job = job_store.read(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return job
+
+@app.post(
+    "/jobs/{target_format}/{mode}/{setting}",
+    summary="提交异步转换任务",
+    status_code=202,
+    responses={
+        202: {"description": "任务已受理，返回任务 ID 与状态查询地址"},
+        400: {"description": "请求无效（例如文件过大）"},
+        422: {"description": "路径参数验证失败（例如格式不支持）"},
+        429: {"description": "排队/执行中的任务已达上限，请按 Retry-After 重试"},
+    },
+    openapi_extra=multipart_openapi()
+)
+async def submit_job(
+    request: Request,
     target_format: TargetFormat,
     mode: ConversionMode,
+    setting: int = Path(..., ge=0, le=100, description="质量(有损) 或 压缩速度(无损)"),
+    width: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标宽度"),
+    height: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标高度"),
+    fit: ResizeFit = Query("contain", description="缩放适配方式"),
+    thumbnail: bool = Query(False, description="缩略图模式（更快，去除元数据）")
+):
+    """
+    上传文件并创建异步转换任务，立即返回 202。
+
+    转换逻辑与缩放参数与 `/convert/{target_format}/{mode}/{setting}` 完全相同，适合耗时较长的
+    大型动图：客户端无需保持长连接，可通过 `GET /jobs/{job_id}` 轮询状态和进度，
+    完成后从 `GET /jobs/{job_id}/result` 下载结果，或用 `DELETE /jobs/{job_id}` 取消。
+    """
+    resize = parse_resize_options(width, height, fit, thumbnail)
+    upload = await receive_upload(request, ram_staging=False)
+    upload["background"] = True
+    try:
+        job = await asyncio.to_thread(
+            job_store.create, target_format, mode, setting, upload["filename"], resize
+        )
+    except BaseException:
+        cleanup_temp_dir(upload["temp_dir"])
+        raise
+    job_store.submit(job, upload)
+    logger.info(f"已受理异步任务 {job['job_id']}: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+    return JSONResponse(status_code=202, content=job_status_response(job))
+
+@app.get("/jobs/{job_id}", summary="查询异步任务状态")
+async def get_job(job_id: str = Path(..., pattern=JOB_ID_PATTERN)):
+    """
+    返回任务状态（queued / running / succeeded / failed / cancelled）、当前阶段、
+    进度（0-1）与过期时间；成功时附带 result_url。
+    """
+    job = await asyncio.to_thread(get_job_or_404, job_id)
+    return job_status_response(job)
+
+@app.get(
+    "/jobs/{job_id}/result",
+    summary="下载异步任务结果",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "转换成功，返回图像文件"},
+        404: {"description": "任务不存在或已过期"},
+        409: {"description": "任务尚未成功完成"},
+    }
+)
+async def get_job_result(job_id: str = Path(..., pattern=JOB_ID_PATTERN)):
+    """任务成功后返回转换结果；结果在过期前可重复下载。"""
+    job = await asyncio.to_thread(get_job_or_404, job_id)
+    if job["status"] != "succeeded":
+        return JSONResponse(status_code=409, content=job_status_response(job))
+    result = job["result"]
+    if not os.path.exists(result["path"]):
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    headers = {"X-Cache": result["cache_status"], "X-Conversion-Engine": result["engine"]}
+    if result.get("animation") is not None:
+        headers["X-Animation"] = result["animation"]
+    return FileResponse(
+        path=result["path"],
+        media_type=result["media_type"],
+        filename=result["filename"],
+        headers=headers
+    )
+
+@app.delete("/jobs/{job_id}", summary="取消异步任务", status_code=202)
+async def cancel_job(job_id: str = Path(..., pattern=JOB_ID_PATTERN)):
+    """
+    取消排队或执行中的任务（正在运行的编码进程会被终止）；已结束的任务
+    会被立即删除。
+    """
+    job = await asyncio.to_thread(get_job_or_404, job_id)
+    if job["status"] in JOB_ACTIVE_STATES:
+        job_store.request_cancel(job_id)
+        return JSONResponse(status_code=202, content=job_status_response(job))
+    await asyncio.to_thread(shutil.rmtree, job_store.job_dir(job_id), True)
+    return JSONResponse(status_code=200, content={"job_id": job_id, "status": "deleted"})
+
+# --- 7. 源图存储 API（上传一次，多次转换）---
+
+SOURCE_HASH_PATTERN = "^[0-9a-f]{64}$"
+
+
+class SourceStore:
+    """
+    按内容寻址的源图存储：POST /img 上传一次，之后通过 GET 转换 URL 多次转换。
+
+    - 每个源图一个目录 SOURCES_DIR/<hash[:2]>/<hash>/：原始文件、meta.json，以及
+      按 ImageMagick 版本区分的预解码像素缓存 mpc-<版本摘要>/source.mpc（配套
+      source.cache）；magick 直接映射像素缓存，转换时不再重复解码
+    - 条目与像素缓存都以原子 rename 发布，多个 worker 可安全共享；meta.json 的
+      mtime 作为 LRU 时间戳（读取时刷新），超出字节预算时淘汰最旧条目
+    - 转换期间持有条目的共享 flock；淘汰以非阻塞排他锁跳过正在使用的条目
+    - 像素缓存在上传后于后台生成；ImageMagick 升级后按新版本重建，期间直接
+      使用原始文件
+    """
+
+    def __init__(self, sources_dir: str, max_bytes: int):
+        self.sources_dir = sources_dir
+        self.max_bytes = max_bytes
+        self.tasks: dict = {}
+        self._failed: set = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def entry_dir(self, source_hash: str) -> str:
+        return os.path.join(self.sources_dir, source_hash[:2], source_hash)
+
+    @staticmethod
+    def mpc_dirname(magick_version: str) -> str:
+        return "mpc-" + hashlib.sha256(magick_version.encode("utf-8")).hexdigest()[:12]
+
+    def mpc_path(self, source_hash: str, magick_version: str) -> str:
+        return os.path.join(self.entry_dir(source_hash), self.mpc_dirname(magick_version), "source.mpc")
+
+    def read_meta(self, source_hash: str) -> Optional[dict]:
+        """读取源图元数据并刷新其 LRU 时间戳；不存在时返回 None。"""
+        path = os.path.join(self.entry_dir(source_hash), "meta.json")
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def publish(self, upload: dict) -> tuple:
+        """
+        把上传文件移入存储并写入元数据，返回 (元数据, 是否新建)。
+
+        条目先在暂存目录中完整生成再 rename 发布；其他 worker 已发布同一内容时
+        丢弃暂存目录，沿用已有条目。
+        """
+        source_hash = upload["sha256"]
+        meta = self.read_meta(source_hash)
+        if meta is not None:
+            return meta, False
+        entry = self.entry_dir(source_hash)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = f"{entry}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(staging)
+        try:
+            original = f"original{upload['extension']}"
+            os.replace(upload["input_path"], os.path.join(staging, original))
+            meta = {
+                "hash": source_hash,
+                "filename": upload["filename"],
+                "original": original,
+                "size": upload["size"],
+                "image": upload["image"],
+                "created_at": time.time(),
+            }
+            with open(os.path.join(staging, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            open(os.path.join(staging, ".lock"), "w").close()
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                existing = self.read_meta(source_hash)
+                if existing is None:
+                    raise
+                return existing, False
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        logger.info("源图已存储: %s (%s, %d 字节)", source_hash, upload["filename"], upload["size"])
+        return meta, True
+
+    def acquire(self, source_hash: str):
+        """
+        获取条目的共享锁（转换期间防止被淘汰），返回需由调用方关闭的锁文件。
+
+        Raises:
+            HTTPException: 404，条目不存在或刚被淘汰
+        """
+        entry = self.entry_dir(source_hash)
+        try:
+            lock_file = open(os.path.join(entry, ".lock"))
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Source not found.")
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        if not os.path.exists(os.path.join(entry, "meta.json")):
+            lock_file.close()
+            raise HTTPException(status_code=404, detail="Source not found.")
+        return lock_file
+
+    def select_input(
+        self,
+        meta: dict,
+        magick_version: str,
+        target_formats: list,
+        resize: Optional[dict],
+        pin_key: Optional[str] = None
+    ) -> tuple:
+        """
+        为一次转换选择输入文件，返回 (路径, 缓存键使用的输入摘要)。
+
+        像素缓存省去解码，但以下情况原始文件更快：JPEG 缩放（解码期缩小）、
+        heif-enc 直接读取原始 JPEG/PNG、Pillow 快速路径可处理的小图。两种输入
+        的输出字节可能不同，因此摘要不同，各自缓存。
+
+        pin_key 标识一个 URL（按原始文件计算的 ETag 键）：像素缓存尚未生成时用原始
+        文件服务过的 URL 会被记录在 pins/ 下，之后即使像素缓存已生成也继续使用原始
+        文件，同一 URL 的 ETag 保持不变，CDN 重新验证不会触发重新编码。
+        """
+        source_hash = meta["hash"]
+        entry = self.entry_dir(source_hash)
+        original = os.path.join(entry, meta["original"])
+        mpc_path = self.mpc_path(source_hash, magick_version)
+        image = meta["image"]
+        prefer_original = (
+            (resize is not None and image is not None and image["format"] == "jpeg")
+            or any(
+                target_format in ["avif", "heif"] and resize is None and heif_enc_reads_directly(original)
+                for target_format in target_formats
+            )
+            or all(
+                select_conversion_engine(original, image, target_format) == "pillow"
+                for target_format in target_formats
+            )
+        )
+        if prefer_original:
+            return original, source_hash
+        pin_path = os.path.join(entry, "pins", pin_key) if pin_key is not None else None
+        if pin_path is not None and os.path.exists(pin_path):
+            return original, source_hash
+        if not os.path.exists(mpc_path):
+            if pin_path is not None:
+                try:
+                    os.makedirs(os.path.dirname(pin_path), exist_ok=True)
+                    open(pin_path, "w").close()
+                except OSError as exc:
+                    logger.warning("记录源图 URL 的输入选择失败: %s", exc)
+            return original, source_hash
+        return mpc_path, f"{source_hash}:mpc"
+
+    async def build_mpc(self, meta: dict, magick_version: str) -> None:
+        """
+        在后台生成当前 ImageMagick 版本的像素缓存，完成后清理旧版本并按预算淘汰。
+
+        使用后台准入通道（不计入请求排队上限）；失败只记录日志，转换继续使用原始文件。
+        """
+        source_hash = meta["hash"]
+        final = os.path.dirname(self.mpc_path(source_hash, magick_version))
+        staging = f"{final}.{uuid.uuid4().hex}.tmp"
+        image = meta["image"]
+        try:
+            os.makedirs(staging)
+            cost = estimate_conversion_cost(image, ["mpc"], meta["size"])
+            async with conversion_slot(cost, "source-store", background=True):
+                await run_conversion_commands([
+                    ['magick'] + build_limit_options(image)
+                    + [os.path.join(self.entry_dir(source_hash), meta["original"]),
+                       os.path.join(staging, "source.mpc")]
+                ])
+            try:
+                os.rename(staging, final)
+            except OSError:
+                if not os.path.isdir(final):
+                    raise
+            logger.info("源图像素缓存已生成: %s", source_hash)
+        except (HTTPException, asyncio.TimeoutError, OSError) as exc:
+            self._failed.add((source_hash, magick_version))
+            logger.warning("生成源图像素缓存失败，继续使用原始文件: %s (%s)", source_hash, exc)
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        await asyncio.to_thread(self._remove_stale_mpc, source_hash, os.path.basename(final))
+        await asyncio.to_thread(self.evict)
+
+    def schedule_mpc(self, meta: dict, magick_version: str) -> None:
+        """当前版本的像素缓存不存在时在后台生成（同一 worker 内去重，失败后不再重试）。"""
+        key = (meta["hash"], magick_version)
+        if (
+            key in self.tasks
+            or key in self._failed
+            or not capability_probe.can_write("mpc")
+            or os.path.exists(self.mpc_path(meta["hash"], magick_version))
+        ):
+            return
+        task = asyncio.create_task(self.build_mpc(meta, magick_version))
+        self.tasks[key] = task
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    def _remove_stale_mpc(self, source_hash: str, keep: str) -> None:
+        """删除其他 ImageMagick 版本的像素缓存；条目正在使用时留待下次。"""
+        entry = self.entry_dir(source_hash)
+        try:
+            with open(os.path.join(entry, ".lock")) as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                for item in os.scandir(entry):
+                    if item.is_dir() and item.name.startswith("mpc-") and item.name != keep:
+                        shutil.rmtree(item.path, ignore_errors=True)
+        except FileNotFoundError:
+            return
+
+    def evict(self) -> None:
+        """
+        淘汰最久未使用的源图直到总大小回到预算内，跳过持有共享锁的条目。
+
+        通过非阻塞 flock 保证同一时刻只有一个 worker 在扫描存储目录。
+        """
+        if not os.path.isdir(self.sources_dir):
+            return
+        with open(os.path.join(self.sources_dir, ".evict.lock"), "a") as evict_lock:
+            try:
+                fcntl.flock(evict_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            total = 0
+            for shard in os.scandir(self.sources_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if not entry.is_dir() or entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        last_used = os.path.getmtime(os.path.join(entry.path, "meta.json"))
+                    except FileNotFoundError:
+                        continue
+                    size = directory_size(entry.path)
+                    entries.append((last_used, size, entry.path))
+                    total += size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    with open(os.path.join(path, ".lock")) as lock_file:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        # 先删 meta.json：等待共享锁的请求拿到锁后会看到条目已不存在
+                        os.unlink(os.path.join(path, "meta.json"))
+                        shutil.rmtree(path, ignore_errors=True)
+                except (BlockingIOError, FileNotFoundError):
+                    continue
+                total -= size
+                logger.info("已淘汰源图: %s", os.path.basename(path))
+            logger.info("源图存储淘汰完成，当前占用 %.2f MB", total / (1024 * 1024))
+
+    async def stop(self) -> None:
+        """取消本 worker 仍在生成的像素缓存（暂存目录随任务一起清理）。"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+source_store = SourceStore(SOURCES_DIR, SOURCE_STORE_MAX_MB * 1024 * 1024)
+
+def source_response(meta: dict) -> dict:
+    """源图元数据的对外表示（隐藏本地路径）。"""
+    image = meta["image"] or {}
+    return {
+        "hash": meta["hash"],
+        "filename": meta["filename"],
+        "size": meta["size"],
+        "format": image.get("format"),
+        "width": image.get("width"),
+        "height": image.get("height"),
+        "frames": image.get("frames"),
+        "animated": image.get("animated"),
+        "url": f"/img/{meta['hash']}",
+        "transform_url": f"/img/{meta['hash']}/{{target_format}}/{{mode}}/{{setting}}",
+    }
+
+def get_source_or_404(source_hash: str) -> dict:
+    meta = source_store.read_meta(source_hash)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Source not found.")
+    return meta
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 是否匹配（弱比较，支持 * 与逗号分隔的多个值）。"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+@app.post(
+    "/img",
+    summary="上传源图（上传一次，多次转换）",
+    status_code=201,
+    responses={
+        200: {"description": "相同内容的源图已存在，返回其元数据"},
+        201: {"description": "源图已存储，返回内容哈希与转换地址"},
+        400: {"description": "请求无效（例如文件过大）"},
+        503: {"description": "源图存储已禁用"},
+    },
+    openapi_extra=multipart_openapi()
+)
+async def upload_source(request: Request):
+    """
+    上传原图并按内容哈希（SHA-256）存储，之后可通过
+    `GET /img/{hash}/{target_format}/{mode}/{setting}` 反复转换而无需再次上传。
+
+    存储后在后台把原图预解码为 ImageMagick 像素缓存（MPC），后续转换直接读取像素。
+    """
+    if not source_store.enabled:
+        raise HTTPException(status_code=503, detail="Source store is disabled.")
+    upload = await receive_upload(request, ram_staging=False)
+    try:
+        meta, created = await asyncio.to_thread(source_store.publish, upload)
+    finally:
+        cleanup_temp_dir(upload["temp_dir"])
+    encoder_versions = await get_encoder_versions()
+    source_store.schedule_mpc(meta, encoder_versions["magick"])
+    if created:
+        await asyncio.to_thread(source_store.evict)
+    return JSONResponse(
+        status_code=201 if created else 200,
+        content=source_response(meta),
+        headers={"Location": f"/img/{meta['hash']}"}
+    )
+
+@app.get("/img/{source_hash}", summary="查询源图元数据")
+async def get_source(source_hash: str = Path(..., pattern=SOURCE_HASH_PATTERN)):
+    """返回已存储源图的文件名、大小、格式、尺寸与帧数。"""
+    meta = await asyncio.to_thread(get_source_or_404, source_hash)
+    return source_response(meta)
+
+@app.get(
+    "/img/{source_hash}/{target_format}/{mode}/{setting}",
+    summary="按 URL 转换已存储的源图",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "转换成功，返回图像文件（带 ETag 与 Cache-Control）"},
+        304: {"description": "If-None-Match 与当前 ETag 匹配"},
+        404: {"description": "源图不存在或已被淘汰"},
+        422: {"description": "路径参数验证失败（例如格式不支持）"},
+        429: {"description": "服务器繁忙（排队已满或等待超时），请按 Retry-After 重试"},
+        500: {"description": "服务器内部转换失败"},
+        504: {"description": "转换处理超时"}
+    }
+)
+async def transform_source(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    target_format: NegotiableFormat,
+    mode: ConversionMode,
+    source_hash: str = Path(..., pattern=SOURCE_HASH_PATTERN),
     setting: int = Path(..., ge=0, le=100, description="质量(有损) 或 压缩速度(无损) (0-100)"),
-    file: UploadFile = File(..., description="要转换的图像文件 (支持动图)")
+    width: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标宽度"),
+    height: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标高度"),
+    fit: ResizeFit = Query("contain", description="缩放适配方式"),
+    thumbnail: bool = Query(False, description="缩略图模式（更快，去除元数据）"),
+    max_bytes: Optional[int] = Query(None, ge=1, description="输出字节预算：在 setting 以内搜索不超过预算的最高质量"),
+    min_ssim: Optional[float] = Query(None, gt=0, le=1, description="最低 SSIM：在 setting 以内搜索满足阈值的最低质量")
 ):
     """
-    通过动态 URL 路径接收图像文件，执行转换并返回结果。
+    转换已存储的源图；路径与查询参数的含义与 `/convert/{target_format}/{mode}/{setting}` 相同。
 
-    - **target_format**: 目标格式 (avif, webp, jpeg, png, gif, heif)
-    - **mode**: 转换模式 (lossless, lossy)
-    - **setting**: 模式设置 (0-100)
-        - mode=lossy: 0=最差质量, 100=最佳质量
-        - mode=lossless: 0=最慢/最佳压缩, 100=最快/最差压缩
+    URL 可直接放进 `<img src>` 或交给 CDN 缓存：响应带强 ETag（由源图哈希、转换参数
+    与编码器版本决定）和 `Cache-Control: public, max-age=IMG_CACHE_MAX_AGE`；
+    If-None-Match 匹配时直接返回 304，不进行任何编码。auto 目标额外带 `Vary: Accept`。
     """
-    logger.info(f"收到API转换请求: {target_format}/{mode}/{setting} (文件: {file.filename})")
+    resize = parse_resize_options(width, height, fit, thumbnail)
+    quality_target = parse_quality_target(target_format, mode, max_bytes, min_ssim)
+    meta = await asyncio.to_thread(get_source_or_404, source_hash)
+    encoder_versions = await get_encoder_versions()
+    accept = request.headers.get("accept", "")
+    lock_file = await asyncio.to_thread(source_store.acquire, source_hash)
+    try:
+        target_formats = [target_format]
+        if target_format == "auto":
+            target_formats = negotiate_formats(accept, meta["image"], mode)[:max(1, AUTO_CANDIDATES)]
+        # 以原始文件计算的 ETag 键标识该 URL，像素缓存生成前后保持同一输入
+        pin_params = {"target_formats": target_formats, "mode": mode, "setting": setting, "resize": resize}
+        if quality_target is not None:
+            pin_params["quality_target"] = quality_target
+        input_path, input_digest = await asyncio.to_thread(
+            source_store.select_input, meta, encoder_versions["magick"], target_formats, resize,
+            conversion_cache.make_key(source_hash, pin_params, encoder_versions)
+        )
+        image = await asyncio.to_thread(inspect_image, input_path)
+        if target_format == "auto":
+            # 与 _perform_auto_conversion() 按实际输入协商的候选保持一致
+            target_formats = negotiate_formats(accept, image, mode)[:max(1, AUTO_CANDIDATES)]
+        params = {"target_formats": target_formats, "mode": mode, "setting": setting, "resize": resize}
+        if quality_target is not None:
+            params["quality_target"] = quality_target
+        headers = {
+            "ETag": f'"{conversion_cache.make_key(input_digest, params, encoder_versions)}"',
+            "Cache-Control": f"public, max-age={IMG_CACHE_MAX_AGE}",
+        }
+        if target_format == "auto":
+            headers["Vary"] = "Accept"
+        source_store.schedule_mpc(meta, encoder_versions["magick"])
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
 
-    # 调用核心转换逻辑
-    return await _perform_conversion(
+        logger.info(f"收到源图转换请求: {source_hash} -> {target_format}/{mode}/{setting}")
+        upload = {
+            "temp_dir": create_session_dir(meta["size"] * STAGING_RAM_FACTOR),
+            "input_path": input_path,
+            "data": None,
+            "filename": meta["filename"],
+            "extension": os.path.splitext(input_path)[1],
+            "size": meta["size"],
+            "sha256": input_digest,
+            "image": image,
+            "client": client_identity(request),
+            "fields": {},
+            "started_at": time.monotonic(),
+            "upload_seconds": 0.0,
+            "validation_seconds": 0.0,
+        }
+        if target_format == "auto":
+            response = await cancel_on_disconnect(
+                request, _perform_auto_conversion(background_tasks, upload, accept, mode, setting, resize)
+            )
+        else:
+            response = await cancel_on_disconnect(request, _perform_conversion(
+                background_tasks=background_tasks,
+                upload=upload,
+                target_format=target_format,
+                mode=mode,
+                setting=setting,
+                resize=resize,
+                quality_target=quality_target
+            ))
+    finally:
+        lock_file.close()
+    response.headers.update(headers)
+    return response
+
+# --- 8. 分块续传上传 API ---
+
+UPLOAD_ID_PATTERN = "^[0-9a-f]{32}$"
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+# 文件头魔数校验需要的字节数（与 receive_upload() 一致）
+UPLOAD_HEADER_BYTES = 32
+
+
+class UploadStore:
+    """
+    可续传的分块上传会话，多个 worker 共享。
+
+    - 每个会话一个目录 UPLOADS_DIR/<upload_id>/：upload.json 记录文件名、声明的
+      总大小与可选的整体 SHA-256，数据块按顺序直接追加到同目录的 data 文件
+    - 已接收偏移量即 data 的文件大小：每个块带自己的 SHA-256（Content-Digest），
+      校验失败、长度不符或连接中断时截断回块开始处，偏移量只随完整且校验通过的块前进
+    - 同一会话同时只接受一个写入（非阻塞排他 flock，冲突返回 409）
+    - upload.json 的 mtime 记录最后活动时间，空闲超过 ttl 的会话由后台清理
+    - 完成时把 data 移入普通会话目录，之后与 receive_upload() 的结果一样交给转换逻辑
+    """
+
+    def __init__(self, uploads_dir: str, max_sessions: int, ttl_seconds: int):
+        self.uploads_dir = uploads_dir
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def session_dir(self, upload_id: str) -> str:
+        return os.path.join(self.uploads_dir, upload_id)
+
+    def read(self, upload_id: str) -> Optional[dict]:
+        """读取会话与当前偏移量；不存在或已空闲超时返回 None。"""
+        meta_path = os.path.join(self.session_dir(upload_id), "upload.json")
+        try:
+            with open(meta_path) as f:
+                session = json.load(f)
+            touched_at = os.path.getmtime(meta_path)
+            session["offset"] = os.path.getsize(os.path.join(self.session_dir(upload_id), "data"))
+        except (OSError, ValueError):
+            return None
+        session["expires_at"] = touched_at + self.ttl_seconds
+        if session["expires_at"] < time.time():
+            return None
+        return session
+
+    def create(self, filename: str, extension: str, size: int, sha256: Optional[str]) -> dict:
+        """
+        登记新的上传会话。
+
+        Raises:
+            HTTPException: 429，未完成的会话已达上限
+        """
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        with open(os.path.join(self.uploads_dir, ".create.lock"), "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            active = sum(
+                1 for name in os.listdir(self.uploads_dir)
+                if not name.startswith(".") and self.read(name) is not None
+            )
+            if active >= self.max_sessions:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many active uploads. Please retry later.",
+                    headers={"Retry-After": str(min(60, self.ttl_seconds))}
+                )
+            upload_id = uuid.uuid4().hex
+            session_dir = self.session_dir(upload_id)
+            os.makedirs(session_dir)
+            open(os.path.join(session_dir, "data"), "wb").close()
+            open(os.path.join(session_dir, ".lock"), "w").close()
+            session = {
+                "upload_id": upload_id,
+                "filename": filename,
+                "extension": extension,
+                "size": size,
+                "sha256": sha256,
+                "created_at": time.time(),
+            }
+            with open(os.path.join(session_dir, "upload.json"), "w") as f:
+                json.dump(session, f)
+        logger.info("已创建上传会话 %s: '%s' (%d 字节)", upload_id, filename, size)
+        return self.read(upload_id)
+
+    def lock(self, upload_id: str):
+        """
+        获取会话的排他锁，返回需由调用方关闭的锁文件。
+
+        Raises:
+            HTTPException: 404，会话不存在或已过期；409，会话正在被其他请求写入或完成
+        """
+        try:
+            lock_file = open(os.path.join(self.session_dir(upload_id), ".lock"))
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found or expired.")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise HTTPException(status_code=409, detail="Another request is writing to this upload.")
+        if self.read(upload_id) is None:
+            lock_file.close()
+            raise HTTPException(status_code=404, detail="Upload not found or expired.")
+        return lock_file
+
+    async def append(self, upload_id: str, request: Request) -> dict:
+        """
+        把请求体作为一个数据块追加到会话的 data 文件，返回更新后的会话。
+
+        请求必须带 Content-Range（起点等于当前偏移量）与 Content-Digest（块的
+        SHA-256）；数据边接收边写入，不在内存中缓存整个块。
+
+        Raises:
+            HTTPException: 400，请求头缺失/不合法、块超出声明大小、校验失败或文件头
+            不是图像；409，起点与当前偏移量不符（响应中带当前偏移量）
+        """
+        lock_file = self.lock(upload_id)
+        try:
+            session = self.read(upload_id)
+            offset = session["offset"]
+            match = CONTENT_RANGE_PATTERN.match(request.headers.get("content-range", "").strip())
+            if match is None:
+                raise HTTPException(status_code=400, detail="Content-Range header 'bytes start-end/total' is required.")
+            start, end = int(match.group(1)), int(match.group(2))
+            total = match.group(3)
+            if end < start or (total != "*" and int(total) != session["size"]) or end >= session["size"]:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid Content-Range for an upload of {session['size']} bytes."
+                )
+            if start != offset:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Chunk must start at the current offset {offset}.",
+                    headers={"Upload-Offset": str(offset)}
+                )
+            expected_digest = parse_content_digest(request.headers.get("content-digest", ""))
+            length = end - start + 1
+
+            data_path = os.path.join(self.session_dir(upload_id), "data")
+            digest = hashlib.sha256()
+            received = 0
+            committed = False
+            output = open(data_path, "ab")
+            try:
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if received > length:
+                        raise HTTPException(status_code=400, detail="Chunk body is longer than its Content-Range.")
+                    digest.update(chunk)
+                    # 与 receive_upload() 相同：写入页缓存的开销很小，直接在事件循环中写入
+                    output.write(chunk)
+                output.flush()
+                if received != length:
+                    raise HTTPException(status_code=400, detail="Chunk body is shorter than its Content-Range.")
+                if digest.digest() != expected_digest:
+                    logger.warning("上传会话 %s 的数据块校验失败: 偏移 %d, %d 字节", upload_id, start, length)
+                    raise HTTPException(status_code=400, detail="Chunk checksum mismatch.")
+                if offset < UPLOAD_HEADER_BYTES <= end + 1 or (end + 1 == session["size"] < UPLOAD_HEADER_BYTES):
+                    with open(data_path, "rb") as f:
+                        if not validate_image_header(f.read(UPLOAD_HEADER_BYTES)):
+                            raise HTTPException(
+                                status_code=400,
+                                detail="Invalid image file content. The file does not appear to be a valid image."
+                            )
+                committed = True
+            finally:
+                # 未完整接收或未通过校验的块不计入偏移量
+                if not committed:
+                    output.truncate(offset)
+                output.close()
+            os.utime(os.path.join(self.session_dir(upload_id), "upload.json"))
+            return self.read(upload_id)
+        finally:
+            lock_file.close()
+
+    def finalize(self, upload_id: str, client: str) -> dict:
+        """
+        结束上传：校验数据完整，把 data 移入新的会话目录，返回与 receive_upload()
+        相同结构的字典（调用方负责清理其中的 temp_dir）。上传会话随之删除。
+
+        Raises:
+            HTTPException: 404，会话不存在；409，数据尚未接收完整或会话正被写入；
+            422，整体 SHA-256 与创建时声明的不一致（会话被删除）；像素数超限等
+            与普通上传相同的校验错误
+        """
+        started_at = time.monotonic()
+        lock_file = self.lock(upload_id)
+        try:
+            session = self.read(upload_id)
+            if session["offset"] != session["size"]:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Upload is incomplete: {session['offset']} of {session['size']} bytes received.",
+                    headers={"Upload-Offset": str(session["offset"])}
+                )
+            data_path = os.path.join(self.session_dir(upload_id), "data")
+            digest = hashlib.sha256()
+            with open(data_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+            if session["sha256"] is not None and session["sha256"] != sha256:
+                shutil.rmtree(self.session_dir(upload_id), ignore_errors=True)
+                raise HTTPException(status_code=422, detail="Upload checksum mismatch.")
+            temp_dir = create_session_dir()
+            input_path = os.path.join(temp_dir, f"input{session['extension']}")
+            try:
+                shutil.move(data_path, input_path)
+                image = inspect_image(input_path)
+                check_pixel_limit(image)
+            except BaseException:
+                cleanup_temp_dir(temp_dir)
+                raise
+            shutil.rmtree(self.session_dir(upload_id), ignore_errors=True)
+        finally:
+            lock_file.close()
+        logger.info("上传会话 %s 已完成: '%s' (%d 字节)", upload_id, session["filename"], session["size"])
+        return {
+            "temp_dir": temp_dir,
+            "input_path": input_path,
+            "data": None,
+            "filename": session["filename"],
+            "extension": session["extension"],
+            "size": session["size"],
+            "sha256": sha256,
+            "image": image,
+            "client": client,
+            "fields": {},
+            "started_at": started_at,
+            "upload_seconds": 0.0,
+            "validation_seconds": time.monotonic() - started_at,
+        }
+
+    def sweep(self) -> None:
+        """删除空闲超时的会话目录（以及缺少 upload.json 的残留目录）。"""
+        if not os.path.isdir(self.uploads_dir):
+            return
+        now = time.time()
+        for upload_id in os.listdir(self.uploads_dir):
+            session_dir = self.session_dir(upload_id)
+            if upload_id.startswith(".") or not os.path.isdir(session_dir):
+                continue
+            if self.read(upload_id) is not None or now - os.path.getmtime(session_dir) <= self.ttl_seconds:
+                continue
+            try:
+                lock_file = open(os.path.join(session_dir, ".lock"))
+            except FileNotFoundError:
+                lock_file = None
+            try:
+                if lock_file is not None:
+                    # 正在接收数据块（块耗时超过 ttl）的会话不清理
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(session_dir, ignore_errors=True)
+                logger.info("已清理过期上传会话: %s", upload_id)
+            except BlockingIOError:
+                pass
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(min(60, max(1, self.ttl_seconds)))
+            try:
+                await asyncio.to_thread(self.sweep)
+            except OSError as exc:
+                logger.warning("清理上传会话失败: %s", exc)
+
+    async def start(self) -> None:
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+
+upload_store = UploadStore(UPLOADS_DIR, UPLOAD_MAX_SESSIONS, UPLOAD_SESSION_TTL_SECONDS)
+
+def parse_content_digest(header: str) -> bytes:
+    """
+    从 Content-Digest 请求头（RFC 9530，如 `sha-256=:<base64>:`）中取出 SHA-256 摘要。
+
+    Raises:
+        HTTPException: 400，缺少 sha-256 摘要或格式不合法
+    """
+    for item in header.split(","):
+        algorithm, _, value = item.strip().partition("=")
+        if algorithm.strip().lower() != "sha-256":
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == ":":
+            try:
+                digest = base64.b64decode(value[1:-1], validate=True)
+            except ValueError:
+                digest = b""
+            if len(digest) == 32:
+                return digest
+        break
+    raise HTTPException(status_code=400, detail="Content-Digest header with a sha-256 value is required.")
+
+def upload_status_response(session: dict) -> JSONResponse:
+    """上传会话状态的对外表示；当前偏移量同时放在 Upload-Offset 响应头中。"""
+    content = {
+        "upload_id": session["upload_id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "offset": session["offset"],
+        "complete": session["offset"] == session["size"],
+        "expires_at": session["expires_at"],
+        "upload_url": f"/uploads/{session['upload_id']}",
+    }
+    return JSONResponse(content=content, headers={"Upload-Offset": str(session["offset"])})
+
+@app.post("/uploads", summary="创建分块上传会话", status_code=201)
+async def create_upload(
+    filename: str = Query(..., description="原始文件名（决定输入格式的扩展名）"),
+    size: int = Query(..., ge=1, description="文件总字节数"),
+    sha256: Optional[str] = Query(None, pattern="^[0-9a-fA-F]{64}$", description="整个文件的 SHA-256（可选，完成时校验）")
+):
+    """
+    创建可续传的上传会话，之后按顺序 `PUT /uploads/{upload_id}` 上传数据块，
+    中断后用 `GET /uploads/{upload_id}` 查询已接收的偏移量并从该处继续。
+    """
+    extension = validate_upload_filename(filename)
+    if size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        raise HTTPException(status_code=400, detail=f"File too large. Max size is {MAX_FILE_SIZE_MB}MB.")
+    session = await asyncio.to_thread(
+        upload_store.create, filename, extension, size, sha256.lower() if sha256 else None
+    )
+    response = upload_status_response(session)
+    response.status_code = 201
+    response.headers["Location"] = f"/uploads/{session['upload_id']}"
+    return response
+
+@app.put(
+    "/uploads/{upload_id}",
+    summary="上传一个数据块",
+    responses={
+        400: {"description": "请求头缺失或不合法、块校验失败或文件头不是图像；偏移量不变"},
+        404: {"description": "会话不存在或已过期"},
+        409: {"description": "起点与当前偏移量不符，或会话正被其他请求写入"},
+    }
+)
+async def upload_chunk(request: Request, upload_id: str = Path(..., pattern=UPLOAD_ID_PATTERN)):
+    """
+    请求体为原始字节，必须带：
+
+    - **Content-Range**: `bytes start-end/total`，start 等于当前偏移量
+    - **Content-Digest**: `sha-256=:<base64>:`，本块数据的 SHA-256
+
+    成功时返回更新后的偏移量（`Upload-Offset` 响应头与 JSON 中的 offset）。
+    """
+    session = await upload_store.append(upload_id, request)
+    return upload_status_response(session)
+
+@app.get("/uploads/{upload_id}", summary="查询上传会话的偏移量")
+async def get_upload(upload_id: str = Path(..., pattern=UPLOAD_ID_PATTERN)):
+    """返回已接收的字节数（offset）、是否接收完整与会话过期时间。"""
+    session = await asyncio.to_thread(upload_store.read, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found or expired.")
+    return upload_status_response(session)
+
+@app.delete("/uploads/{upload_id}", summary="放弃上传会话")
+async def delete_upload(upload_id: str = Path(..., pattern=UPLOAD_ID_PATTERN)):
+    """删除会话及已接收的数据。"""
+    lock_file = await asyncio.to_thread(upload_store.lock, upload_id)
+    try:
+        await asyncio.to_thread(shutil.rmtree, upload_store.session_dir(upload_id), True)
+    finally:
+        lock_file.close()
+    return {"upload_id": upload_id, "status": "deleted"}
+
+@app.post(
+    "/uploads/{upload_id}/finalize",
+    summary="完成上传并存入源图存储",
+    responses={
+        409: {"description": "数据尚未接收完整"},
+        422: {"description": "整体 SHA-256 与创建会话时声明的不一致"},
+    }
+)
+async def finalize_upload(request: Request, upload_id: str = Path(..., pattern=UPLOAD_ID_PATTERN)):
+    """
+    完成上传并按内容哈希存入源图存储，响应与 `POST /img` 相同；之后通过
+    `GET /img/{hash}/{target_format}/{mode}/{setting}` 转换。
+    """
+    if not source_store.enabled:
+        raise HTTPException(status_code=503, detail="Source store is disabled.")
+    upload = await asyncio.to_thread(upload_store.finalize, upload_id, client_identity(request))
+    try:
+        meta, created = await asyncio.to_thread(source_store.publish, upload)
+    finally:
+        cleanup_temp_dir(upload["temp_dir"])
+    encoder_versions = await get_encoder_versions()
+    source_store.schedule_mpc(meta, encoder_versions["magick"])
+    if created:
+        await asyncio.to_thread(source_store.evict)
+    return JSONResponse(
+        status_code=201 if created else 200,
+        content=source_response(meta),
+        headers={"Location": f"/img/{meta['hash']}"}
+    )
+
+@app.post(
+    "/uploads/{upload_id}/finalize/{target_format}/{mode}/{setting}",
+    summary="完成上传并转换",
+    response_class=FileResponse,
+    responses={
+        200: {"description": "转换成功，返回图像文件"},
+        409: {"description": "数据尚未接收完整"},
+        422: {"description": "参数验证失败，或整体 SHA-256 与创建会话时声明的不一致"},
+    }
+)
+async def finalize_upload_convert(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    target_format: NegotiableFormat,
+    mode: ConversionMode,
+    upload_id: str = Path(..., pattern=UPLOAD_ID_PATTERN),
+    setting: int = Path(..., ge=0, le=100, description="质量(有损) 或 压缩速度(无损) (0-100)"),
+    width: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标宽度"),
+    height: Optional[int] = Query(None, ge=1, le=MAX_RESIZE_DIMENSION, description="缩放目标高度"),
+    fit: ResizeFit = Query("contain", description="缩放适配方式"),
+    thumbnail: bool = Query(False, description="缩略图模式（更快，去除元数据）"),
+    max_bytes: Optional[int] = Query(None, ge=1, description="输出字节预算：在 setting 以内搜索不超过预算的最高质量"),
+    min_ssim: Optional[float] = Query(None, gt=0, le=1, description="最低 SSIM：在 setting 以内搜索满足阈值的最低质量")
+):
+    """
+    完成上传并转换；路径与查询参数的含义与 `/convert/{target_format}/{mode}/{setting}` 相同，
+    转换成功或失败后上传会话都已删除。
+    """
+    resize = parse_resize_options(width, height, fit, thumbnail)
+    quality_target = parse_quality_target(target_format, mode, max_bytes, min_ssim)
+    upload = await asyncio.to_thread(upload_store.finalize, upload_id, client_identity(request))
+    logger.info(f"收到分块上传转换请求: {target_format}/{mode}/{setting} (文件: {upload['filename']})")
+
+    if target_format == "auto":
+        return await cancel_on_disconnect(request, _perform_auto_conversion(
+            background_tasks, upload, request.headers.get("accept", ""), mode, setting, resize
+        ))
+
+    return await cancel_on_disconnect(request, _perform_conversion(
         background_tasks=background_tasks,
-        file=file,
+        upload=upload,
         target_format=target_format,
         mode=mode,
-        setting=setting
-    )
+        setting=setting,
+        resize=resize,
+        quality_target=quality_target
+    ))
+
+if __name__ == "__main__":
+    # entrypoint.sh 在启动 uvicorn 前调用：python3 main.py --plan-workers 输出规划的 worker 数
+    import sys
+
+    if sys.argv[1:] == ["--plan-workers"]:
+        print(RESOURCE_PLAN["workers"])
+    elif sys.argv[1:] == ["--broker"]:
+        # entrypoint.sh 在后台启动：python3 main.py --broker
+        try:
+            asyncio.run(conversion_broker.serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(json.dumps(RESOURCE_PLAN))
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+离线基准测试与压测工具
+
+针对本地启动的 main:app 实例运行，不访问任何外部服务：
+
+    python3 scripts/benchmark.py corpus                        # 只生成测试语料
+    python3 scripts/benchmark.py run -o base.json              # 启动本地实例并压测
+    python3 scripts/benchmark.py run --url http://127.0.0.1:8000 -o new.json
+    python3 scripts/benchmark.py compare base.json new.json    # 对比两次结果，回归时退出码为 1
+
+语料由固定随机种子生成（照片、截图、带透明通道的 PNG、多尺寸/帧数的 GIF 与 WebP 动图），
+同一 Pillow 版本下逐字节一致。压测按 "格式/模式/设置" 场景依次执行，每个场景输出
+p50/p95/p99 延迟、吞吐量和服务进程树的峰值 RSS（仅在由本脚本启动实例时可用）。
+
+依赖：Python 标准库与 Pillow（与服务本身的 requirements.txt 相同）。
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CORPUS_DIR = os.path.join(tempfile.gettempdir(), "imagemagick-api-benchmark", "corpus")
+DEFAULT_SCENARIOS = "webp/lossy/80,webp/lossless/50,jpeg/lossy/85,png/lossless/50,avif/lossy/50,gif/lossy/80"
+CORPUS_SEED = 20240601
+RESULT_VERSION = 1
+
+# 语料清单：(文件名, 生成器, 参数)；--quick 时跳过标记为 large 的条目
+CORPUS = [
+    ("photo-640x480.jpg", "photo", {"size": (640, 480)}),
+    ("photo-1920x1080.jpg", "photo", {"size": (1920, 1080)}),
+    ("photo-4000x3000.jpg", "photo", {"size": (4000, 3000), "large": True}),
+    ("screenshot-1280x800.png", "screenshot", {"size": (1280, 800)}),
+    ("screenshot-2560x1600.png", "screenshot", {"size": (2560, 1600), "large": True}),
+    ("alpha-512x512.png", "alpha", {"size": (512, 512)}),
+    ("alpha-1024x1024.png", "alpha", {"size": (1024, 1024)}),
+    ("anim-320x240-12f.gif", "animation", {"size": (320, 240), "frames": 12}),
+    ("anim-480x270-60f.gif", "animation", {"size": (480, 270), "frames": 60}),
+    ("anim-800x450-150f.gif", "animation", {"size": (800, 450), "frames": 150, "large": True}),
+    ("anim-320x240-12f.webp", "animation", {"size": (320, 240), "frames": 12}),
+    ("anim-480x270-60f.webp", "animation", {"size": (480, 270), "frames": 60}),
+]
+
+CONTENT_TYPES = {".jpg": "image/jpeg", ".png": "image/png", ".gif": "image/gif", ".webp": "image/webp"}
+
+# --- 1. 语料生成 ---
+
+def _noise(rng: random.Random, size: tuple, blur: float):
+    """由种子决定的灰度噪声（Pillow 的 effect_noise 使用 C 库随机数，不可复现）。"""
+    from PIL import Image, ImageFilter
+
+    width, height = size
+    # 先在 1/8 分辨率上生成再放大，避免大尺寸时生成上千万随机字节
+    small = (max(1, width // 8), max(1, height // 8))
+    noise = Image.frombytes("L", small, rng.randbytes(small[0] * small[1]))
+    return noise.resize(size, Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(blur))
+
+def make_photo(rng: random.Random, size: tuple):
+    """模拟照片：平滑渐变叠加低频噪声与若干柔和色块，压缩特性接近自然图像。"""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.ROTATE_180), _noise(rng, size, 4)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(2, min(size) // 20), max(3, min(size) // 4))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(max(1, min(size) // 200)))
+    detail = _noise(rng, size, 0.6)
+    return Image.blend(image, Image.merge("RGB", (detail, detail, detail)), 0.15)
+
+def make_screenshot(rng: random.Random, size: tuple):
+    """模拟截图：大面积纯色、窗口边框与细密的 "文字" 行，适合无损与调色板压缩。"""
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    image = Image.new("RGB", size, (246, 247, 249))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, width, 48], fill=(40, 44, 52))
+    draw.rectangle([0, 48, width // 5, height], fill=(230, 232, 236))
+    palette = [(30, 30, 30), (0, 102, 204), (200, 60, 60), (90, 90, 90)]
+    y = 72
+    while y < height - 16:
+        x = width // 5 + 24
+        while x < width - 40:
+            word = rng.randrange(12, 64)
+            draw.rectangle([x, y, x + word, y + 8], fill=rng.choice(palette))
+            x += word + rng.randrange(6, 14)
+        y += rng.randrange(18, 30)
+    for _ in range(6):
+        x, y = rng.randrange(width // 5, width - 200), rng.randrange(60, height - 120)
+        draw.rectangle([x, y, x + 180, y + 100], outline=(0, 102, 204), width=2, fill=(255, 255, 255))
+    return image
+
+def make_alpha(rng: random.Random, size: tuple):
+    """带透明通道的图标/贴纸：透明背景上的抗锯齿形状与半透明阴影。"""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    width, height = size
+    image = Image.new("RGBA", size, (0, 0, 0, 0))
+    shadow = Image.new("RGBA", size, (0, 0, 0, 0))
+    ImageDraw.Draw(shadow).ellipse([width // 8, height // 6, width * 7 // 8, height * 15 // 16], fill=(0, 0, 0, 110))
+    image.alpha_composite(shadow.filter(ImageFilter.GaussianBlur(width // 40)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x0, y0 = rng.randrange(width // 2), rng.randrange(height // 2)
+        x1, y1 = x0 + rng.randrange(width // 8, width // 2), y0 + rng.randrange(height // 8, height // 2)
+        color = tuple(rng.randrange(256) for _ in range(3)) + (rng.randrange(160, 256),)
+        draw.rounded_rectangle([x0, y0, x1, y1], radius=width // 20, fill=color)
+    return image
+
+def make_animation(rng: random.Random, size: tuple, frames: int) -> list:
+    """简单动画：移动的色块在静态背景上运动，帧间差异局部化（与真实动图类似）。"""
+    from PIL import ImageDraw
+
+    width, height = size
+    background = make_screenshot(rng, size).quantize(64).convert("RGB")
+    sprites = [
+        (rng.randrange(width), rng.randrange(height), rng.choice([-6, -3, 3, 6]), rng.choice([-4, -2, 2, 4]),
+         tuple(rng.randrange(256) for _ in range(3)))
+        for _ in range(5)
+    ]
+    result = []
+    for index in range(frames):
+        frame = background.copy()
+        draw = ImageDraw.Draw(frame)
+        for x, y, dx, dy, color in sprites:
+            cx, cy = (x + dx * index) % width, (y + dy * index) % height
+            draw.ellipse([cx - 20, cy - 20, cx + 20, cy + 20], fill=color)
+        result.append(frame)
+    return result
+
+def generate_corpus(corpus_dir: str, quick: bool = False) -> list:
+    """
+    生成（或复用已存在的）测试语料，返回文件路径列表。
+
+    每个文件使用由文件名派生的独立种子，增删条目不会改变其余文件的内容。
+    """
+    try:
+        from PIL import Image  # noqa: F401
+    except ImportError:
+        sys.exit("生成语料需要 Pillow：pip install pillow")
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for name, kind, params in CORPUS:
+        if quick and params.get("large"):
+            continue
+        path = os.path.join(corpus_dir, name)
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        rng = random.Random(f"{CORPUS_SEED}:{name}")
+        staging = f"{path}.{uuid.uuid4().hex}.tmp"
+        extension = os.path.splitext(name)[1]
+        if kind == "animation":
+            frames = make_animation(rng, params["size"], params["frames"])
+            if extension == ".gif":
+                frames = [frame.quantize(128) for frame in frames]
+                frames[0].save(staging, format="GIF", save_all=True, append_images=frames[1:], duration=40, loop=0)
+            else:
+                frames[0].save(
+                    staging, format="WEBP", save_all=True, append_images=frames[1:], duration=40, loop=0, quality=80
+                )
+        elif kind == "photo":
+            make_photo(rng, params["size"]).save(staging, format="JPEG", quality=90)
+        elif kind == "screenshot":
+            make_screenshot(rng, params["size"]).save(staging, format="PNG")
+        else:
+            make_alpha(rng, params["size"]).save(staging, format="PNG")
+        os.replace(staging, path)
+        print(f"已生成 {name} ({os.path.getsize(path)} 字节)", file=sys.stderr)
+    return paths
+
+# --- 2. 本地实例与进程内存采样 ---
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(workers: int, cache: bool, env_overrides: dict) -> tuple:
+    """在临时目录中启动 uvicorn main:app，返回 (进程, 基础 URL, 临时目录)。"""
+    temp_dir = tempfile.mkdtemp(prefix="imagemagick-api-benchmark-")
+    port = free_port()
+    env = dict(os.environ)
+    env.update({"TEMP_DIR": temp_dir, "PYTHONUNBUFFERED": "1"})
+    if not cache:
+        env["CONVERSION_CACHE_MAX_MB"] = "0"
+    env.update(env_overrides)
+    log = open(os.path.join(temp_dir, "server.log"), "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            log.close()
+            with open(os.path.join(temp_dir, "server.log"), "rb") as f:
+                sys.stderr.write(f.read().decode(errors="replace"))
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            sys.exit(f"服务进程启动失败 (退出码 {process.returncode})")
+        try:
+            status, _, _ = http_request(base_url, "GET", "/health/ready", timeout=2)
+            if status == 200:
+                return process, base_url, temp_dir
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    sys.exit("等待服务就绪超时（/health/ready）")
+
+def stop_server(process, temp_dir: str) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+def process_tree_rss(root_pid: int) -> int:
+    """读取 /proc 中进程树（uvicorn 主进程、worker 与 magick 等子进程）的 RSS 总和（字节）。"""
+    children = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        pid = int(entry)
+        children.setdefault(int(fields.get("PPid", "0").strip()), []).append(pid)
+        rss[pid] = int(fields.get("VmRSS", "0 kB").split()[0]) * 1024
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+class RssSampler:
+    """后台线程按固定间隔采样进程树 RSS，记录两次 reset() 之间的峰值。"""
+
+    def __init__(self, root_pid: int, interval: float = 0.05):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_tree_rss(self.root_pid))
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def reset(self) -> int:
+        peak, self.peak = self.peak, process_tree_rss(self.root_pid)
+        return max(peak, self.peak)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+# --- 3. 压测驱动 ---
+
+def http_request(base_url: str, method: str, path: str, body: bytes = b"", headers: dict = None, timeout: float = 300):
+    """发送一次 HTTP 请求，返回 (状态码, 响应头, 响应体长度)。每次使用新连接，与浏览器/客户端上传行为一致。"""
+    parsed = urllib.parse.urlsplit(base_url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        size = 0
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        return response.status, dict(response.getheaders()), size
+    finally:
+        connection.close()
+
+def encode_multipart(path: str) -> tuple:
+    """把语料文件编码为 multipart/form-data 请求体，返回 (请求体, Content-Type)。"""
+    boundary = uuid.uuid4().hex
+    name = os.path.basename(path)
+    content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+    with open(path, "rb") as f:
+        content = f.read()
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """最近秩百分位数（与常见压测工具一致，不插值）。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-fraction * len(sorted_values) // 1)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def run_scenario(base_url: str, scenario: str, bodies: list, requests: int, concurrency: int,
+                 rate: float, timeout: float, query: str) -> dict:
+    """
+    以 concurrency 个并发连接执行一个场景共 requests 次请求，按顺序轮换语料。
+
+    rate > 0 时为开环压测：第 i 个请求计划在 i/rate 秒发出，延迟从计划时间算起，
+    服务变慢导致的排队会计入延迟（避免协调遗漏）；rate = 0 时各连接收到响应后立即发下一个请求。
+    """
+    path = f"/convert/{scenario}" + (f"?{query}" if query else "")
+    latencies = []
+    statuses = {}
+    engines = {}
+    output_bytes = 0
+    lock = threading.Lock()
+    next_index = [0]
+    started = time.monotonic()
+
+    def worker() -> None:
+        nonlocal output_bytes
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= requests:
+                return
+            scheduled = started + index / rate if rate > 0 else time.monotonic()
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            body, content_type = bodies[index % len(bodies)]
+            try:
+                status, headers, size = http_request(
+                    base_url, "POST", path, body, {"Content-Type": content_type}, timeout=timeout
+                )
+                engine = headers.get("X-Conversion-Engine") or headers.get("x-conversion-engine")
+            except OSError as exc:
+                status, size, engine = type(exc).__name__, 0, None
+            elapsed = time.monotonic() - scheduled
+            with lock:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+                    output_bytes += size
+                    engines[engine] = engines.get(engine, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - started
+
+    latencies.sort()
+    ok = len(latencies)
+    return {
+        "requests": requests,
+        "ok": ok,
+        "error_rate": round(1 - ok / requests, 4) if requests else 0.0,
+        "statuses": statuses,
+        "engines": engines,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(ok / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "mean": round(sum(latencies) / ok * 1000, 2) if ok else 0.0,
+            "max": round(latencies[-1] * 1000, 2) if ok else 0.0,
+        },
+        "output_bytes_mean": round(output_bytes / ok) if ok else 0,
+    }
+
+def magick_version() -> str:
+    try:
+        output = subprocess.run(["magick", "-version"], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return output.splitlines()[0] if output else None
+
+def command_run(args) -> int:
+    paths = generate_corpus(args.corpus_dir, args.quick)
+    if args.match:
+        paths = [path for path in paths if args.match in os.path.basename(path)]
+    if not paths:
+        sys.exit("没有匹配的语料文件")
+    bodies = [encode_multipart(path) for path in paths]
+    scenarios = [item for item in args.scenarios.replace(" ", ",").split(",") if item]
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+
+    process = sampler = temp_dir = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url, temp_dir = start_server(args.workers, args.cache, env_overrides)
+        if os.path.isdir("/proc"):
+            sampler = RssSampler(process.pid)
+            sampler.start()
+    elif env_overrides:
+        print("警告：--env 只对本脚本启动的实例生效", file=sys.stderr)
+
+    results = {}
+    try:
+        for scenario in scenarios:
+            # 预热：每个语料文件转换一次，排除首次导入与页缓存的影响（不计入结果）
+            if args.warmup:
+                run_scenario(base_url, scenario, bodies, len(bodies), 1, 0, args.timeout, args.query)
+            if sampler is not None:
+                sampler.reset()
+            result = run_scenario(
+                base_url, scenario, bodies, args.requests, args.concurrency, args.rate, args.timeout, args.query
+            )
+            result["peak_rss_mb"] = round(sampler.reset() / 1024 / 1024, 1) if sampler is not None else None
+            results[scenario] = result
+            latency = result["latency_ms"]
+            print(
+                f"{scenario:<22} ok {result['ok']}/{result['requests']}  "
+                f"p50 {latency['p50']:.1f}ms  p95 {latency['p95']:.1f}ms  p99 {latency['p99']:.1f}ms  "
+                f"{result['throughput_rps']:.2f} req/s  rss {result['peak_rss_mb']} MB",
+                file=sys.stderr
+            )
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            stop_server(process, temp_dir)
+
+    report = {
+        "version": RESULT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "url": args.url,
+            "workers": args.workers if args.url is None else None,
+            "cache": args.cache,
+            "env": env_overrides,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "query": args.query,
+            "corpus": [os.path.basename(path) for path in paths],
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "magick": magick_version(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+# --- 4. 结果对比 ---
+
+# (指标路径, 数值越大越差)
+COMPARED_METRICS = [
+    (("latency_ms", "p50"), True),
+    (("latency_ms", "p95"), True),
+    (("latency_ms", "p99"), True),
+    (("throughput_rps",), False),
+    (("peak_rss_mb",), True),
+]
+
+def metric_value(result: dict, path: tuple):
+    for key in path:
+        result = result.get(key) if isinstance(result, dict) else None
+    return result
+
+def compare_reports(base: dict, new: dict, threshold: float, min_delta_ms: float) -> list:
+    """
+    逐场景对比两份结果，返回 (场景, 指标, 基线, 新值, 变化百分比, 是否回归) 列表。
+
+    相对变化超过 threshold（百分比）视为回归；延迟指标还要求绝对差值超过 min_delta_ms，
+    避免毫秒级场景的抖动被误报。错误率上升总是视为回归。
+    """
+    rows = []
+    for scenario, new_result in new["results"].items():
+        base_result = base["results"].get(scenario)
+        if base_result is None:
+            continue
+        for path, higher_is_worse in COMPARED_METRICS:
+            old, current = metric_value(base_result, path), metric_value(new_result, path)
+            if old is None or current is None:
+                continue
+            change = (current - old) / old * 100 if old else 0.0
+            worse = change > threshold if higher_is_worse else change < -threshold
+            if path[0] == "latency_ms" and abs(current - old) < min_delta_ms:
+                worse = False
+            rows.append((scenario, ".".join(path), old, current, change, worse))
+        old_errors, new_errors = base_result["error_rate"], new_result["error_rate"]
+        rows.append((scenario, "error_rate", old_errors, new_errors,
+                     (new_errors - old_errors) * 100, new_errors > old_errors))
+    return rows
+
+def command_compare(args) -> int:
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    rows = compare_reports(base, new, args.threshold, args.min_delta_ms)
+    regressions = [row for row in rows if row[5]]
+    for scenario, name, old, current, change, worse in rows:
+        flag = "REGRESSION" if worse else ""
+        print(f"{scenario:<22} {name:<16} {old:>10} -> {current:<10} {change:+7.1f}%  {flag}")
+    missing = sorted(set(base["results"]) - set(new["results"]))
+    if missing:
+        print(f"新结果缺少场景: {', '.join(missing)}")
+    print(f"\n{len(regressions)} 项回归（阈值 {args.threshold}%）")
+    return 1 if regressions else 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ImageMagick API 离线基准测试与压测")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    corpus = subparsers.add_parser("corpus", help="生成确定性测试语料")
+    corpus.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    corpus.add_argument("--quick", action="store_true", help="跳过大尺寸语料")
+
+    run = subparsers.add_parser("run", help="执行压测并输出 JSON 结果")
+    run.add_argument("--url", help="压测已运行的实例；缺省时在临时目录启动本地 uvicorn main:app")
+    run.add_argument("--workers", type=int, default=1, help="本地实例的 worker 数")
+    run.add_argument("--cache", action="store_true", help="启用转换结果缓存（默认禁用，以测量真实转换开销）")
+    run.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="本地实例的额外环境变量")
+    run.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    run.add_argument("--quick", action="store_true", help="跳过大尺寸语料")
+    run.add_argument("--match", help="只使用文件名包含该字符串的语料")
+    run.add_argument("--scenarios", default=DEFAULT_SCENARIOS, help="逗号分隔的 格式/模式/设置 列表")
+    run.add_argument("--query", default="", help="附加到转换 URL 的查询参数，例如 width=800")
+    run.add_argument("--requests", type=int, default=50, help="每个场景的请求数")
+    run.add_argument("--concurrency", type=int, default=4, help="并发连接数")
+    run.add_argument("--rate", type=float, default=0, help="开环请求速率（请求/秒），0 表示闭环")
+    run.add_argument("--timeout", type=float, default=600, help="单个请求超时（秒）")
+    run.add_argument("--no-warmup", dest="warmup", action="store_false", help="跳过每个场景的预热")
+    run.add_argument("-o", "--output", help="结果 JSON 路径（缺省输出到 stdout）")
+
+    compare = subparsers.add_parser("compare", help="对比两次结果，存在回归时退出码为 1")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10.0, help="回归阈值（百分比）")
+    compare.add_argument("--min-delta-ms", type=float, default=5.0, help="延迟指标的最小绝对差值")
+
+    args = parser.parse_args()
+    if args.command == "corpus":
+        for path in generate_corpus(args.corpus_dir, args.quick):
+            print(path)
+        return 0
+    if args.command == "run":
+        return command_run(args)
+    return command_compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
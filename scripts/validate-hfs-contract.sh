@@ -77,6 +77,31 @@ expected_variables = {
     "PORT", "PYTHONUNBUFFERED", "MAGICK_MEMORY_LIMIT", "MAGICK_MAP_LIMIT",
     "MAGICK_DISK_LIMIT", "MAGICK_TIME_LIMIT", "MAGICK_THREAD_LIMIT", "WORKERS",
     "MAX_CONCURRENT_PER_WORKER",
+    "CONVERSION_CACHE_MAX_MB",
+    "FAST_PATH_MAX_MEGAPIXELS",
+    "ANIMATION_SHARD_MIN_FRAMES",
+    "ANIMATION_SHARD_MIN_MEGAPIXELS",
+    "CAPABILITY_REFRESH_SECONDS",
+    "ADMISSION_SLOT_COST",
+    "ADMISSION_MAX_QUEUE",
+    "ADMISSION_MAX_WAIT_SECONDS",
+    "ADMISSION_FAST_LANE_COST",
+    "JOB_MAX_PENDING",
+    "JOB_RESULT_TTL_SECONDS",
+    "MAX_INPUT_MEGAPIXELS",
+    "PIPE_MAX_MB",
+    "RESOURCE_PLANNING",
+    "AUTO_CANDIDATES",
+    "SOURCE_STORE_MAX_MB",
+    "IMG_CACHE_MAX_AGE",
+    "STAGING_RAM_MAX_MB",
+    "STAGING_SWEEP_SECONDS",
+    "PROCESS_RLIMITS",
+    "UPLOAD_MAX_SESSIONS",
+    "UPLOAD_SESSION_TTL_SECONDS",
+    "CONVERSION_BROKER",
+    "BROKER_MAX_CONVERSIONS",
+    "CONVERSION_TRACE",
 }
 require(role_values["local_only"] == expected_local, "local_only keys must be exact")
 require(role_values["secrets"] == set(), "this service has no classified secrets")
@@ -168,7 +193,7 @@ require("JSONResponse(status_code=503" in main_source and '"status"] = "unhealth
         "health must return non-2xx unhealthy responses")
 require("except OSError as exc:" in main_source,
         "subprocess creation errors must be handled")
-require("['heif-enc']" in main_source and "commands[1].append('--avif')" in main_source,
+require("['heif-enc']" in main_source and "command.append('--avif')" in main_source,
         "AVIF/HEIF output must use the explicit libheif encoder path")
 for invariant in (
     "asyncio.wait_for(process.communicate(), timeout=5)",